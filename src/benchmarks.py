@@ -0,0 +1,152 @@
+import argparse
+import importlib.util
+import random
+import time
+
+from lxml import etree
+
+import test as ingest
+
+# Sample description bodies in the two layouts found in our KMZ exports
+HTML_DESCRIPTION_ROWS = [
+    ('Date', '4/6/2023'), ('Voltage', '138 kV'), ('Conductor Type', 'ACSR 795 mm²'),
+    ('From Str.', 'STR-1042'), ('To Str.', 'STR-1043'), ('Disp. Condition', 'Good'),
+    ('5 Digit Code', '40213'), ('County', 'Brazoria'), ('Address', '1200 County Rd 25'),
+    ('GLN X', '3154021.55'), ('GLN Y', '13754220.10'), ('Inspector', 'Field crew 7')
+]
+
+
+def make_html_description(rng):
+    rows = ''.join(f"<tr><td>{key}</td><td>{value}</td></tr>" for key, value in rng.sample(HTML_DESCRIPTION_ROWS, 10))
+    return f"<html><body><table border=\"1\">{rows}</table></body></html>"
+
+
+def make_text_description(rng):
+    lines = [f"{key}: {value}" for key, value in rng.sample(HTML_DESCRIPTION_ROWS, 10)]
+    lines.insert(rng.randrange(len(lines)), "Date 4/6/2023")
+    return "<br/>\n".join(lines)
+
+
+FEATURE_TEMPLATES = {
+    'Placemark (Point)': (
+        '<Placemark id="p{i}"><name>Pole {i}</name><description>Voltage: 138 kV</description>'
+        '<LookAt><longitude>-95.1</longitude><latitude>29.9</latitude><range>500</range></LookAt>'
+        '<styleUrl>#line</styleUrl><ExtendedData><Data name="asset"><value>A{i}</value></Data></ExtendedData>'
+        '<Point><coordinates>-95.1,29.9,0</coordinates></Point></Placemark>'
+    ),
+    'Placemark (LineString)': (
+        '<Placemark><name>Span {i}</name><styleUrl>#line</styleUrl><gx:drawOrder>2</gx:drawOrder>'
+        '<LineString><coordinates>-95.10,29.90,0 -95.11,29.91,0 -95.12,29.91,0</coordinates></LineString></Placemark>'
+    ),
+    'Placemark (MultiGeometry)': (
+        '<Placemark><name>Circuit {i}</name><styleUrl>#line</styleUrl><MultiGeometry>'
+        '<LineString><coordinates>-95.10,29.90,0 -95.11,29.91,0</coordinates></LineString>'
+        '<LineString><coordinates>-95.11,29.91,0 -95.12,29.92,0</coordinates></LineString>'
+        '</MultiGeometry></Placemark>'
+    ),
+    'GroundOverlay': (
+        '<GroundOverlay><name>Ortho {i}</name><color>ffffffff</color>'
+        '<Icon><href>files/ortho{i}.jpg</href><viewBoundScale>0.75</viewBoundScale></Icon>'
+        '<LatLonBox><north>30.0</north><south>29.9</south><east>-95.0</east><west>-95.1</west>'
+        '<rotation>1.5</rotation></LatLonBox></GroundOverlay>'
+    ),
+    'NetworkLink': (
+        '<NetworkLink><name>Link {i}</name><visibility>1</visibility>'
+        '<Link><href>tiles/{i}.kml</href><viewRefreshMode>onStop</viewRefreshMode></Link></NetworkLink>'
+    )
+}
+
+
+def load_module(path):
+    """
+    Imports a Python file under its own name, e.g. an older copy of test.py to compare against.
+    """
+    spec = importlib.util.spec_from_file_location('baseline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def report(label, count, seconds, baseline_seconds=None, extra=''):
+    line = f"{label}: {count} in {seconds:.3f} s ({count / seconds:,.0f}/s{extra})"
+    if baseline_seconds is not None:
+        line += f", baseline {baseline_seconds:.3f} s, speedup {baseline_seconds / seconds:.2f}x"
+    print(line)
+
+
+def time_calls(func, inputs, repeat):
+    """
+    Returns the best wall time in seconds of calling func on every input, over repeat runs.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for value in inputs:
+            func(value)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_description_extraction(count, repeat, baseline=None):
+    rng = random.Random(0)
+    for label, make in (('html table', make_html_description), ('plain text', make_text_description)):
+        descriptions = [make(rng) for _ in range(count)]
+        size = sum(len(d) for d in descriptions)
+        seconds = time_calls(ingest.extract_data_from_description, descriptions, repeat)
+        baseline_seconds = (time_calls(baseline.extract_data_from_description, descriptions, repeat)
+                            if baseline else None)
+        report(f"extract_data_from_description [{label}]", count, seconds, baseline_seconds,
+               f", {size / seconds / 1e6:.1f} MB/s")
+
+
+def feature_extractor(module, kind, ns, root):
+    """
+    Returns a one-argument function that runs module's extract_*_details for a feature kind.
+    """
+    if kind.startswith('Placemark'):
+        styles, style_maps = module.parse_styles_and_maps(root, ns)
+        if hasattr(module, 'StyleResolver'):
+            resolver = module.StyleResolver(styles, style_maps, ns)
+            return lambda element: module.extract_placemark_details(element, ns, resolver, False, [])
+        return lambda element: module.extract_placemark_details(element, ns, styles, style_maps, False, [])
+    if kind == 'GroundOverlay':
+        return lambda element: module.extract_groundoverlay_details(element, ns, [])
+    return lambda element: module.extract_networklink_details(element, ns, [])
+
+
+def bench_feature_extraction(count, repeat, baseline=None):
+    ns = {'kml': 'http://www.opengis.net/kml/2.2', 'gx': 'http://www.google.com/kml/ext/2.2'}
+    for kind, template in FEATURE_TEMPLATES.items():
+        features = ''.join(template.format(i=i) for i in range(count))
+        root = etree.fromstring(
+            f'<kml xmlns="{ns["kml"]}" xmlns:gx="{ns["gx"]}"><Document>'
+            f'<Style id="line"><LineStyle><color>ff0000ff</color><width>2</width></LineStyle></Style>'
+            f'{features}</Document></kml>'.encode('utf-8'))
+        elements = list(root[0])[1:]
+        seconds = time_calls(feature_extractor(ingest, kind, ns, root), elements, repeat)
+        baseline_seconds = (time_calls(feature_extractor(baseline, kind, ns, root), elements, repeat)
+                            if baseline else None)
+        report(f"extract details [{kind}]", count, seconds, baseline_seconds)
+
+
+BENCHMARKS = {
+    'description': bench_description_extraction,
+    'features': bench_feature_extraction
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for ingest hot paths.')
+    parser.add_argument('names', nargs='*', help=f"Benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--count', type=int, default=20000, help='Inputs per benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per benchmark; the best is reported')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='Older copy of test.py to compare against, e.g. from git show <rev>:src/test.py')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    baseline = load_module(args.baseline) if args.baseline else None
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name](args.count, args.repeat, baseline)
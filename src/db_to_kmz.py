@@ -2,11 +2,11 @@ import zipfile
 import os
 from lxml import etree
 import pyodbc
-import ast
 import logging
 import shutil
 import random
 import re
+import time
 from datetime import datetime
 from PIL import Image  # Import Pillow for image processing
 import io  # For in-memory file handling
@@ -15,18 +15,22 @@ import math
 import matplotlib.pyplot as plt  # For visualization
 import matplotlib.cm as cm
 import matplotlib.colors as mcolors
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 import argparse
-
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,  # Set to DEBUG for detailed logs
-    format='%(asctime)s %(levelname)s:%(message)s',
-    handlers=[
-        logging.FileHandler("reconstruction.log"),
-        logging.StreamHandler()
-    ]
-)
+import hashlib
+import heapq
+import itertools
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from spatial_index import SPATIAL_INDEX_BACKENDS, build_segment_index, meters_per_degree
+from image_cache import ImageCache
+from fragment_cache import FragmentCache
+from diagnostics import FEATURE_TRACE, LazyXml, add_logging_arguments, configure_logging
+from kml_common import SPATIAL_COLUMNS, FolderResolver, decode_json_column, parse_folder_path, parse_kml_coordinates
+
+# Logging is configured in main() (--log-level, --trace-every); records also go to this file
+LOG_FILE = "reconstruction.log"
 
 # Database connection parameters
 server_name = 'sql_server,1433'
@@ -37,20 +41,41 @@ password = 'YourStrong!Password'
 proximity_threshold = 10  # meters
 angle_threshold = 3       # degrees
 GRID_SIZE_DEGREES = 0.001
+KMZ_COMPRESSION_LEVEL = 6  # zlib level 0-9 for deflated KMZ entries
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.svg')
+IMAGE_PREFETCH_PER_WORKER = 2  # images compressed ahead of the zip writer, per worker
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+IMAGE_PASSTHROUGH_MAX_BYTES = 512 * 1024  # images within max_size and this size are packed unchanged
+PASSTHROUGH_IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF')
+# Members whose bytes are already entropy-coded; deflating them again costs CPU for ~0 gain.
+PRECOMPRESSED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.kmz', '.zip', '.gz', '.mp3', '.mp4')
+# Part of every folder watermark; bump it when build_*_element output changes so cached fragments are re-rendered
+FRAGMENT_FORMAT_VERSION = 2
+# Incremental exports with more changed folders than this read whole tables instead of filtering by folder
+MAX_FILTERED_DIRTY_FOLDERS = 500
 
 class Placemark:
+    """
+    Line geometry of a placemark row. All LineString points are packed into one contiguous
+    float64 array of (lat, lon, alt) rows; line_offsets[i]:line_offsets[i + 1] delimits the
+    i-th LineString.
+    """
+    __slots__ = ('name', 'description', 'geometry_type', 'coords', 'line_offsets')
+
     def __init__(self, row):
         self.name = row['name']
         self.description = row['description']
         self.geometry_type = row['geometry_type']
-        self.line_strings = []  # List to store LineStrings
+        self.coords = np.empty((0, 3), dtype=np.float64)
+        self.line_offsets = np.zeros(1, dtype=np.intp)
         self.parse_geometry(row)
 
     def parse_geometry(self, row):
+        line_strings = []
         if self.geometry_type == 'LineString':
             coords = self.parse_coordinates(row['coordinates'])
-            if coords:
-                self.line_strings.append(coords)
+            if len(coords):
+                line_strings.append(coords)
         elif self.geometry_type == 'MultiGeometry':
             geometry_xml_str = row['geometry_xml']
             if geometry_xml_str:
@@ -61,34 +86,42 @@ class Placemark:
                         coord_elem = line_string_elem.find("{http://www.opengis.net/kml/2.2}coordinates")
                         if coord_elem is not None and coord_elem.text:
                             coords = self.parse_coordinates(coord_elem.text)
-                            if coords:
-                                self.line_strings.append(coords)
+                            if len(coords):
+                                line_strings.append(coords)
                 except etree.XMLSyntaxError as e:
                     logging.error(f"XML parsing error for Placemark '{self.name}': {e}")
 
+        if line_strings:
+            self.coords = np.ascontiguousarray(np.concatenate(line_strings))
+            self.line_offsets = np.concatenate(([0], np.cumsum([len(c) for c in line_strings]))).astype(np.intp)
+
     def parse_coordinates(self, coord_str):
-        coords = []
-        if coord_str:
-            for coord in coord_str.strip().split():
-                parts = coord.strip().split(',')
-                if len(parts) >= 2:
-                    try:
-                        lon = float(parts[0])
-                        lat = float(parts[1])
-                        alt = float(parts[2]) if len(parts) > 2 else 0.0
-                        coords.append((lat, lon, alt))
-                    except ValueError as e:
-                        logging.warning(f"Invalid coordinate format in Placemark '{self.name}': {coord} - {e}")
-        return coords
+        """
+        Parses a KML coordinates string into an (N, 3) array of (lat, lon, alt). Invalid tuples
+        are logged and skipped.
+        """
+        return parse_kml_coordinates(coord_str, on_invalid=self.warn_invalid_coordinate)
+
+    def warn_invalid_coordinate(self, coord, error):
+        logging.warning(f"Invalid coordinate format in Placemark '{self.name}': {coord} - {error}")
+
+    @property
+    def line_strings(self):
+        return [self.coords[self.line_offsets[i]:self.line_offsets[i + 1]]
+                for i in range(len(self.line_offsets) - 1)]
 
     def get_line_segments(self):
-        segments = []
-        for coords in self.line_strings:
-            for i in range(len(coords) - 1):
-                lat1, lon1, alt1 = coords[i]
-                lat2, lon2, alt2 = coords[i + 1]
-                segments.append(((lat1, lon1, alt1), (lat2, lon2, alt2)))
-        return segments
+        """
+        Returns an (M, 2, 3) array of segments. Each LineString contributes a strided
+        view over the packed coordinates; only multi-line placemarks need a concatenation.
+        """
+        segments = [sliding_window_view(coords, (2, 3)).reshape(-1, 2, 3)
+                    for coords in self.line_strings if len(coords) >= 2]
+        if not segments:
+            return np.empty((0, 2, 3), dtype=np.float64)
+        if len(segments) == 1:
+            return segments[0]
+        return np.concatenate(segments)
 
 def calculate_3d_distance(coord1, coord2):
     lat1, lon1, alt1 = coord1
@@ -111,6 +144,30 @@ def calculate_bearing(coord1, coord2):
     bearing = (math.degrees(initial_bearing) + 360) % 360
     return bearing
 
+def calculate_bearings(starts, ends):
+    """
+    Vectorized calculate_bearing for arrays of (lat, lon, ...) start and end points.
+    """
+    lat1, lon1 = np.radians(starts[:, 0]), np.radians(starts[:, 1])
+    lat2, lon2 = np.radians(ends[:, 0]), np.radians(ends[:, 1])
+    d_lon = lon2 - lon1
+
+    x = np.sin(d_lon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(d_lon)
+
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+def planar_distances(points1, points2):
+    """
+    Approximate 3D distances in meters between (lat, lon, alt) arrays, using WGS-84 meters per
+    degree at the mean latitude. Within a few centimeters of calculate_3d_distance at ROW scale.
+    """
+    m_per_deg_lat, m_per_deg_lon = meters_per_degree((points1[..., 0] + points2[..., 0]) / 2)
+    dy = (points2[..., 0] - points1[..., 0]) * m_per_deg_lat
+    dx = (points2[..., 1] - points1[..., 1]) * m_per_deg_lon
+    dz = points2[..., 2] - points1[..., 2]
+    return np.sqrt(dx * dx + dy * dy + dz * dz)
+
 def get_connection():
     conn_str = (
         f"DRIVER={{ODBC Driver 18 for SQL Server}};"
@@ -159,7 +216,17 @@ def ensure_tables_exist(conn):
             cable NVARCHAR(MAX),
             voltage NVARCHAR(MAX),
             date_acq NVARCHAR(MAX),
-            line_length FLOAT
+            line_length FLOAT,
+            geog GEOGRAPHY,
+            min_lat FLOAT,
+            max_lat FLOAT,
+            min_lon FLOAT,
+            max_lon FLOAT,
+            data_format INT,
+            content_hash CHAR(64),
+            source_file NVARCHAR(260),
+            deleted_at DATETIME2,
+            row_version ROWVERSION
         )
     END
     ''')
@@ -191,7 +258,12 @@ def ensure_tables_exist(conn):
             tilt FLOAT,
             [range] FLOAT,
             altitude_mode NVARCHAR(100),
-            date_acq NVARCHAR(MAX)
+            date_acq NVARCHAR(MAX),
+            data_format INT,
+            content_hash CHAR(64),
+            source_file NVARCHAR(260),
+            deleted_at DATETIME2,
+            row_version ROWVERSION
         )
     END
     ''')
@@ -217,7 +289,12 @@ def ensure_tables_exist(conn):
             folder_hierarchy NVARCHAR(MAX),
             attributes NVARCHAR(MAX),
             extended_data NVARCHAR(MAX),
-            date_acq NVARCHAR(MAX)
+            date_acq NVARCHAR(MAX),
+            data_format INT,
+            content_hash CHAR(64),
+            source_file NVARCHAR(260),
+            deleted_at DATETIME2,
+            row_version ROWVERSION
         )
     END
     ''')
@@ -234,30 +311,206 @@ def ensure_tables_exist(conn):
     END
     ''')
 
+    # Tables created before incremental export lack the row_version its watermarks are built from
+    for table in FEATURE_TABLES:
+        if 'row_version' not in get_table_columns(conn, table):
+            cursor.execute(f"ALTER TABLE {table} ADD row_version ROWVERSION")
+    # Spatial filters need the placemark geometry columns filled by test.py
+    placemark_columns = get_table_columns(conn, 'placemarks')
+    for column_name, column_type in SPATIAL_COLUMNS.items():
+        if column_name not in placemark_columns:
+            cursor.execute(f"ALTER TABLE placemarks ADD {column_name} {column_type}")
+
     conn.commit()
 
-def fetch_table(conn, table_name):
+# Columns read by reconstruct_kml for each table
+PLACEMARK_COLUMNS = (
+    'name', 'description', 'coordinates', 'longitude', 'latitude', 'altitude', 'heading', 'tilt', 'range',
+    'altitude_mode', 'poly_color', 'poly_opacity', 'icon_href', 'icon_scale', 'icon_color', 'label_color',
+    'label_scale', 'extended_data', 'folder_hierarchy', 'attributes', 'geometry_type', 'geometry_xml',
+    'line_length', 'date_acq', 'voltage', 'cable', 'data_format'
+)
+GROUNDOVERLAY_COLUMNS = (
+    'name', 'icon_href', 'view_bound_scale', 'coordinates', 'north', 'south', 'east', 'west', 'rotation',
+    'longitude', 'latitude', 'altitude', 'heading', 'tilt', 'range', 'altitude_mode', 'date_acq',
+    'extended_data', 'folder_hierarchy', 'data_format'
+)
+NETWORKLINK_COLUMNS = (
+    'name', 'visibility', 'longitude', 'latitude', 'altitude', 'heading', 'tilt', 'range', 'altitude_mode',
+    'date_acq', 'href', 'viewRefreshMode', 'viewRefreshTime', 'extended_data', 'folder_hierarchy', 'data_format'
+)
+FETCH_CHUNK_SIZE = 1000
+FEATURE_TABLES = ('placemarks', 'groundoverlays', 'networklinks')
+
+class TableRow:
+    """
+    Read-only dict-style view over a pyodbc Row. All rows of a query share one
+    column -> index map, so no per-row dict is built.
+    """
+    __slots__ = ('columns', 'values')
+
+    def __init__(self, columns, values):
+        self.columns = columns
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[self.columns[key]]
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def get(self, key, default=None):
+        index = self.columns.get(key)
+        return default if index is None else self.values[index]
+
+    def keys(self):
+        return self.columns.keys()
+
+def get_table_columns(conn, table_name):
+    cursor = conn.cursor()
+    cursor.execute("SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = ?", (table_name,))
+    columns = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    return columns
+
+def fetch_table(conn, table_name, columns=None, chunk_size=FETCH_CHUNK_SIZE, order_by=None, where=None, params=()):
+    """
+    Runs the SELECT for table_name and returns a generator of TableRow objects read in
+    fetchmany chunks. columns limits the projection; requested columns missing from the
+    table are left out, so membership tests on the rows behave as with SELECT *.
+    Rows tombstoned by incremental ingest (deleted_at set) are skipped.
+    where is an optional extra condition with ? placeholders bound to params;
+    order_by is an optional ORDER BY expression.
+    The query runs immediately, so database errors are raised here rather than on iteration.
+    """
+    cursor = conn.cursor()
+    existing = get_table_columns(conn, table_name)
+    if columns:
+        selected = [column for column in columns if column in existing]
+        query = f"SELECT {', '.join(f'[{column}]' for column in selected)} FROM {table_name}"
+    else:
+        query = f"SELECT * FROM {table_name}"
+    conditions = ["deleted_at IS NULL"] if 'deleted_at' in existing else []
+    if where:
+        conditions.append(f"({where})")
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if order_by:
+        query += f" ORDER BY {order_by}"
+    cursor.execute(query, params)
+    column_index = {desc[0]: index for index, desc in enumerate(cursor.description)}
+
+    def iter_rows():
+        try:
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for r in rows:
+                    yield TableRow(column_index, r)
+        finally:
+            cursor.close()
+
+    return iter_rows()
+
+def fetch_placemarks(conn, order_by=None, where=None, params=()):
+    return fetch_table(conn, "placemarks", PLACEMARK_COLUMNS, order_by=order_by, where=where, params=params)
+
+def fetch_groundoverlays(conn, order_by=None, where=None, params=()):
+    return fetch_table(conn, "groundoverlays", GROUNDOVERLAY_COLUMNS, order_by=order_by, where=where, params=params)
+
+def fetch_networklinks(conn, order_by=None, where=None, params=()):
+    return fetch_table(conn, "networklinks", NETWORKLINK_COLUMNS, order_by=order_by, where=where, params=params)
+
+def fetch_folder_watermarks(conn, row_filters=None):
+    """
+    Returns {folder_path: watermark} for every folder with live features, where folder_path
+    is the stored folder_hierarchy ('' for features at the Document root). A watermark holds,
+    per table, the folder's live row count and its highest row_version. SQL Server bumps
+    row_version on every insert and update (tombstones and revivals included), so any change
+    to a folder's rows changes its watermark, and rows deleted outright change the count.
+    This is one grouped scan of three narrow columns per table. Paths are grouped exactly, as
+    Python compares them: the column's collation would merge folders differing only in case,
+    so the grouping is binary, and DATALENGTH keeps paths differing in trailing spaces apart.
+    row_filters (see spatial_filters) restrict the scan to the exported rows; they are also
+    part of every watermark, so changing the region re-renders every folder.
+    """
+    row_filters = row_filters or {}
+    prefix = f"{FRAGMENT_FORMAT_VERSION}:"
+    if row_filters:
+        prefix += hashlib.sha256(repr(sorted(row_filters.items())).encode('utf-8')).hexdigest()[:16] + ':'
+    folders = defaultdict(dict)
     cursor = conn.cursor()
-    cursor.execute(f"SELECT * FROM {table_name}")
-    rows = cursor.fetchall()
-    # Convert rows to list of dicts
-    columns = [desc[0] for desc in cursor.description]
-    result = []
-    for r in rows:
-        row_dict = {}
-        for col_index, col_name in enumerate(columns):
-            row_dict[col_name] = r[col_index]
-        result.append(row_dict)
-    return result
-
-def fetch_placemarks(conn):
-    return fetch_table(conn, "placemarks")
-
-def fetch_groundoverlays(conn):
-    return fetch_table(conn, "groundoverlays")
-
-def fetch_networklinks(conn):
-    return fetch_table(conn, "networklinks")
+    for table in FEATURE_TABLES:
+        live_rows = "COUNT(*) - COUNT(deleted_at)" if 'deleted_at' in get_table_columns(conn, table) else "COUNT(*)"
+        where, params = row_filters.get(table, (None, ()))
+        cursor.execute(f"SELECT folder_hierarchy COLLATE Latin1_General_BIN2, {live_rows}, MAX(row_version) "
+                       f"FROM {table}{f' WHERE {where}' if where else ''} "
+                       f"GROUP BY folder_hierarchy COLLATE Latin1_General_BIN2, DATALENGTH(folder_hierarchy)", params)
+        for folder_hierarchy, count, row_version in cursor.fetchall():
+            # NULL and '' both mean the Document root
+            previous_count, previous_version = folders[folder_hierarchy or ''].get(table, (0, b''))
+            folders[folder_hierarchy or ''][table] = (previous_count + count,
+                                                       max(previous_version, bytes(row_version or b'')))
+    cursor.close()
+    return {
+        folder_path: prefix + ';'.join(
+            f"{table}={count}@{row_version.hex()}" for table, (count, row_version) in sorted(tables.items()))
+        for folder_path, tables in folders.items()
+        if any(count for count, _ in tables.values())
+    }
+
+def folder_filter(folder_paths):
+    """
+    Returns (where, params) for fetch_table restricting rows to the given folder paths.
+    """
+    paths = sorted(path for path in folder_paths if path)
+    clauses = [f"folder_hierarchy IN ({', '.join('?' * len(paths))})"] if paths else []
+    if '' in folder_paths:
+        clauses.append("folder_hierarchy IS NULL OR folder_hierarchy = ''")
+    return ' OR '.join(clauses) or "1 = 0", paths
+
+def spatial_filters(bbox=None, within_km=None):
+    """
+    Returns {table: (where, params)} that push a regional export's spatial predicate down to
+    SQL, or {} when neither filter is given. Both filters may be combined.
+    bbox is (west, south, east, north) in degrees: placemarks whose bounding box (min/max
+    lat/lon columns, see IX_placemarks_bounds) overlaps it are kept.
+    within_km is (lat, lon, km): placemarks whose geog lies within km of the point are kept;
+    STDistance against a constant is answered by the spatial index SIX_placemarks_geog.
+    Ground overlays (LatLonBox) and network links (LookAt point) have no geography column and
+    are matched against the boxes instead, the circle's box for within_km. Features without a
+    stored location are left out, so run test.py --backfill-spatial on older databases first.
+    """
+    conditions = defaultdict(list)
+    boxes = []
+    if bbox:
+        west, south, east, north = bbox
+        conditions['placemarks'].append(("max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?",
+                                         (south, north, west, east)))
+        boxes.append(bbox)
+    if within_km:
+        lat, lon, km = within_km
+        conditions['placemarks'].append(("geog.STDistance(geography::Point(?, ?, 4326)) <= ?", (lat, lon, km * 1000)))
+        m_per_deg_lat, m_per_deg_lon = (float(m) for m in meters_per_degree(lat))
+        lat_span = km * 1000 / m_per_deg_lat
+        lon_span = km * 1000 / m_per_deg_lon if m_per_deg_lon > 1 else 180
+        boxes.append((lon - lon_span, lat - lat_span, lon + lon_span, lat + lat_span))
+    for west, south, east, north in boxes:
+        conditions['groundoverlays'].append(("north >= ? AND south <= ? AND east >= ? AND west <= ?",
+                                             (south, north, west, east)))
+        conditions['networklinks'].append(("latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?",
+                                           (south, north, west, east)))
+    return {table: combine_filters(*table_conditions) for table, table_conditions in conditions.items()}
+
+def combine_filters(*filters):
+    """
+    ANDs (where, params) pairs for fetch_table; pairs with an empty where are skipped.
+    """
+    filters = [(where, params) for where, params in filters if where]
+    if not filters:
+        return None, ()
+    return ' AND '.join(f"({where})" for where, _ in filters), tuple(param for _, params in filters for param in params)
 
 def is_valid_number(value):
     try:
@@ -266,11 +519,11 @@ def is_valid_number(value):
     except (TypeError, ValueError):
         return False
 
-def add_extended_data(element, extended_data_str, nsmap):
+def add_extended_data(element, extended_data_str, nsmap, data_format=None):
     if not extended_data_str:
         return
     try:
-        extended_data_dict = ast.literal_eval(extended_data_str)
+        extended_data_dict = decode_json_column(extended_data_str, data_format)
         if isinstance(extended_data_dict, dict) and extended_data_dict:
             extended_data = etree.SubElement(element, "{%s}ExtendedData" % nsmap['kml'])
             for key, value in extended_data_dict.items():
@@ -282,48 +535,15 @@ def add_extended_data(element, extended_data_str, nsmap):
     except (ValueError, SyntaxError) as e:
         logging.warning(f"Invalid extended_data format: {extended_data_str}. Error: {e}")
 
-def get_folder_element(folder_path, parent_elem, folder_dict, nsmap):
-    if not folder_path:
-        return parent_elem
-
-    folders = folder_path.strip().split(' > ')
-    current_path = ''
-    current_elem = parent_elem
+# Streaming exports order rows by folder path with the ' > ' separator replaced by U+0001, which
+# sorts below every other character, so each folder is directly followed by its descendants:
+# "Lines", "Lines > Sub", "Lines 2023". Every key also ends in U+0001: SQL Server pads the shorter
+# string with spaces when comparing, which would otherwise sort "Lines" after "Lines > Sub" and
+# tie "Lines" with "Lines ". FOLDER_ORDER_SQL and folder_sort_key give the same order.
+FOLDER_ORDER_SQL = "(REPLACE(folder_hierarchy, ' > ', NCHAR(1)) + NCHAR(1)) COLLATE Latin1_General_BIN2"
 
-    for folder_name in folders:
-        folder_name = folder_name.strip()
-        try:
-            folder_data = ast.literal_eval(folder_name)
-            if isinstance(folder_data, dict):
-                if 'featureType' in folder_data:
-                    folder_name = folder_data['featureType']
-                elif 'name' in folder_data:
-                    folder_name = folder_data['name']
-                else:
-                    folder_name = ', '.join(f'{k}: {v}' for k, v in folder_data.items())
-            else:
-                folder_name = str(folder_data)
-        except (ValueError, SyntaxError):
-            pass
-
-        if current_path:
-            current_path += '/' + folder_name
-        else:
-            current_path = folder_name
-
-        if current_path in folder_dict:
-            current_elem = folder_dict[current_path]
-        else:
-            if '.kmz' in folder_name.lower():
-                folder_elem = etree.SubElement(current_elem, "{%s}Document" % nsmap['kml'])
-            else:
-                folder_elem = etree.SubElement(current_elem, "{%s}Folder" % nsmap['kml'])
-            name_elem = etree.SubElement(folder_elem, "{%s}name" % nsmap['kml'])
-            name_elem.text = folder_name
-            folder_dict[current_path] = folder_elem
-            current_elem = folder_elem
-
-    return current_elem
+def folder_sort_key(folder_hierarchy):
+    return (folder_hierarchy or '').replace(' > ', '\x01') + '\x01'
 
 def map_voltage_to_color(voltage):
     try:
@@ -346,12 +566,27 @@ def map_voltage_to_color(voltage):
     color = f"ff{blue:02x}{green:02x}{red:02x}"
     return color
 
-def compress_image(image_path, max_size=(1024, 1024), quality=85):
+def compress_image(image_path, max_size=(1024, 1024), quality=85, cache=None):
+    """
+    Returns (compressed_bytes, format), or (None, None) on failure. With an ImageCache the
+    result is looked up by source hash and settings first and stored after compressing.
+    """
+    cache_key = None
+    if cache is not None:
+        try:
+            cache_key = cache.key(image_path, (tuple(max_size), quality, Image.__version__))
+        except OSError as e:
+            logging.error(f"Failed to hash image {image_path}: {e}")
+        else:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logging.debug("Image cache hit for %s", image_path)
+                return cached
     try:
         with Image.open(image_path) as img:
             original_format = img.format
             original_size = os.path.getsize(image_path)
-            logging.debug(f"Original image size: {original_size} bytes for {image_path}")
+            logging.debug("Original image size: %d bytes for %s", original_size, image_path)
             img.thumbnail(max_size, Image.LANCZOS)
             img_byte_arr = io.BytesIO()
             if original_format == 'JPEG':
@@ -364,7 +599,9 @@ def compress_image(image_path, max_size=(1024, 1024), quality=85):
                 original_format = 'JPEG'
             compressed_data = img_byte_arr.getvalue()
             compressed_size = len(compressed_data)
-            logging.debug(f"Compressed image size: {compressed_size} bytes for {image_path}")
+            logging.debug("Compressed image size: %d bytes for %s", compressed_size, image_path)
+            if cache_key is not None:
+                cache.put(cache_key, compressed_data, original_format)
             return compressed_data, original_format
     except Exception as e:
         logging.error(f"Failed to compress image {image_path}: {e}")
@@ -403,55 +640,216 @@ def build_spatial_index_with_names(placemark_objects, grid_size=GRID_SIZE_DEGREE
                     grid_index[(lat_cell, lon_cell)].append((seg, placemark.name))
     return grid_index
 
-def find_identified_pairs(grid_index, proximity_threshold=10, angle_threshold=3):
-    identified_pairs = set()
-    processed_pairs = set()
-
-    for cell, segments in grid_index.items():
-        neighboring_cells = get_neighboring_cells(cell)
-        for neighbor in neighboring_cells:
-            if neighbor not in grid_index:
+def build_segment_table(grid_index):
+    """
+    Assigns an id to every distinct (name, segment) in the grid index.
+    Returns the names, an (M, 2, 3) segment array and a dict of cell -> array of segment ids.
+    """
+    segment_ids = {}
+    names = []
+    segments = []
+    cell_ids = {}
+    for cell, cell_segments in grid_index.items():
+        ids = []
+        for seg, name in cell_segments:
+            key = (name, seg.tobytes())
+            seg_id = segment_ids.get(key)
+            if seg_id is None:
+                seg_id = len(names)
+                segment_ids[key] = seg_id
+                names.append(name)
+                segments.append(seg)
+            ids.append(seg_id)
+        cell_ids[cell] = np.array(ids, dtype=np.intp)
+    segment_array = np.array(segments, dtype=np.float64).reshape(-1, 2, 3)
+    return names, segment_array, cell_ids
+
+def segment_table_from_placemarks(placemark_objects):
+    """
+    Returns the names and (M, 2, 3) segment array of every distinct (name, segment).
+    """
+    seen = set()
+    names = []
+    segments = []
+    for placemark in placemark_objects:
+        for seg in placemark.get_line_segments():
+            key = (placemark.name, seg.tobytes())
+            if key in seen:
+                continue
+            seen.add(key)
+            names.append(placemark.name)
+            segments.append(seg)
+    return names, np.array(segments, dtype=np.float64).reshape(-1, 2, 3)
+
+def evaluate_segment_pair(names, segments, midpoints, id1, id2, proximity_threshold, angle_threshold):
+    """
+    Exact ROW check for one candidate pair. Returns the identified pair tuple or None.
+    """
+    mid1 = tuple(midpoints[id1].tolist())
+    mid2 = tuple(midpoints[id2].tolist())
+    distance = calculate_3d_distance(mid1, mid2)
+    if distance > proximity_threshold:
+        return None
+
+    seg1 = segments[id1].tolist()
+    seg2 = segments[id2].tolist()
+    bearing1 = calculate_bearing(seg1[0], seg1[1])
+    bearing2 = calculate_bearing(seg2[0], seg2[1])
+    angle_diff = abs(bearing1 - bearing2)
+    angle_diff = min(angle_diff, 360 - angle_diff)
+
+    if angle_diff > angle_threshold:
+        return None
+
+    seg1_tuple = (tuple(seg1[0]), tuple(seg1[1]))
+    seg2_tuple = (tuple(seg2[0]), tuple(seg2[1]))
+    return (names[id1], names[id2], seg1_tuple, seg2_tuple, distance, angle_diff)
+
+def scan_cell_pairs(cells, cell_ids, names, segments, proximity_threshold, angle_threshold):
+    """
+    Screens every cell in cells (a list of (order, cell)) against its neighboring cells.
+
+    Midpoints and bearings are computed once for all segments. Each cell/neighbor block is
+    screened as an array with a planar distance and bearing pre-filter (with a small safety
+    margin) before the exact geodesic and bearing check on the survivors.
+
+    Returns a dict mapping (min_id, max_id) to (rank, pair) for every pair that passed the
+    pre-filter, where rank = (order, neighbor_index, row, col) locates its first encounter
+    and pair is the identified pair tuple in that orientation, or None if it failed the check.
+    """
+    results = {}
+    if len(names) == 0:
+        return results
+
+    midpoints = (segments[:, 0, :] + segments[:, 1, :]) / 2
+    bearings = calculate_bearings(segments[:, 0, :], segments[:, 1, :])
+
+    distance_limit = proximity_threshold * 1.01 + 0.01
+    angle_limit = angle_threshold + 1e-6
+
+    for order, cell in cells:
+        ids1 = cell_ids[cell]
+        for neighbor_index, neighbor in enumerate(get_neighboring_cells(cell)):
+            ids2 = cell_ids.get(neighbor)
+            if ids2 is None:
                 continue
-            neighbor_segments = grid_index[neighbor]
-
-            for seg1, name1 in segments:
-                for seg2, name2 in neighbor_segments:
-                    if seg1 == seg2 and name1 == name2:
-                        continue
-                    pair_id = tuple(sorted([(name1, seg1), (name2, seg2)]))
-                    if pair_id in processed_pairs:
-                        continue
-                    processed_pairs.add(pair_id)
-
-                    mid1_lat = (seg1[0][0] + seg1[1][0]) / 2
-                    mid1_lon = (seg1[0][1] + seg1[1][1]) / 2
-                    mid1_alt = (seg1[0][2] + seg1[1][2]) / 2
-                    mid1 = (mid1_lat, mid1_lon, mid1_alt)
-
-                    mid2_lat = (seg2[0][0] + seg2[1][0]) / 2
-                    mid2_lon = (seg2[0][1] + seg2[1][1]) / 2
-                    mid2_alt = (seg2[0][2] + seg2[1][2]) / 2
-                    mid2 = (mid2_lat, mid2_lon, mid2_alt)
-
-                    distance = calculate_3d_distance(mid1, mid2)
-                    if distance > proximity_threshold:
-                        continue
 
-                    bearing1 = calculate_bearing(seg1[0], seg1[1])
-                    bearing2 = calculate_bearing(seg2[0], seg2[1])
-                    angle_diff = abs(bearing1 - bearing2)
-                    angle_diff = min(angle_diff, 360 - angle_diff)
+            angle_diff = np.abs(bearings[ids1][:, None] - bearings[ids2][None, :])
+            angle_diff = np.minimum(angle_diff, 360 - angle_diff)
+            candidates = (angle_diff <= angle_limit) & (ids1[:, None] != ids2[None, :])
+            rows, cols = np.nonzero(candidates)
+            if len(rows) == 0:
+                continue
 
-                    if angle_diff > angle_threshold:
-                        continue
+            distances = planar_distances(midpoints[ids1[rows]], midpoints[ids2[cols]])
+            close = distances <= distance_limit
+            rows, cols = rows[close], cols[close]
+            for row, col, id1, id2 in zip(rows.tolist(), cols.tolist(), ids1[rows].tolist(), ids2[cols].tolist()):
+                pair_key = (id1, id2) if id1 < id2 else (id2, id1)
+                if pair_key in results:
+                    continue
 
-                    seg1_tuple = (tuple(seg1[0]), tuple(seg1[1]))
-                    seg2_tuple = (tuple(seg2[0]), tuple(seg2[1]))
-                    identified_pairs.add((name1, name2, seg1_tuple, seg2_tuple, distance, angle_diff))
+                pair = evaluate_segment_pair(names, segments, midpoints, id1, id2,
+                                             proximity_threshold, angle_threshold)
+                results[pair_key] = ((order, neighbor_index, row, col), pair)
 
-    return identified_pairs
+    return results
 
-def plot_grids_and_lines(grid_index, identified_pairs, output_plot='outputs/grid_plot.pdf'):
+def find_identified_pairs(grid_index, proximity_threshold=10, angle_threshold=3):
+    """
+    Finds segment pairs from neighboring grid cells whose midpoints are within
+    proximity_threshold meters and whose bearings differ by at most angle_threshold degrees.
+    Pairs are reported in the orientation they are first encountered, as in a cell-by-cell
+    nested loop.
+    """
+    names, segments, cell_ids = build_segment_table(grid_index)
+    results = scan_cell_pairs(list(enumerate(cell_ids)), cell_ids, names, segments,
+                              proximity_threshold, angle_threshold)
+    return {pair for _, pair in results.values() if pair is not None}
+
+def scan_tile(task):
+    """
+    ProcessPoolExecutor worker: runs scan_cell_pairs on one tile of owned cells plus its halo.
+    Segment ids in the task are local; results are returned keyed by global segment id.
+    """
+    cells, cell_ids, names, segments, global_ids, proximity_threshold, angle_threshold = task
+    results = scan_cell_pairs(cells, cell_ids, names, segments, proximity_threshold, angle_threshold)
+    # global_ids is sorted, so local id order (and hence min/max) is preserved
+    return [((int(global_ids[id1]), int(global_ids[id2])), rank, pair) for (id1, id2), (rank, pair) in results.items()]
+
+def find_identified_pairs_parallel(grid_index, workers, proximity_threshold=10, angle_threshold=3, tile_cells=32):
+    """
+    Parallel find_identified_pairs. Grid cells are grouped into square tiles of tile_cells x
+    tile_cells cells; each tile is shipped with its one-cell halo to a worker process. Pairs
+    seen by more than one tile are merged by keeping their earliest encounter, so the result
+    matches the serial run exactly.
+    """
+    names, segments, cell_ids = build_segment_table(grid_index)
+    if len(names) == 0:
+        return set()
+
+    tiles = defaultdict(list)
+    for order, cell in enumerate(cell_ids):
+        tiles[(cell[0] // tile_cells, cell[1] // tile_cells)].append((order, cell))
+
+    tasks = []
+    for owned_cells in tiles.values():
+        halo_cells = {neighbor for _, cell in owned_cells for neighbor in get_neighboring_cells(cell)
+                      if neighbor in cell_ids}
+        global_ids = np.unique(np.concatenate([cell_ids[cell] for cell in halo_cells]))
+        local_cell_ids = {cell: np.searchsorted(global_ids, cell_ids[cell]) for cell in halo_cells}
+        tasks.append((owned_cells, local_cell_ids, [names[i] for i in global_ids], segments[global_ids],
+                      global_ids, proximity_threshold, angle_threshold))
+
+    merged = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for tile_results in executor.map(scan_tile, tasks):
+            for pair_key, rank, pair in tile_results:
+                current = merged.get(pair_key)
+                if current is None or rank < current[0]:
+                    merged[pair_key] = (rank, pair)
+
+    logging.info(f"Scanned {len(tasks)} tiles with {workers} workers")
+    return {pair for _, pair in merged.values() if pair is not None}
+
+def find_identified_pairs_indexed(placemark_objects, backend, proximity_threshold=10, angle_threshold=3):
+    """
+    Same ROW test as find_identified_pairs, but candidates come from a spatial index backend
+    ('kdtree' or 'rtree', see spatial_index.py) queried for segments within proximity_threshold
+    meters instead of from neighboring grid cells. Returns the pairs and the segment table.
+    """
+    identified_pairs = set()
+    names, segments = segment_table_from_placemarks(placemark_objects)
+    if len(names) == 0:
+        return identified_pairs, names, segments
+
+    midpoints = (segments[:, 0, :] + segments[:, 1, :]) / 2
+    bearings = calculate_bearings(segments[:, 0, :], segments[:, 1, :])
+
+    distance_limit = proximity_threshold * 1.01 + 0.01
+    candidates = build_segment_index(backend, segments).query_pairs(distance_limit)
+    if len(candidates) == 0:
+        return identified_pairs, names, segments
+    ids1, ids2 = candidates[:, 0], candidates[:, 1]
+
+    angle_diff = np.abs(bearings[ids1] - bearings[ids2])
+    angle_diff = np.minimum(angle_diff, 360 - angle_diff)
+    keep = (angle_diff <= angle_threshold + 1e-6) & \
+        (planar_distances(midpoints[ids1], midpoints[ids2]) <= distance_limit)
+
+    for id1, id2 in zip(ids1[keep].tolist(), ids2[keep].tolist()):
+        pair = evaluate_segment_pair(names, segments, midpoints, id1, id2,
+                                     proximity_threshold, angle_threshold)
+        if pair is not None:
+            identified_pairs.add(pair)
+
+    return identified_pairs, names, segments
+
+def plot_grids_and_lines(grid_index, identified_pairs, output_plot='outputs/grid_plot.pdf', segments=None):
+    """
+    Plots the grid cells, all segments and the identified pairs. Pass segments to draw
+    them directly when no grid index was built (grid_index may then be empty).
+    """
     plt.figure(figsize=(24, 24))
     ax = plt.gca()
 
@@ -466,11 +864,12 @@ def plot_grids_and_lines(grid_index, identified_pairs, output_plot='outputs/grid
                              linewidth=0.5, edgecolor='gray', facecolor='none')
         ax.add_patch(rect)
 
-    for segments in grid_index.values():
-        for seg, _ in segments:
-            latitudes = [seg[0][0], seg[1][0]]
-            longitudes = [seg[0][1], seg[1][1]]
-            plt.plot(longitudes, latitudes, color='blue', linewidth=0.5, alpha=0.5)
+    if segments is None:
+        segments = [seg for cell_segments in grid_index.values() for seg, _ in cell_segments]
+    for seg in segments:
+        latitudes = [seg[0][0], seg[1][0]]
+        longitudes = [seg[0][1], seg[1][1]]
+        plt.plot(longitudes, latitudes, color='blue', linewidth=0.5, alpha=0.5)
 
     num_pairs = len(identified_pairs)
     if num_pairs == 0:
@@ -492,49 +891,393 @@ def plot_grids_and_lines(grid_index, identified_pairs, output_plot='outputs/grid
     plt.close()
     logging.info(f"Grid and lines plot saved to {output_plot}")
 
-def get_conductor_width(conn, conductor_type, cable_field):
-    cursor = conn.cursor()
-    cursor.execute("SELECT width_mm FROM conductor_types WHERE type = ?", (conductor_type,))
-    result = cursor.fetchone()
-    if result and result[0] is not None:
-        return result[0]
-    else:
-        width = None
+UPSERT_CONDUCTOR_TYPE_SQL = '''
+MERGE conductor_types WITH (HOLDLOCK) AS target
+USING (SELECT ? AS type, ? AS width_mm) AS source
+ON target.type = source.type
+WHEN NOT MATCHED THEN
+    INSERT (type, width_mm) VALUES (source.type, source.width_mm);
+'''
+
+class ConductorWidthCache:
+    """
+    In-memory view of conductor_types for one export. The table is read once up front and
+    widths for new types are resolved in memory: parsed from the cable's 'NN mm²' text or,
+    failing that, assigned at random. Random assignments are queued and written by flush()
+    in one batched MERGE, so a run costs two round trips however many placemarks it has.
+    A type inserted concurrently by another process keeps that process's width.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.widths = {}
+        self.pending = {}
+        cursor = conn.cursor()
+        cursor.execute("SELECT type, width_mm FROM conductor_types")
+        for conductor_type, width in cursor.fetchall():
+            if width is not None:
+                self.widths[conductor_type] = width
+        logging.debug("Loaded %d conductor widths", len(self.widths))
+
+    def get_width(self, conductor_type, cable_field):
+        width = self.widths.get(conductor_type)
+        if width is not None:
+            return width
         if cable_field:
             match = re.search(r'(\d+)\s*mm²', cable_field)
             if match:
                 width = float(match.group(1))
         if width is None:
             width = random.uniform(1, 100)
-            try:
-                cursor.execute("INSERT INTO conductor_types (type, width_mm) VALUES (?, ?)", (conductor_type, width))
-                conn.commit()
-                logging.debug(f"Assigned random width {width:.2f} mm to conductor type '{conductor_type}'")
-            except pyodbc.IntegrityError:
-                cursor.execute("SELECT width_mm FROM conductor_types WHERE type = ?", (conductor_type,))
-                result = cursor.fetchone()
-                if result and result[0] is not None:
-                    width = result[0]
-        logging.debug(f"Width for conductor type '{conductor_type}': {width:.2f} mm")
+            self.pending[conductor_type] = width
+            logging.debug("Assigned random width %.2f mm to conductor type '%s'", width, conductor_type)
+        self.widths[conductor_type] = width
+        logging.debug("Width for conductor type '%s': %.2f mm", conductor_type, width)
         return width
 
+    def flush(self):
+        """
+        Upserts the queued random widths in a single batch and commits.
+        """
+        if not self.pending:
+            return
+        cursor = self.conn.cursor()
+        cursor.fast_executemany = True
+        try:
+            cursor.executemany(UPSERT_CONDUCTOR_TYPE_SQL, list(self.pending.items()))
+            self.conn.commit()
+            logging.info(f"Saved {len(self.pending)} new conductor types")
+            self.pending.clear()
+        except pyodbc.Error as e:
+            self.conn.rollback()
+            logging.error(f"Failed to save conductor types: {e}")
+
 def sanitize_icon_href_for_groundoverlays(icon_href):
     if not icon_href:
         return ''
     filename = os.path.basename(icon_href)
     return f"files/{filename}"
 
-def reconstruct_kml(db_path, output_kml, find_pairs=True):
+def report_identified_pairs(placemark_objects, spatial_index='grid', workers=1):
+    """
+    Finds lines sharing a right-of-way and writes outputs/lines_in_same_row.txt and the grid plot.
+    """
+    if spatial_index == 'grid':
+        grid_index = build_spatial_index_with_names(placemark_objects, GRID_SIZE_DEGREES)
+        if workers > 1:
+            identified_pairs = find_identified_pairs_parallel(grid_index, workers, proximity_threshold, angle_threshold)
+        else:
+            identified_pairs = find_identified_pairs(grid_index, proximity_threshold, angle_threshold)
+        plot_segments = None
+    else:
+        grid_index = {}
+        identified_pairs, _, plot_segments = find_identified_pairs_indexed(
+            placemark_objects, spatial_index, proximity_threshold, angle_threshold)
+    print("Total identified_pairs:", len(identified_pairs))
+    with open('outputs/lines_in_same_row.txt', 'w') as f:
+        for name1, name2, seg1, seg2, distance, angle_diff in identified_pairs:
+            f.write(f"{name1} and {name2} share the same ROW\n")
+            f.write(f"Segment from {name1}: {seg1}\n")
+            f.write(f"Segment from {name2}: {seg2}\n")
+            f.write(f"Distance between segments: {distance:.2f} meters\n")
+            f.write(f"Angle difference: {angle_diff:.2f} degrees\n\n")
+    plot_grids_and_lines(grid_index, identified_pairs, output_plot='outputs/grid_plot.pdf', segments=plot_segments)
+
+def build_placemark_element(row, nsmap, conductor_widths):
+    """
+    Builds a detached <Placemark> element for a placemarks row.
+    """
+    placemark_attributes = {}
+    if row['attributes']:
+        try:
+            placemark_attributes = decode_json_column(row['attributes'], row.get('data_format')) or {}
+        except:
+            pass
+    placemark_id = placemark_attributes.get('id')
+
+    if placemark_id:
+        placemark = etree.Element("{%s}Placemark" % nsmap['kml'], id=str(placemark_id))
+    else:
+        placemark = etree.Element("{%s}Placemark" % nsmap['kml'])
+
+    name_elem = etree.SubElement(placemark, "{%s}name" % nsmap['kml'])
+    name_elem.text = row['name'] if row['name'] else "Unnamed Placemark"
+
+    description_elem = etree.SubElement(placemark, "{%s}description" % nsmap['kml'])
+    base_description = row['description'] if row['description'] else ""
+    line_length = row['line_length'] if 'line_length' in row and row['line_length'] is not None else None
+
+    if line_length is not None:
+        line_length_str = f"<br/><b>Line Length:</b> {line_length} meters"
+        description_elem.text = base_description + line_length_str
+    else:
+        description_elem.text = base_description
+
+    geometry_type = row['geometry_type']
+    geometry_xml_str = row['geometry_xml']
+
+    if geometry_type == 'MultiGeometry' and geometry_xml_str:
+        try:
+            geometry_xml = etree.fromstring(geometry_xml_str.encode('utf-8'))
+            if not etree.QName(geometry_xml).namespace:
+                geometry_xml.tag = "{%s}%s" % (nsmap['kml'], etree.QName(geometry_xml).localname)
+            for elem in geometry_xml.iter():
+                if not etree.QName(elem).namespace:
+                    elem.tag = "{%s}%s" % (nsmap['kml'], etree.QName(elem).localname)
+            placemark.append(geometry_xml)
+        except etree.XMLSyntaxError as e:
+            logging.error(f"Invalid geometry_xml for Placemark '{row['name']}': {e}")
+    elif 'coordinates' in row and row['coordinates'] and row['coordinates'] != 'None':
+        coordinates = row['coordinates']
+        if geometry_type == 'Polygon':
+            polygon = etree.SubElement(placemark, "{%s}Polygon" % nsmap['kml'])
+            outer_boundary = etree.SubElement(polygon, "{%s}outerBoundaryIs" % nsmap['kml'])
+            linear_ring = etree.SubElement(outer_boundary, "{%s}LinearRing" % nsmap['kml'])
+            coord_elem = etree.SubElement(linear_ring, "{%s}coordinates" % nsmap['kml'])
+            coord_elem.text = coordinates
+        elif geometry_type == 'LineString':
+            linestring = etree.SubElement(placemark, "{%s}LineString" % nsmap['kml'])
+            coord_elem = etree.SubElement(linestring, "{%s}coordinates" % nsmap['kml'])
+            coord_elem.text = coordinates
+        else:
+            point = etree.SubElement(placemark, "{%s}Point" % nsmap['kml'])
+            coord_elem = etree.SubElement(point, "{%s}coordinates" % nsmap['kml'])
+            coord_elem.text = coordinates
+
+    if ('longitude' in row and 'latitude' in row and
+        is_valid_number(row['longitude']) and is_valid_number(row['latitude'])):
+        lookat = etree.SubElement(placemark, "{%s}LookAt" % nsmap['kml'])
+        etree.SubElement(lookat, "{%s}longitude" % nsmap['kml']).text = str(row['longitude'])
+        etree.SubElement(lookat, "{%s}latitude" % nsmap['kml']).text = str(row['latitude'])
+        etree.SubElement(lookat, "{%s}altitude" % nsmap['kml']).text = str(row['altitude']) if 'altitude' in row and row['altitude'] is not None else "0"
+        etree.SubElement(lookat, "{%s}heading" % nsmap['kml']).text = str(row['heading']) if 'heading' in row and row['heading'] is not None else "0"
+        etree.SubElement(lookat, "{%s}tilt" % nsmap['kml']).text = str(row['tilt']) if 'tilt' in row and row['tilt'] is not None else "0"
+        etree.SubElement(lookat, "{%s}range" % nsmap['kml']).text = str(row['range']) if 'range' in row and row['range'] is not None else "0"
+        if 'altitude_mode' in row and row['altitude_mode']:
+            altitude_mode_elem = etree.SubElement(lookat, "{%s}altitudeMode" % nsmap['kml'])
+            altitude_mode_elem.text = row['altitude_mode']
+
+    date_acq = row['date_acq'] if 'date_acq' in row else None
+    if date_acq:
+        try:
+            if '<begin>' in date_acq and '<end>' in date_acq:
+                begin_match = re.search(r'<begin>(.*?)</begin>', date_acq)
+                end_match = re.search(r'<end>(.*?)</end>', date_acq)
+                if begin_match and end_match:
+                    begin_time = begin_match.group(1)
+                    end_time = end_match.group(1)
+                    timespan = etree.SubElement(placemark, "{%s}TimeSpan" % nsmap['kml'])
+                    begin_elem = etree.SubElement(timespan, "{%s}begin" % nsmap['kml'])
+                    begin_elem.text = begin_time
+                    end_elem = etree.SubElement(timespan, "{%s}end" % nsmap['kml'])
+                    end_elem.text = end_time
+            else:
+                date_obj = None
+                for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+                    try:
+                        date_obj = datetime.strptime(date_acq, fmt)
+                        break
+                    except ValueError:
+                        continue
+                if date_obj:
+                    timestamp = etree.SubElement(placemark, "{%s}TimeStamp" % nsmap['kml'])
+                    when = etree.SubElement(timestamp, "{%s}when" % nsmap['kml'])
+                    when.text = date_obj.isoformat() + 'Z'
+                else:
+                    logging.warning(f"Failed to parse date_acq '{date_acq}' for Placemark '{row['name']}'")
+        except Exception as e:
+            logging.warning(f"Error processing date_acq '{date_acq}' for Placemark '{row['name']}': {e}")
+
+    style = etree.SubElement(placemark, "{%s}Style" % nsmap['kml'])
+    voltage = row['voltage'] if 'voltage' in row else None
+    color = map_voltage_to_color(voltage)
+    conductor_type = row['cable'] if 'cable' in row else None
+    width = None
+    if conductor_type:
+        width = conductor_widths.get_width(conductor_type, row['cable'])
+
+    linestyle = etree.SubElement(style, "{%s}LineStyle" % nsmap['kml'])
+    line_color = etree.SubElement(linestyle, "{%s}color" % nsmap['kml'])
+    line_color.text = color
+    line_width = etree.SubElement(linestyle, "{%s}width" % nsmap['kml'])
+    line_width.text = f"{width:.2f}" if width else "1"
+
+    if 'poly_color' in row or 'poly_opacity' in row:
+        polystyle = etree.SubElement(style, "{%s}PolyStyle" % nsmap['kml'])
+        if 'poly_color' in row and row['poly_color']:
+            poly_color = etree.SubElement(polystyle, "{%s}color" % nsmap['kml'])
+            poly_color.text = row['poly_color']
+        if 'poly_opacity' in row and row['poly_opacity']:
+            poly_opacity = etree.SubElement(polystyle, "{%s}opacity" % nsmap['kml'])
+            poly_opacity.text = str(row['poly_opacity'])
+
+    if 'icon_href' in row or 'icon_scale' in row or 'icon_color' in row:
+        iconstyle = etree.SubElement(style, "{%s}IconStyle" % nsmap['kml'])
+        if 'icon_scale' in row and row['icon_scale']:
+            icon_scale = etree.SubElement(iconstyle, "{%s}scale" % nsmap['kml'])
+            icon_scale.text = str(row['icon_scale'])
+        if 'icon_color' in row and row['icon_color']:
+            icon_color = etree.SubElement(iconstyle, "{%s}color" % nsmap['kml'])
+            icon_color.text = row['icon_color']
+        icon = etree.SubElement(iconstyle, "{%s}Icon" % nsmap['kml'])
+        href = etree.SubElement(icon, "{%s}href" % nsmap['kml'])
+        href.text = row['icon_href'] if 'icon_href' in row and row['icon_href'] else ""
+
+    if 'label_color' in row or 'label_scale' in row:
+        labelstyle = etree.SubElement(style, "{%s}LabelStyle" % nsmap['kml'])
+        if 'label_color' in row and row['label_color']:
+            label_color = etree.SubElement(labelstyle, "{%s}color" % nsmap['kml'])
+            label_color.text = row['label_color']
+        if 'label_scale' in row and row['label_scale']:
+            label_scale = etree.SubElement(labelstyle, "{%s}scale" % nsmap['kml'])
+            label_scale.text = str(row['label_scale'])
+
+    if 'extended_data' in row and row['extended_data']:
+        add_extended_data(placemark, row['extended_data'], nsmap, row.get('data_format'))
+
+    # Sampled per-feature tracing; the element is only serialised if this record is emitted
+    if FEATURE_TRACE.sample():
+        logging.debug("Built Placemark '%s':\n%s", row['name'], LazyXml(placemark, pretty_print=True))
+
+    return placemark
+
+def build_groundoverlay_element(row, nsmap):
+    """
+    Builds a detached <GroundOverlay> element for a groundoverlays row.
+    """
+    groundoverlay = etree.Element("{%s}GroundOverlay" % nsmap['kml'])
+    name_elem = etree.SubElement(groundoverlay, "{%s}name" % nsmap['kml'])
+    name_elem.text = row['name'] if row['name'] else "Unnamed GroundOverlay"
+
+    icon = etree.SubElement(groundoverlay, "{%s}Icon" % nsmap['kml'])
+    href = etree.SubElement(icon, "{%s}href" % nsmap['kml'])
+    new_icon_href = sanitize_icon_href_for_groundoverlays(row['icon_href']) if 'icon_href' in row else ""
+    href.text = new_icon_href
+
+    if 'view_bound_scale' in row and row['view_bound_scale'] is not None:
+        view_bound_scale_elem = etree.SubElement(icon, "{%s}viewBoundScale" % nsmap['kml'])
+        view_bound_scale_elem.text = str(row['view_bound_scale'])
+
+    if 'coordinates' in row and row['coordinates']:
+        latlonquad = etree.SubElement(groundoverlay, "{%s}LatLonQuad" % nsmap['gx'])
+        coord_elem = etree.SubElement(latlonquad, "{%s}coordinates" % nsmap['kml'])
+        coord_elem.text = row['coordinates']
+    else:
+        latlonbox = etree.SubElement(groundoverlay, "{%s}LatLonBox" % nsmap['kml'])
+        etree.SubElement(latlonbox, "{%s}north" % nsmap['kml']).text = str(row['north']) if row['north'] is not None else "0"
+        etree.SubElement(latlonbox, "{%s}south" % nsmap['kml']).text = str(row['south']) if row['south'] is not None else "0"
+        etree.SubElement(latlonbox, "{%s}east" % nsmap['kml']).text = str(row['east']) if row['east'] is not None else "0"
+        etree.SubElement(latlonbox, "{%s}west" % nsmap['kml']).text = str(row['west']) if row['west'] is not None else "0"
+        if 'rotation' in row and row['rotation'] is not None:
+            rotation_elem = etree.SubElement(latlonbox, "{%s}rotation" % nsmap['kml'])
+            rotation_elem.text = str(row['rotation'])
+
+    if ('longitude' in row and 'latitude' in row and
+        is_valid_number(row['longitude']) and is_valid_number(row['latitude'])):
+        lookat = etree.SubElement(groundoverlay, "{%s}LookAt" % nsmap['kml'])
+        etree.SubElement(lookat, "{%s}longitude" % nsmap['kml']).text = str(row['longitude'])
+        etree.SubElement(lookat, "{%s}latitude" % nsmap['kml']).text = str(row['latitude'])
+        etree.SubElement(lookat, "{%s}altitude" % nsmap['kml']).text = str(row['altitude']) if row['altitude'] is not None else "0"
+        etree.SubElement(lookat, "{%s}heading" % nsmap['kml']).text = str(row['heading']) if row['heading'] is not None else "0"
+        etree.SubElement(lookat, "{%s}tilt" % nsmap['kml']).text = str(row['tilt']) if row['tilt'] is not None else "0"
+        etree.SubElement(lookat, "{%s}range" % nsmap['kml']).text = str(row['range']) if row['range'] is not None else "0"
+        if 'altitude_mode' in row and row['altitude_mode']:
+            altitude_mode_elem = etree.SubElement(lookat, "{%s}altitudeMode" % nsmap['kml'])
+            altitude_mode_elem.text = row['altitude_mode']
+
+    date_acq = row['date_acq'] if 'date_acq' in row else None
+    if date_acq:
+        try:
+            date_obj = None
+            for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%d-%m-%Y"):
+                try:
+                    date_obj = datetime.strptime(date_acq, fmt)
+                    break
+                except ValueError:
+                    continue
+            if date_obj:
+                timestamp = etree.SubElement(groundoverlay, "{%s}TimeStamp" % nsmap['kml'])
+                when = etree.SubElement(timestamp, "{%s}when" % nsmap['kml'])
+                when.text = date_obj.isoformat()
+        except Exception as e:
+            logging.warning(f"Failed to parse date_acq '{date_acq}' for GroundOverlay '{row['name']}': {e}")
+
+    if 'extended_data' in row and row['extended_data']:
+        add_extended_data(groundoverlay, row['extended_data'], nsmap, row.get('data_format'))
+
+    return groundoverlay
+
+def build_networklink_element(row, nsmap):
+    """
+    Builds a detached <NetworkLink> element for a networklinks row.
+    """
+    networklink = etree.Element("{%s}NetworkLink" % nsmap['kml'])
+
+    name_elem = etree.SubElement(networklink, "{%s}name" % nsmap['kml'])
+    name_elem.text = row['name'] if row['name'] else "Unnamed NetworkLink"
+
+    visibility_elem = etree.SubElement(networklink, "{%s}visibility" % nsmap['kml'])
+    visibility_elem.text = str(row['visibility']) if 'visibility' in row and row['visibility'] is not None else "1"
+
+    if ('longitude' in row and 'latitude' in row and
+        is_valid_number(row['longitude']) and is_valid_number(row['latitude'])):
+        lookat = etree.SubElement(networklink, "{%s}LookAt" % nsmap['kml'])
+        etree.SubElement(lookat, "{%s}longitude" % nsmap['kml']).text = str(row['longitude'])
+        etree.SubElement(lookat, "{%s}latitude" % nsmap['kml']).text = str(row['latitude'])
+        etree.SubElement(lookat, "{%s}altitude" % nsmap['kml']).text = str(row['altitude']) if row['altitude'] is not None else "0"
+        etree.SubElement(lookat, "{%s}heading" % nsmap['kml']).text = str(row['heading']) if row['heading'] is not None else "0"
+        etree.SubElement(lookat, "{%s}tilt" % nsmap['kml']).text = str(row['tilt']) if row['tilt'] is not None else "0"
+        etree.SubElement(lookat, "{%s}range" % nsmap['kml']).text = str(row['range']) if row['range'] is not None else "0"
+        if 'altitude_mode' in row and row['altitude_mode']:
+            altitude_mode_elem = etree.SubElement(lookat, "{%s}altitudeMode" % nsmap['kml'])
+            altitude_mode_elem.text = row['altitude_mode']
+
+    date_acq = row['date_acq'] if 'date_acq' in row else None
+    if date_acq:
+        try:
+            date_obj = None
+            for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%d-%m-%Y"):
+                try:
+                    date_obj = datetime.strptime(date_acq, fmt)
+                    break
+                except ValueError:
+                    continue
+            if date_obj:
+                timestamp = etree.SubElement(networklink, "{%s}TimeStamp" % nsmap['kml'])
+                when = etree.SubElement(timestamp, "{%s}when" % nsmap['kml'])
+                when.text = date_obj.isoformat()
+        except Exception as e:
+            logging.warning(f"Failed to parse date_acq '{date_acq}' for NetworkLink '{row['name']}': {e}")
+
+    url = etree.SubElement(networklink, "{%s}Url" % nsmap['kml'])
+    href = etree.SubElement(url, "{%s}href" % nsmap['kml'])
+    href.text = row['href'] if 'href' in row and row['href'] else ""
+    view_refresh_mode = etree.SubElement(url, "{%s}viewRefreshMode" % nsmap['kml'])
+    view_refresh_mode.text = row['viewRefreshMode'] if 'viewRefreshMode' in row and row['viewRefreshMode'] else ""
+    view_refresh_time = etree.SubElement(url, "{%s}viewRefreshTime" % nsmap['kml'])
+    view_refresh_time.text = str(row['viewRefreshTime']) if 'viewRefreshTime' in row and row['viewRefreshTime'] is not None else "0"
+
+    if 'extended_data' in row and row['extended_data']:
+        add_extended_data(networklink, row['extended_data'], nsmap, row.get('data_format'))
+
+    return networklink
+
+def reconstruct_kml(db_path, output_kml, find_pairs=True, spatial_index='grid', workers=1, row_filters=None):
+    """
+    Builds the whole KML document in memory from the database. row_filters (see
+    spatial_filters) limit which rows are read.
+    """
     logging.info("Starting KML reconstruction...")
+    row_filters = row_filters or {}
 
     # Connect to SQL Server
     conn = get_connection()
     ensure_tables_exist(conn)
 
+    # Conductor widths are resolved in memory, so rows can be streamed over conn itself
+    conductor_widths = ConductorWidthCache(conn)
     try:
-        placemarks = fetch_placemarks(conn)
-        groundoverlays = fetch_groundoverlays(conn)
-        networklinks = fetch_networklinks(conn)
+        placemarks = fetch_placemarks(conn, None, *row_filters.get('placemarks', (None, ())))
     except pyodbc.Error as e:
         logging.error(f"Database fetch error: {e}")
         conn.close()
@@ -547,177 +1290,18 @@ def reconstruct_kml(db_path, output_kml, find_pairs=True):
 
     kml_root = etree.Element("{%s}kml" % nsmap['kml'], nsmap=nsmap)
     document = etree.SubElement(kml_root, "{%s}Document" % nsmap['kml'])
-    folder_dict = {}
-
-    # Ensure conductor_types table exists (already done in ensure_tables_exist)
+    folders = FolderResolver(document, nsmap)
 
+    placemark_objects = []
     for row in placemarks:
         if 'description' not in row or row['description'] is None:
             # Uncomment the next line if you want to skip placemarks without description
             # continue
             pass
 
-        folder_hierarchy = row['folder_hierarchy']
-        folder_elem = get_folder_element(folder_hierarchy, document, folder_dict, nsmap) if folder_hierarchy else document
-        placemark_attributes = {}
-        if row['attributes']:
-            try:
-                placemark_attributes = ast.literal_eval(row['attributes'])
-            except:
-                pass
-        placemark_id = placemark_attributes.get('id')
-
-        if placemark_id:
-            placemark = etree.SubElement(folder_elem, "{%s}Placemark" % nsmap['kml'], id=str(placemark_id))
-        else:
-            placemark = etree.SubElement(folder_elem, "{%s}Placemark" % nsmap['kml'])
-
-        name_elem = etree.SubElement(placemark, "{%s}name" % nsmap['kml'])
-        name_elem.text = row['name'] if row['name'] else "Unnamed Placemark"
-
-        description_elem = etree.SubElement(placemark, "{%s}description" % nsmap['kml'])
-        base_description = row['description'] if row['description'] else ""
-        line_length = row['line_length'] if 'line_length' in row and row['line_length'] is not None else None
+        folder_elem = folders.resolve(row['folder_hierarchy'])
+        folder_elem.append(build_placemark_element(row, nsmap, conductor_widths))
 
-        if line_length is not None:
-            line_length_str = f"<br/><b>Line Length:</b> {line_length} meters"
-            description_elem.text = base_description + line_length_str
-            logging.debug(f"Added line_length to description for Placemark '{row['name']}'")
-        else:
-            description_elem.text = base_description
-
-        geometry_type = row['geometry_type']
-        geometry_xml_str = row['geometry_xml']
-
-        if geometry_type == 'MultiGeometry' and geometry_xml_str:
-            try:
-                geometry_xml = etree.fromstring(geometry_xml_str.encode('utf-8'))
-                if not etree.QName(geometry_xml).namespace:
-                    geometry_xml.tag = "{%s}%s" % (nsmap['kml'], etree.QName(geometry_xml).localname)
-                for elem in geometry_xml.iter():
-                    if not etree.QName(elem).namespace:
-                        elem.tag = "{%s}%s" % (nsmap['kml'], etree.QName(elem).localname)
-                placemark.append(geometry_xml)
-                logging.debug(f"Appended MultiGeometry to Placemark '{row['name']}'")
-            except etree.XMLSyntaxError as e:
-                logging.error(f"Invalid geometry_xml for Placemark '{row['name']}': {e}")
-        elif 'coordinates' in row and row['coordinates'] and row['coordinates'] != 'None':
-            coordinates = row['coordinates']
-            if geometry_type == 'Polygon':
-                polygon = etree.SubElement(placemark, "{%s}Polygon" % nsmap['kml'])
-                outer_boundary = etree.SubElement(polygon, "{%s}outerBoundaryIs" % nsmap['kml'])
-                linear_ring = etree.SubElement(outer_boundary, "{%s}LinearRing" % nsmap['kml'])
-                coord_elem = etree.SubElement(linear_ring, "{%s}coordinates" % nsmap['kml'])
-                coord_elem.text = coordinates
-                logging.debug(f"Added Polygon geometry to Placemark '{row['name']}'")
-            elif geometry_type == 'LineString':
-                linestring = etree.SubElement(placemark, "{%s}LineString" % nsmap['kml'])
-                coord_elem = etree.SubElement(linestring, "{%s}coordinates" % nsmap['kml'])
-                coord_elem.text = coordinates
-                logging.debug(f"Added LineString geometry to Placemark '{row['name']}'")
-            else:
-                point = etree.SubElement(placemark, "{%s}Point" % nsmap['kml'])
-                coord_elem = etree.SubElement(point, "{%s}coordinates" % nsmap['kml'])
-                coord_elem.text = coordinates
-                logging.debug(f"Added Point geometry to Placemark '{row['name']}'")
-
-        if ('longitude' in row and 'latitude' in row and
-            is_valid_number(row['longitude']) and is_valid_number(row['latitude'])):
-            lookat = etree.SubElement(placemark, "{%s}LookAt" % nsmap['kml'])
-            etree.SubElement(lookat, "{%s}longitude" % nsmap['kml']).text = str(row['longitude'])
-            etree.SubElement(lookat, "{%s}latitude" % nsmap['kml']).text = str(row['latitude'])
-            etree.SubElement(lookat, "{%s}altitude" % nsmap['kml']).text = str(row['altitude']) if 'altitude' in row and row['altitude'] is not None else "0"
-            etree.SubElement(lookat, "{%s}heading" % nsmap['kml']).text = str(row['heading']) if 'heading' in row and row['heading'] is not None else "0"
-            etree.SubElement(lookat, "{%s}tilt" % nsmap['kml']).text = str(row['tilt']) if 'tilt' in row and row['tilt'] is not None else "0"
-            etree.SubElement(lookat, "{%s}range" % nsmap['kml']).text = str(row['range']) if 'range' in row and row['range'] is not None else "0"
-            if 'altitude_mode' in row and row['altitude_mode']:
-                altitude_mode_elem = etree.SubElement(lookat, "{%s}altitudeMode" % nsmap['kml'])
-                altitude_mode_elem.text = row['altitude_mode']
-            logging.debug(f"Added LookAt to Placemark '{row['name']}'")
-
-        date_acq = row['date_acq'] if 'date_acq' in row else None
-        if date_acq:
-            try:
-                if '<begin>' in date_acq and '<end>' in date_acq:
-                    begin_match = re.search(r'<begin>(.*?)</begin>', date_acq)
-                    end_match = re.search(r'<end>(.*?)</end>', date_acq)
-                    if begin_match and end_match:
-                        begin_time = begin_match.group(1)
-                        end_time = end_match.group(1)
-                        timespan = etree.SubElement(placemark, "{%s}TimeSpan" % nsmap['kml'])
-                        begin_elem = etree.SubElement(timespan, "{%s}begin" % nsmap['kml'])
-                        begin_elem.text = begin_time
-                        end_elem = etree.SubElement(timespan, "{%s}end" % nsmap['kml'])
-                        end_elem.text = end_time
-                        logging.debug(f"Added TimeSpan to Placemark '{row['name']}'")
-                else:
-                    date_obj = None
-                    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
-                        try:
-                            date_obj = datetime.strptime(date_acq, fmt)
-                            break
-                        except ValueError:
-                            continue
-                    if date_obj:
-                        timestamp = etree.SubElement(placemark, "{%s}TimeStamp" % nsmap['kml'])
-                        when = etree.SubElement(timestamp, "{%s}when" % nsmap['kml'])
-                        when.text = date_obj.isoformat() + 'Z'
-                        logging.debug(f"Added TimeStamp to Placemark '{row['name']}'")
-                    else:
-                        logging.warning(f"Failed to parse date_acq '{date_acq}' for Placemark '{row['name']}'")
-            except Exception as e:
-                logging.warning(f"Error processing date_acq '{date_acq}' for Placemark '{row['name']}': {e}")
-
-        style = etree.SubElement(placemark, "{%s}Style" % nsmap['kml'])
-        voltage = row['voltage'] if 'voltage' in row else None
-        color = map_voltage_to_color(voltage)
-        conductor_type = row['cable'] if 'cable' in row else None
-        width = None
-        if conductor_type:
-            width = get_conductor_width(conn, conductor_type, row['cable'])
-
-        linestyle = etree.SubElement(style, "{%s}LineStyle" % nsmap['kml'])
-        line_color = etree.SubElement(linestyle, "{%s}color" % nsmap['kml'])
-        line_color.text = color
-        line_width = etree.SubElement(linestyle, "{%s}width" % nsmap['kml'])
-        line_width.text = f"{width:.2f}" if width else "1"
-        logging.debug(f"Set LineStyle for Placemark '{row['name']}'")
-
-        if 'poly_color' in row or 'poly_opacity' in row:
-            polystyle = etree.SubElement(style, "{%s}PolyStyle" % nsmap['kml'])
-            if 'poly_color' in row and row['poly_color']:
-                poly_color = etree.SubElement(polystyle, "{%s}color" % nsmap['kml'])
-                poly_color.text = row['poly_color']
-            if 'poly_opacity' in row and row['poly_opacity']:
-                poly_opacity = etree.SubElement(polystyle, "{%s}opacity" % nsmap['kml'])
-                poly_opacity.text = str(row['poly_opacity'])
-
-        if 'icon_href' in row or 'icon_scale' in row or 'icon_color' in row:
-            iconstyle = etree.SubElement(style, "{%s}IconStyle" % nsmap['kml'])
-            if 'icon_scale' in row and row['icon_scale']:
-                icon_scale = etree.SubElement(iconstyle, "{%s}scale" % nsmap['kml'])
-                icon_scale.text = str(row['icon_scale'])
-            if 'icon_color' in row and row['icon_color']:
-                icon_color = etree.SubElement(iconstyle, "{%s}color" % nsmap['kml'])
-                icon_color.text = row['icon_color']
-            icon = etree.SubElement(iconstyle, "{%s}Icon" % nsmap['kml'])
-            href = etree.SubElement(icon, "{%s}href" % nsmap['kml'])
-            href.text = row['icon_href'] if 'icon_href' in row and row['icon_href'] else ""
-
-        if 'label_color' in row or 'label_scale' in row:
-            labelstyle = etree.SubElement(style, "{%s}LabelStyle" % nsmap['kml'])
-            if 'label_color' in row and row['label_color']:
-                label_color = etree.SubElement(labelstyle, "{%s}color" % nsmap['kml'])
-                label_color.text = row['label_color']
-            if 'label_scale' in row and row['label_scale']:
-                label_scale = etree.SubElement(labelstyle, "{%s}scale" % nsmap['kml'])
-                label_scale.text = str(row['label_scale'])
-
-        if 'extended_data' in row and row['extended_data']:
-            add_extended_data(placemark, row['extended_data'], nsmap)
-
-    placemark_objects = []
-    for row in placemarks:
         if row['geometry_type'] in ['LineString', 'MultiGeometry']:
             placemark_obj = Placemark(row)
             placemark_objects.append(placemark_obj)
@@ -725,182 +1309,421 @@ def reconstruct_kml(db_path, output_kml, find_pairs=True):
     print("Total placemark_objects:", len(placemark_objects))
 
     if find_pairs:
-        grid_index = build_spatial_index_with_names(placemark_objects, GRID_SIZE_DEGREES)
-        identified_pairs = find_identified_pairs(grid_index, proximity_threshold, angle_threshold)
-        print("Total identified_pairs:", len(identified_pairs))
-        with open('outputs/lines_in_same_row.txt', 'w') as f:
-            for name1, name2, seg1, seg2, distance, angle_diff in identified_pairs:
-                f.write(f"{name1} and {name2} share the same ROW\n")
-                f.write(f"Segment from {name1}: {seg1}\n")
-                f.write(f"Segment from {name2}: {seg2}\n")
-                f.write(f"Distance between segments: {distance:.2f} meters\n")
-                f.write(f"Angle difference: {angle_diff:.2f} degrees\n\n")
-        plot_grids_and_lines(grid_index, identified_pairs, output_plot='outputs/grid_plot.pdf')
+        report_identified_pairs(placemark_objects, spatial_index, workers)
     else:
         logging.info("Skipping pair finding as per user request.")
 
+    try:
+        groundoverlays = fetch_groundoverlays(conn, None, *row_filters.get('groundoverlays', (None, ())))
+    except pyodbc.Error as e:
+        logging.error(f"Database fetch error: {e}")
+        groundoverlays = []
+
     for row in groundoverlays:
-        folder_hierarchy = row['folder_hierarchy']
-        folder_elem = get_folder_element(folder_hierarchy, document, folder_dict, nsmap) if folder_hierarchy else document
+        folder_elem = folders.resolve(row['folder_hierarchy'])
+        folder_elem.append(build_groundoverlay_element(row, nsmap))
 
-        groundoverlay = etree.SubElement(folder_elem, "{%s}GroundOverlay" % nsmap['kml'])
-        name_elem = etree.SubElement(groundoverlay, "{%s}name" % nsmap['kml'])
-        name_elem.text = row['name'] if row['name'] else "Unnamed GroundOverlay"
+    try:
+        networklinks = fetch_networklinks(conn, None, *row_filters.get('networklinks', (None, ())))
+    except pyodbc.Error as e:
+        logging.error(f"Database fetch error: {e}")
+        networklinks = []
 
-        icon = etree.SubElement(groundoverlay, "{%s}Icon" % nsmap['kml'])
-        href = etree.SubElement(icon, "{%s}href" % nsmap['kml'])
-        new_icon_href = sanitize_icon_href_for_groundoverlays(row['icon_href']) if 'icon_href' in row else ""
-        href.text = new_icon_href
+    for row in networklinks:
+        folder_elem = folders.resolve(row['folder_hierarchy'])
+        folder_elem.append(build_networklink_element(row, nsmap))
 
-        if 'view_bound_scale' in row and row['view_bound_scale'] is not None:
-            view_bound_scale_elem = etree.SubElement(icon, "{%s}viewBoundScale" % nsmap['kml'])
-            view_bound_scale_elem.text = str(row['view_bound_scale'])
+    conductor_widths.flush()
+    conn.close()
+    logging.info("KML reconstruction completed.")
 
-        if 'coordinates' in row and row['coordinates']:
-            latlonquad = etree.SubElement(groundoverlay, "{%s}LatLonQuad" % nsmap['gx'])
-            coord_elem = etree.SubElement(latlonquad, "{%s}coordinates" % nsmap['kml'])
-            coord_elem.text = row['coordinates']
-        else:
-            latlonbox = etree.SubElement(groundoverlay, "{%s}LatLonBox" % nsmap['kml'])
-            etree.SubElement(latlonbox, "{%s}north" % nsmap['kml']).text = str(row['north']) if row['north'] is not None else "0"
-            etree.SubElement(latlonbox, "{%s}south" % nsmap['kml']).text = str(row['south']) if row['south'] is not None else "0"
-            etree.SubElement(latlonbox, "{%s}east" % nsmap['kml']).text = str(row['east']) if row['east'] is not None else "0"
-            etree.SubElement(latlonbox, "{%s}west" % nsmap['kml']).text = str(row['west']) if row['west'] is not None else "0"
-            if 'rotation' in row and row['rotation'] is not None:
-                rotation_elem = etree.SubElement(latlonbox, "{%s}rotation" % nsmap['kml'])
-                rotation_elem.text = str(row['rotation'])
-
-        if ('longitude' in row and 'latitude' in row and
-            is_valid_number(row['longitude']) and is_valid_number(row['latitude'])):
-            lookat = etree.SubElement(groundoverlay, "{%s}LookAt" % nsmap['kml'])
-            etree.SubElement(lookat, "{%s}longitude" % nsmap['kml']).text = str(row['longitude'])
-            etree.SubElement(lookat, "{%s}latitude" % nsmap['kml']).text = str(row['latitude'])
-            etree.SubElement(lookat, "{%s}altitude" % nsmap['kml']).text = str(row['altitude']) if row['altitude'] is not None else "0"
-            etree.SubElement(lookat, "{%s}heading" % nsmap['kml']).text = str(row['heading']) if row['heading'] is not None else "0"
-            etree.SubElement(lookat, "{%s}tilt" % nsmap['kml']).text = str(row['tilt']) if row['tilt'] is not None else "0"
-            etree.SubElement(lookat, "{%s}range" % nsmap['kml']).text = str(row['range']) if row['range'] is not None else "0"
-            if 'altitude_mode' in row and row['altitude_mode']:
-                altitude_mode_elem = etree.SubElement(lookat, "{%s}altitudeMode" % nsmap['kml'])
-                altitude_mode_elem.text = row['altitude_mode']
-
-        date_acq = row['date_acq'] if 'date_acq' in row else None
-        if date_acq:
-            try:
-                date_obj = None
-                for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%d-%m-%Y"):
-                    try:
-                        date_obj = datetime.strptime(date_acq, fmt)
-                        break
-                    except ValueError:
-                        continue
-                if date_obj:
-                    timestamp = etree.SubElement(groundoverlay, "{%s}TimeStamp" % nsmap['kml'])
-                    when = etree.SubElement(timestamp, "{%s}when" % nsmap['kml'])
-                    when.text = date_obj.isoformat()
-            except Exception as e:
-                logging.warning(f"Failed to parse date_acq '{date_acq}' for GroundOverlay '{row['name']}': {e}")
+    return kml_root, document
 
-        if 'extended_data' in row and row['extended_data']:
-            add_extended_data(groundoverlay, row['extended_data'], nsmap)
+def serialize_features(elements, nsmap):
+    """
+    Serialises detached feature elements for splicing into the streamed <kml> element. lxml
+    would declare nsmap on each one, so they are serialised as children of a wrapper that
+    declares it, and the wrapper's own tags are cut off. The trailing newline is dropped too, so
+    serialising features one at a time or together gives the same bytes.
+    """
+    wrapper = etree.Element("{%s}kml" % nsmap['kml'], nsmap=nsmap)
+    wrapper.extend(elements)
+    data = etree.tostring(wrapper, pretty_print=True)
+    return data[data.index(b'>') + 1:data.rindex(b'<')].rstrip(b'\n')
+
+def write_kml_streaming(output, find_pairs=True, spatial_index='grid', workers=1, extra_elements=(),
+                        fragment_cache=None, row_filters=None):
+    """
+    Streaming alternative to reconstruct_kml + tree.write. Each table is read ordered by
+    folder path (FOLDER_ORDER_SQL) over its own connection, the three streams are merged on
+    the same key, and every feature is serialised with etree.xmlfile as soon as it is built.
+    Folders are opened and closed as the path changes, so memory does not grow with the
+    number of features. Features are grouped by folder rather than kept in table order.
+    extra_elements are written at the end of the Document. output is a path or a
+    writable binary file object. row_filters (see spatial_filters) limit which rows are read.
+
+    With a FragmentCache the export is incremental: only folders whose watermark (see
+    fetch_folder_watermarks) differs from their cached fragment are read and rendered, and
+    the stored bytes of every other folder are spliced into the output unchanged. Pair
+    finding then only sees the re-rendered folders.
+    """
+    if isinstance(output, (str, os.PathLike)):
+        # Cached fragments are written to the file object directly, next to xmlfile's output
+        with open(output, 'wb') as f:
+            return write_kml_streaming(f, find_pairs, spatial_index, workers, extra_elements, fragment_cache,
+                                       row_filters)
+
+    logging.info("Starting streaming KML export...")
 
-    for row in networklinks:
-        folder_hierarchy = row['folder_hierarchy']
-        folder_elem = get_folder_element(folder_hierarchy, document, folder_dict, nsmap) if folder_hierarchy else document
-
-        networklink = etree.SubElement(folder_elem, "{%s}NetworkLink" % nsmap['kml'])
-
-        name_elem = etree.SubElement(networklink, "{%s}name" % nsmap['kml'])
-        name_elem.text = row['name'] if row['name'] else "Unnamed NetworkLink"
-
-        visibility_elem = etree.SubElement(networklink, "{%s}visibility" % nsmap['kml'])
-        visibility_elem.text = str(row['visibility']) if 'visibility' in row and row['visibility'] is not None else "1"
-
-        if ('longitude' in row and 'latitude' in row and
-            is_valid_number(row['longitude']) and is_valid_number(row['latitude'])):
-            lookat = etree.SubElement(networklink, "{%s}LookAt" % nsmap['kml'])
-            etree.SubElement(lookat, "{%s}longitude" % nsmap['kml']).text = str(row['longitude'])
-            etree.SubElement(lookat, "{%s}latitude" % nsmap['kml']).text = str(row['latitude'])
-            etree.SubElement(lookat, "{%s}altitude" % nsmap['kml']).text = str(row['altitude']) if row['altitude'] is not None else "0"
-            etree.SubElement(lookat, "{%s}heading" % nsmap['kml']).text = str(row['heading']) if row['heading'] is not None else "0"
-            etree.SubElement(lookat, "{%s}tilt" % nsmap['kml']).text = str(row['tilt']) if row['tilt'] is not None else "0"
-            etree.SubElement(lookat, "{%s}range" % nsmap['kml']).text = str(row['range']) if row['range'] is not None else "0"
-            if 'altitude_mode' in row and row['altitude_mode']:
-                altitude_mode_elem = etree.SubElement(lookat, "{%s}altitudeMode" % nsmap['kml'])
-                altitude_mode_elem.text = row['altitude_mode']
-
-        date_acq = row['date_acq'] if 'date_acq' in row else None
-        if date_acq:
-            try:
-                date_obj = None
-                for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%d-%m-%Y"):
-                    try:
-                        date_obj = datetime.strptime(date_acq, fmt)
-                        break
-                    except ValueError:
-                        continue
-                if date_obj:
-                    timestamp = etree.SubElement(networklink, "{%s}TimeStamp" % nsmap['kml'])
-                    when = etree.SubElement(timestamp, "{%s}when" % nsmap['kml'])
-                    when.text = date_obj.isoformat()
-            except Exception as e:
-                logging.warning(f"Failed to parse date_acq '{date_acq}' for NetworkLink '{row['name']}': {e}")
+    conn = get_connection()
+    ensure_tables_exist(conn)
+
+    nsmap = {
+        'kml': "http://www.opengis.net/kml/2.2",
+        'gx': "http://www.google.com/kml/ext/2.2"
+    }
+    conductor_widths = ConductorWidthCache(conn)
+    loaded_widths = dict(conductor_widths.widths)
+    order_by = FOLDER_ORDER_SQL
 
-        url = etree.SubElement(networklink, "{%s}Url" % nsmap['kml'])
-        href = etree.SubElement(url, "{%s}href" % nsmap['kml'])
-        href.text = row['href'] if 'href' in row and row['href'] else ""
-        view_refresh_mode = etree.SubElement(url, "{%s}viewRefreshMode" % nsmap['kml'])
-        view_refresh_mode.text = row['viewRefreshMode'] if 'viewRefreshMode' in row and row['viewRefreshMode'] else ""
-        view_refresh_time = etree.SubElement(url, "{%s}viewRefreshTime" % nsmap['kml'])
-        view_refresh_time.text = str(row['viewRefreshTime']) if 'viewRefreshTime' in row and row['viewRefreshTime'] is not None else "0"
+    row_filters = row_filters or {}
+    folders = None, ()
+    if fragment_cache is not None:
+        try:
+            watermarks = fetch_folder_watermarks(conn, row_filters)
+        except pyodbc.Error as e:
+            logging.error(f"Database fetch error: {e}")
+            conn.close()
+            return
+        fragment_cache.check_conductor_widths(loaded_widths)
+        dirty = {folder_path for folder_path, watermark in watermarks.items()
+                 if fragment_cache.watermark(folder_path) != watermark}
+        logging.info(f"Incremental export: {len(dirty)} of {len(watermarks)} folders changed")
+        if len(dirty) <= MAX_FILTERED_DIRTY_FOLDERS:
+            folders = folder_filter(dirty)
+    filters = {table: combine_filters(row_filters.get(table, (None, ())), folders) for table in FEATURE_TABLES}
+
+    read_conns = [get_connection() for _ in range(3)]
+
+    def tagged(kind, rows):
+        for row in rows:
+            yield kind, row
 
-        if 'extended_data' in row and row['extended_data']:
-            add_extended_data(networklink, row['extended_data'], nsmap)
+    try:
+        streams = [
+            tagged('placemark', fetch_placemarks(read_conns[0], order_by, *filters['placemarks'])),
+            tagged('groundoverlay', fetch_groundoverlays(read_conns[1], order_by, *filters['groundoverlays'])),
+            tagged('networklink', fetch_networklinks(read_conns[2], order_by, *filters['networklinks']))
+        ]
+    except pyodbc.Error as e:
+        logging.error(f"Database fetch error: {e}")
+        for read_conn in read_conns:
+            read_conn.close()
+        conn.close()
+        return
+
+    placemark_objects = []
+    feature_count = 0
+
+    def build_feature(kind, row):
+        nonlocal feature_count
+        feature_count += 1
+        if kind == 'placemark':
+            if row['geometry_type'] in ['LineString', 'MultiGeometry']:
+                placemark_objects.append(Placemark(row))
+            return build_placemark_element(row, nsmap, conductor_widths)
+        if kind == 'groundoverlay':
+            return build_groundoverlay_element(row, nsmap)
+        return build_networklink_element(row, nsmap)
+
+    merged = heapq.merge(*streams, key=lambda item: folder_sort_key(item[1]['folder_hierarchy']))
+    folder_groups = itertools.groupby(merged, key=lambda item: item[1]['folder_hierarchy'] or '')
+    with etree.xmlfile(output, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        with xf.element("{%s}kml" % nsmap['kml'], nsmap=nsmap):
+            with xf.element("{%s}Document" % nsmap['kml']):
+                open_folders = []  # (folder name, xf.element context) from outermost to innermost
+
+                def enter_folder(folder_path):
+                    folder_names = parse_folder_path(folder_path) if folder_path else []
+                    common = 0
+                    while (common < len(open_folders) and common < len(folder_names) and
+                           open_folders[common][0] == folder_names[common]):
+                        common += 1
+                    while len(open_folders) > common:
+                        open_folders.pop()[1].__exit__(None, None, None)
+                    for folder_name in folder_names[common:]:
+                        container = "Document" if '.kmz' in folder_name.lower() else "Folder"
+                        folder_context = xf.element("{%s}%s" % (nsmap['kml'], container))
+                        folder_context.__enter__()
+                        with xf.element("{%s}name" % nsmap['kml']):
+                            xf.write(folder_name)
+                        open_folders.append((folder_name, folder_context))
+
+                if fragment_cache is None:
+                    for folder_path, items in folder_groups:
+                        enter_folder(folder_path)
+                        for kind, row in items:
+                            xf.flush()
+                            output.write(serialize_features([build_feature(kind, row)], nsmap))
+                else:
+                    group = next(folder_groups, None)
+                    for folder_path in sorted(watermarks, key=folder_sort_key):
+                        enter_folder(folder_path)
+                        # Rows of clean folders are only present when whole tables were read
+                        while group is not None and folder_sort_key(group[0]) < folder_sort_key(folder_path):
+                            group = next(folder_groups, None)
+                        if folder_path in dirty:
+                            items = group[1] if group is not None and group[0] == folder_path else ()
+                            fragment = serialize_features([build_feature(kind, row) for kind, row in items], nsmap)
+                            fragment_cache.put(folder_path, watermarks[folder_path], fragment)
+                        else:
+                            fragment = fragment_cache.get(folder_path, watermarks[folder_path])
+                            if fragment is None:
+                                raise RuntimeError(f"Fragment cache entry for folder '{folder_path}' "
+                                                   f"changed during the export")
+                        xf.flush()
+                        output.write(fragment)
+
+                while open_folders:
+                    open_folders.pop()[1].__exit__(None, None, None)
+                xf.flush()
+                output.write(serialize_features(extra_elements, nsmap))
+
+    for read_conn in read_conns:
+        read_conn.close()
+    if fragment_cache is not None:
+        # Random widths assigned during this run are stored by flush() and used by the new fragments
+        fragment_cache.save_conductor_widths({**loaded_widths, **conductor_widths.pending})
+        fragment_cache.prune(watermarks)
+        logging.info(f"Re-rendered {len(dirty)} folders and reused {len(watermarks) - len(dirty)} cached folders.")
+    conductor_widths.flush()
+    logging.info(f"Streamed {feature_count} features to KML.")
+
+    print("Total placemark_objects:", len(placemark_objects))
+    if find_pairs:
+        report_identified_pairs(placemark_objects, spatial_index, workers)
+    else:
+        logging.info("Skipping pair finding as per user request.")
 
     conn.close()
-    logging.info("KML reconstruction completed.")
 
-    return kml_root, document
+class TeeWriter:
+    """
+    Binary file-like object that writes every chunk to several targets, so a KML can be
+    serialised into the KMZ entry and a standalone file in the same pass.
+    """
+
+    def __init__(self, *targets):
+        self.targets = targets
+
+    def write(self, data):
+        for target in self.targets:
+            target.write(data)
+        return len(data)
+
+def is_image_file(file_path):
+    return os.path.splitext(file_path)[1].lower() in IMAGE_EXTENSIONS
+
+def list_kmz_resources(source_folder):
+    """
+    Returns (file_path, arcname) for every file under source_folder in a stable sorted order,
+    so archives built from the same folder always list their entries identically.
+    """
+    resources = []
+    for root_dir, dirs, files in os.walk(source_folder):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root_dir, file)
+            resources.append((file_path, os.path.relpath(file_path, source_folder)))
+    return resources
+
+def pack_image(image_path, cache=None, max_size=(1024, 1024)):
+    """
+    Applies the packing policy to one image and returns (status, data, seconds):
+    'passthrough' - already a compressed format within max_size and IMAGE_PASSTHROUGH_MAX_BYTES,
+                    packed unchanged without decoding (data is None)
+    'unchanged'   - re-encoded but not smaller than the source, packed unchanged (data is None)
+    'reencoded'   - data holds the compressed bytes
+    'failed'      - could not be compressed, packed unchanged (data is None)
+    seconds is the time spent re-encoding (or reading the cache).
+    """
+    try:
+        source_size = os.path.getsize(image_path)
+        with Image.open(image_path) as img:  # reads the header only
+            source_format, width, height = img.format, img.width, img.height
+    except Exception:
+        source_format, width, height = None, None, None
+    within_max_size = width is not None and width <= max_size[0] and height <= max_size[1]
+    if (within_max_size and source_format in PASSTHROUGH_IMAGE_FORMATS and
+            source_size <= IMAGE_PASSTHROUGH_MAX_BYTES):
+        return 'passthrough', None, 0.0
+
+    start = time.perf_counter()
+    data, image_format = compress_image(image_path, max_size=max_size, cache=cache)
+    seconds = time.perf_counter() - start
+    if data is None:
+        return 'failed', None, seconds
+    if within_max_size and len(data) >= source_size:
+        return 'unchanged', None, seconds
+    return 'reencoded', data, seconds
+
+def iter_packed_resources(resources, workers=1, cache=None):
+    """
+    Yields (file_path, arcname, packed) in the order of resources, where packed is the
+    pack_image result for images and None for other files. With workers > 1 images are
+    packed in a process pool that runs a bounded number of files ahead of the consumer.
+    cache is an optional ImageCache consulted before compressing.
+    """
+    if workers <= 1 or not any(is_image_file(file_path) for file_path, _ in resources):
+        for file_path, arcname in resources:
+            packed = pack_image(file_path, cache) if is_image_file(file_path) else None
+            yield file_path, arcname, packed
+        return
 
-def create_kmz(kml_file, kmz_file, source_folder):
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        remaining = iter(resources)
+        window = workers * IMAGE_PREFETCH_PER_WORKER
+        while True:
+            while len(pending) < window:
+                next_resource = next(remaining, None)
+                if next_resource is None:
+                    break
+                file_path, arcname = next_resource
+                future = executor.submit(pack_image, file_path, cache) if is_image_file(file_path) else None
+                pending.append((file_path, arcname, future))
+            if not pending:
+                break
+            file_path, arcname, future = pending.popleft()
+            yield file_path, arcname, future.result() if future else None
+
+class PackingReport:
+    """
+    Tallies what the KMZ packing policy skipped and estimates the time that saved, using
+    this run's own re-encode and deflate throughput as the yardstick.
+    """
+
+    def __init__(self):
+        self.passthrough_images = 0
+        self.passthrough_bytes = 0
+        self.unchanged_images = 0
+        self.reencoded_images = 0
+        self.reencode_input_bytes = 0
+        self.reencode_seconds = 0.0
+        self.stored_members = 0
+        self.stored_bytes = 0
+        self.deflated_bytes = 0
+        self.deflate_seconds = 0.0
+
+    def log_summary(self):
+        reencode_rate = self.reencode_seconds / self.reencode_input_bytes if self.reencode_input_bytes else None
+        deflate_rate = self.deflate_seconds / self.deflated_bytes if self.deflated_bytes else None
+        message = (f"KMZ packing: passed through {self.passthrough_images} images ({self.passthrough_bytes} bytes) "
+                   f"without re-encoding")
+        if reencode_rate is not None:
+            message += f" (~{self.passthrough_bytes * reencode_rate:.2f} s saved)"
+        message += (f"; kept {self.unchanged_images} originals that re-encoding did not shrink; "
+                    f"re-encoded {self.reencoded_images} images; stored {self.stored_members} members "
+                    f"({self.stored_bytes} bytes) without deflate")
+        if deflate_rate is not None:
+            message += f" (~{self.stored_bytes * deflate_rate:.2f} s saved)"
+        logging.info(message)
+
+def add_kmz_resources(kmz, source_folder, image_workers=1, image_cache=None):
+    """
+    Packs every file under source_folder into kmz. Images go through pack_image; members that
+    are already compressed (re-encoded images and PRECOMPRESSED_EXTENSIONS) are stored with
+    ZIP_STORED and everything else uses the archive's compression. Returns a PackingReport.
+    """
+    report = PackingReport()
+    if not os.path.isdir(source_folder):
+        logging.warning(f"Source folder for KMZ resources does not exist: {source_folder}")
+        return report
+    resources = list_kmz_resources(source_folder)
+    for file_path, arcname, packed in iter_packed_resources(resources, image_workers, image_cache):
+        file_size = os.path.getsize(file_path)
+        status, data, seconds = packed if packed else (None, None, 0.0)
+        if status == 'passthrough':
+            report.passthrough_images += 1
+            report.passthrough_bytes += file_size
+        elif status == 'unchanged':
+            report.unchanged_images += 1
+        elif status == 'reencoded':
+            report.reencoded_images += 1
+            report.reencode_input_bytes += file_size
+            report.reencode_seconds += seconds
+
+        if data is not None:
+            # Stamp the entry with the source file's mtime, as kmz.write does, so output is reproducible.
+            zinfo = zipfile.ZipInfo.from_file(file_path, arcname)
+            kmz.writestr(zinfo, data, compress_type=zipfile.ZIP_STORED)
+            report.stored_members += 1
+            report.stored_bytes += len(data)
+            logging.debug("Compressed and added image to KMZ: %s as %s (Size: %d bytes)", file_path, arcname, len(data))
+        elif os.path.splitext(file_path)[1].lower() in PRECOMPRESSED_EXTENSIONS:
+            kmz.write(file_path, arcname, compress_type=zipfile.ZIP_STORED)
+            report.stored_members += 1
+            report.stored_bytes += file_size
+            logging.debug("Stored original file in KMZ: %s as %s (Size: %d bytes)", file_path, arcname, file_size)
+        else:
+            start = time.perf_counter()
+            kmz.write(file_path, arcname)
+            if kmz.compression != zipfile.ZIP_STORED:
+                report.deflate_seconds += time.perf_counter() - start
+                report.deflated_bytes += file_size
+            logging.debug("Added file to KMZ: %s as %s (Size: %d bytes)", file_path, arcname, file_size)
+    if image_cache is not None:
+        image_cache.evict()
+    report.log_summary()
+    return report
+
+def create_kmz(kml_file, kmz_file, source_folder, compresslevel=KMZ_COMPRESSION_LEVEL, image_workers=1,
+               image_cache=None):
     logging.info("Starting KMZ creation...")
     try:
-        with zipfile.ZipFile(kmz_file, 'w', zipfile.ZIP_DEFLATED) as kmz:
+        with zipfile.ZipFile(kmz_file, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as kmz:
             kmz.write(kml_file, os.path.basename(kml_file))
             kml_size = os.path.getsize(kml_file)
-            logging.debug(f"Added KML file to KMZ: {kml_file} (Size: {kml_size} bytes)")
-
-            if os.path.isdir(source_folder):
-                for root_dir, dirs, files in os.walk(source_folder):
-                    for file in files:
-                        file_path = os.path.join(root_dir, file)
-                        arcname = os.path.relpath(file_path, source_folder)
-                        _, ext = os.path.splitext(file)
-                        ext = ext.lower()
-                        if ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.svg']:
-                            compressed_image_data, image_format = compress_image(file_path)
-                            if compressed_image_data:
-                                kmz.writestr(arcname, compressed_image_data)
-                                compressed_size = len(compressed_image_data)
-                                logging.debug(f"Compressed and added image to KMZ: {file_path} as {arcname} (Size: {compressed_size} bytes)")
-                            else:
-                                kmz.write(file_path, arcname)
-                                original_size = os.path.getsize(file_path)
-                                logging.debug(f"Added original image to KMZ: {file_path} as {arcname} (Size: {original_size} bytes)")
-                        else:
-                            kmz.write(file_path, arcname)
-                            file_size = os.path.getsize(file_path)
-                            logging.debug(f"Added non-image file to KMZ: {file_path} as {arcname} (Size: {file_size} bytes)")
-            else:
-                logging.warning(f"Source folder for KMZ resources does not exist: {source_folder}")
+            logging.debug("Added KML file to KMZ: %s (Size: %d bytes)", kml_file, kml_size)
+            add_kmz_resources(kmz, source_folder, image_workers, image_cache)
 
         final_kmz_size = os.path.getsize(kmz_file)
         logging.info(f"KMZ file successfully created at: {kmz_file} (Total Size: {final_kmz_size} bytes)")
     except Exception as e:
         logging.error(f"Failed to create KMZ file: {e}")
 
-def add_svg_overlay(document, image_path, north, south, east, west, rotation=0):
-    nsmap = document.nsmap
-    groundoverlay = etree.SubElement(document, "{%s}GroundOverlay" % nsmap['kml'])
+def create_kmz_streaming(write_kml, kmz_file, source_folder, kml_arcname='reconstructed.kml',
+                         kml_file=None, compresslevel=KMZ_COMPRESSION_LEVEL, image_workers=1, image_cache=None):
+    """
+    Builds the KMZ without reading a KML back from disk. write_kml is called with a writable
+    binary file object and serialises the document straight into the deflated archive entry.
+    If kml_file is given, the same bytes are also written there as a standalone copy.
+    Images are compressed by image_workers processes, reusing image_cache entries when given.
+    """
+    logging.info("Starting KMZ creation (streaming KML into archive)...")
+    try:
+        with zipfile.ZipFile(kmz_file, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as kmz:
+            # The entry size is unknown up front, so allow ZIP64 in case it passes 2 GiB.
+            with kmz.open(kml_arcname, 'w', force_zip64=True) as entry:
+                if kml_file:
+                    with open(kml_file, 'wb') as standalone:
+                        write_kml(TeeWriter(entry, standalone))
+                    logging.info(f"KML file successfully created at: {kml_file}")
+                else:
+                    write_kml(entry)
+            kml_info = kmz.getinfo(kml_arcname)
+            logging.debug("Added KML to KMZ as %s (Size: %d bytes, Compressed: %d bytes)",
+                          kml_arcname, kml_info.file_size, kml_info.compress_size)
+            add_kmz_resources(kmz, source_folder, image_workers, image_cache)
+
+        final_kmz_size = os.path.getsize(kmz_file)
+        logging.info(f"KMZ file successfully created at: {kmz_file} (Total Size: {final_kmz_size} bytes)")
+    except Exception as e:
+        logging.error(f"Failed to create KMZ file: {e}")
+
+def create_svg_overlay(nsmap, image_path, north, south, east, west, rotation=0):
+    groundoverlay = etree.Element("{%s}GroundOverlay" % nsmap['kml'])
     name = etree.SubElement(groundoverlay, "{%s}name" % nsmap['kml'])
     name.text = "Image Overlay"
     icon = etree.SubElement(groundoverlay, "{%s}Icon" % nsmap['kml'])
@@ -914,15 +1737,50 @@ def add_svg_overlay(document, image_path, north, south, east, west, rotation=0):
     etree.SubElement(latlonbox, "{%s}west" % nsmap['kml']).text = str(west)
     if rotation:
         etree.SubElement(latlonbox, "{%s}rotation" % nsmap['kml']).text = str(rotation)
+    return groundoverlay
+
+def add_svg_overlay(document, image_path, north, south, east, west, rotation=0):
+    document.append(create_svg_overlay(document.nsmap, image_path, north, south, east, west, rotation))
     logging.info("Added image GroundOverlay with bounding box coordinates.")
 
-def reconstruct_kml_from_db(db_path, output_kml, find_pairs=True):
-    return reconstruct_kml(db_path, output_kml, find_pairs=find_pairs)
+def reconstruct_kml_from_db(db_path, output_kml, find_pairs=True, spatial_index='grid', workers=1, row_filters=None):
+    return reconstruct_kml(db_path, output_kml, find_pairs=find_pairs, spatial_index=spatial_index, workers=workers,
+                           row_filters=row_filters)
 
 def main():
     parser = argparse.ArgumentParser(description='Reconstruct KML and create KMZ.')
     parser.add_argument('--find-pairs', action='store_true', help='Find and process line pairs')
+    parser.add_argument('--spatial-index', choices=['grid'] + list(SPATIAL_INDEX_BACKENDS), default='grid',
+                        help='Spatial index used to find candidate line pairs')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes for grid-based pair finding (tiles of grid cells are scanned in parallel)')
+    parser.add_argument('--stream-kml', action='store_true',
+                        help='Write the KML incrementally instead of building the whole document in memory')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Re-render only folders whose rows changed since the last incremental export and reuse '
+                             'the cached KML of the rest from outputs/kml_fragment_cache (implies --stream-kml)')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                        help='Only export features whose bounding box overlaps this box (degrees)')
+    parser.add_argument('--within-km', type=float, nargs=3, metavar=('LAT', 'LON', 'KM'),
+                        help='Only export features within KM kilometres of the point LAT, LON')
+    parser.add_argument('--no-kml', action='store_true',
+                        help='Only write the KMZ; do not leave a standalone reconstructed.kml on disk')
+    parser.add_argument('--compression-level', type=int, choices=range(10), default=KMZ_COMPRESSION_LEVEL,
+                        metavar='0-9', help='Deflate level for KMZ entries')
+    parser.add_argument('--image-workers', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes used to compress images while the KMZ is written')
+    parser.add_argument('--no-image-cache', action='store_true',
+                        help='Recompress every image instead of reusing outputs/image_cache')
+    add_logging_arguments(parser, default_level='INFO')
     args = parser.parse_args()
+    configure_logging(args.log_level, log_file=LOG_FILE, trace_every=args.trace_every)
+    if args.incremental and args.find_pairs:
+        parser.error("--find-pairs needs every line placemark and cannot be combined with --incremental")
+    if args.bbox and not (args.bbox[0] <= args.bbox[2] and args.bbox[1] <= args.bbox[3]):
+        parser.error("--bbox must be WEST SOUTH EAST NORTH with WEST <= EAST and SOUTH <= NORTH")
+    if args.within_km and not (-90 <= args.within_km[0] <= 90 and args.within_km[2] > 0):
+        parser.error("--within-km needs a latitude in [-90, 90] and a positive distance")
+    row_filters = spatial_filters(args.bbox, args.within_km)
 
     find_pairs = args.find_pairs
 
@@ -931,21 +1789,35 @@ def main():
     output_kml = os.path.join(current_dir, 'outputs', 'reconstructed.kml')
     files_folder = os.path.join(current_dir, 'outputs', 'files')
     kmz_file = os.path.join(current_dir, 'outputs', 'reconstructed.kmz')
+    image_cache_dir = os.path.join(current_dir, 'outputs', 'image_cache')
+    fragment_cache_dir = os.path.join(current_dir, 'outputs', 'kml_fragment_cache')
 
     os.makedirs(os.path.dirname(output_kml), exist_ok=True)
     os.makedirs(files_folder, exist_ok=True)
 
-    kml_root, document = reconstruct_kml_from_db(db_path, output_kml, find_pairs=find_pairs)
-    add_svg_overlay(document, "files/station_diagram.png", north=30.0, south=29.9, east=-95.0, west=-95.1)
+    if args.stream_kml or args.incremental:
+        fragment_cache = FragmentCache(fragment_cache_dir) if args.incremental else None
+        nsmap = {'kml': "http://www.opengis.net/kml/2.2", 'gx': "http://www.google.com/kml/ext/2.2"}
+        svg_overlay = create_svg_overlay(nsmap, "files/station_diagram.png", north=30.0, south=29.9, east=-95.0, west=-95.1)
 
-    tree = etree.ElementTree(kml_root)
-    try:
-        tree.write(output_kml, pretty_print=True, xml_declaration=True, encoding='UTF-8')
-        logging.info(f"KML file successfully created at: {output_kml}")
-    except Exception as e:
-        logging.error(f"Failed to write KML file: {e}")
-
-    create_kmz(output_kml, kmz_file, files_folder)
+        def write_kml(output):
+            write_kml_streaming(output, find_pairs=find_pairs, spatial_index=args.spatial_index,
+                                workers=args.workers, extra_elements=[svg_overlay], fragment_cache=fragment_cache,
+                                row_filters=row_filters)
+    else:
+        kml_root, document = reconstruct_kml_from_db(db_path, output_kml, find_pairs=find_pairs,
+                                                     spatial_index=args.spatial_index, workers=args.workers,
+                                                     row_filters=row_filters)
+        add_svg_overlay(document, "files/station_diagram.png", north=30.0, south=29.9, east=-95.0, west=-95.1)
+        tree = etree.ElementTree(kml_root)
+
+        def write_kml(output):
+            tree.write(output, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+
+    create_kmz_streaming(write_kml, kmz_file, files_folder, kml_arcname=os.path.basename(output_kml),
+                         kml_file=None if args.no_kml else output_kml, compresslevel=args.compression_level,
+                         image_workers=args.image_workers,
+                         image_cache=None if args.no_image_cache else ImageCache(image_cache_dir, IMAGE_CACHE_MAX_BYTES))
     logging.info("Script execution completed successfully.")
 
 if __name__ == "__main__":
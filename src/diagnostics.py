@@ -0,0 +1,70 @@
+import logging
+
+from lxml import etree
+
+LOG_FORMAT = '%(asctime)s %(levelname)s:%(message)s'
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+def configure_logging(level='WARNING', log_file=None, trace_every=1):
+    """
+    Configures the root logger for a script run. level is a name from LOG_LEVELS; records below
+    it are dropped before any message formatting happens. When log_file is given, records are
+    written there as well as to stderr. trace_every sets FEATURE_TRACE sampling (see FeatureTrace).
+    """
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.insert(0, logging.FileHandler(log_file))
+    logging.basicConfig(level=getattr(logging, level), format=LOG_FORMAT, handlers=handlers, force=True)
+    FEATURE_TRACE.every = trace_every
+
+
+def add_logging_arguments(parser, default_level='WARNING'):
+    """
+    Adds the shared --log-level and --trace-every options to an argparse parser.
+    """
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default=default_level,
+                        help=f"Lowest log level emitted (default: {default_level})")
+    parser.add_argument('--trace-every', type=int, default=1, metavar='N',
+                        help='At DEBUG level, trace every Nth feature in detail; 0 disables per-feature tracing')
+
+
+class LazyXml:
+    """
+    Log argument that serialises an element only if the record is actually formatted, e.g.
+    logging.debug("Placemark XML:\\n%s", LazyXml(placemark, pretty_print=True)).
+    """
+    __slots__ = ('element', 'pretty_print')
+
+    def __init__(self, element, pretty_print=False):
+        self.element = element
+        self.pretty_print = pretty_print
+
+    def __str__(self):
+        return etree.tostring(self.element, pretty_print=self.pretty_print, encoding='unicode')
+
+
+class FeatureTrace:
+    """
+    Sampler for per-feature debug tracing. sample() is True for the 1st, (N+1)th, (2N+1)th ...
+    feature it is asked about, and only while DEBUG is enabled on the root logger, so callers
+    can guard a whole block of per-feature diagnostics with a single check:
+
+        if FEATURE_TRACE.sample():
+            logging.debug(...)
+
+    every=0 turns per-feature tracing off. The counter is per process.
+    """
+
+    def __init__(self, every=1):
+        self.every = every
+        self.seen = 0
+
+    def sample(self):
+        if not self.every or not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return False
+        self.seen += 1
+        return (self.seen - 1) % self.every == 0
+
+
+FEATURE_TRACE = FeatureTrace()
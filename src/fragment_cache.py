@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import logging
+
+CONDUCTOR_WIDTHS_FILE = 'conductor_widths.json'
+
+
+class FragmentCache:
+    """
+    Persistent store of serialised KML fragments, one per folder_hierarchy, for incremental
+    exports. Each entry is one file <key>.frag in cache_dir, where key is the SHA-256 of the
+    folder path; it holds the folder's watermark on its first line followed by the bytes of
+    every feature in that folder. get() only returns the bytes when the stored watermark
+    matches the current one, so a folder whose rows changed simply misses.
+    Placemark styling also depends on conductor_types, which the watermarks do not cover;
+    check_conductor_widths() drops every entry when a width the fragments may use changed.
+    The directory is meant for one exporter at a time.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, folder_path):
+        key = hashlib.sha256(folder_path.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.frag")
+
+    def watermark(self, folder_path):
+        """
+        Returns the watermark stored for folder_path, or None if it has no entry.
+        """
+        try:
+            with open(self._path(folder_path), 'rb') as f:
+                return f.readline().rstrip(b'\n').decode('ascii')
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def get(self, folder_path, watermark):
+        """
+        Returns the fragment bytes for folder_path if they were stored under watermark, else None.
+        """
+        try:
+            with open(self._path(folder_path), 'rb') as f:
+                if f.readline().rstrip(b'\n').decode('ascii') != watermark:
+                    return None
+                return f.read()
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def _write_atomic(self, path, data):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Failed to write fragment cache entry {path}: {e}")
+
+    def put(self, folder_path, watermark, data):
+        """
+        Stores a folder's fragment bytes under watermark. The entry is written to a temporary
+        file and renamed into place, so a reader never sees a partial entry.
+        """
+        self._write_atomic(self._path(folder_path), watermark.encode('ascii') + b'\n' + data)
+
+    def clear(self):
+        """
+        Removes every fragment. Returns the number of entries removed.
+        """
+        return self.prune(())
+
+    def prune(self, folder_paths):
+        """
+        Removes the fragments of folders not in folder_paths, i.e. folders that no longer have
+        any rows. Returns the number of entries removed.
+        """
+        keep = {os.path.basename(self._path(folder_path)) for folder_path in folder_paths}
+        removed = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.frag') and entry.name not in keep:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    continue
+                removed += 1
+        if removed:
+            logging.info(f"Removed {removed} stale entries from fragment cache {self.cache_dir}")
+        return removed
+
+    def check_conductor_widths(self, widths):
+        """
+        Clears the cache if any conductor type recorded by save_conductor_widths() now has a
+        different width or is gone. Types added since do not invalidate anything, because no
+        cached fragment can have used them. Returns True if the cache was cleared.
+        """
+        try:
+            with open(os.path.join(self.cache_dir, CONDUCTOR_WIDTHS_FILE), encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = None
+        if saved is not None and all(widths.get(conductor_type) == width for conductor_type, width in saved.items()):
+            return False
+        self.clear()
+        return True
+
+    def save_conductor_widths(self, widths):
+        """
+        Records the conductor widths the cached fragments were rendered with.
+        """
+        path = os.path.join(self.cache_dir, CONDUCTOR_WIDTHS_FILE)
+        self._write_atomic(path, json.dumps(widths, ensure_ascii=False, sort_keys=True).encode('utf-8'))
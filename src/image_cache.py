@@ -0,0 +1,91 @@
+import hashlib
+import os
+import logging
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+class ImageCache:
+    """
+    Persistent content-addressed store of compressed images. Entries are keyed by the SHA-256
+    of the source file plus the compression settings, so an unchanged image is never
+    recompressed and a changed image or setting simply misses. Each entry is one file
+    <key>.img in cache_dir holding the image format on its first line followed by the bytes;
+    its mtime is refreshed on every hit and evict() removes the least recently used entries
+    until the directory fits in max_bytes.
+    Instances hold only plain attributes, so they can be passed to worker processes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, image_path, settings):
+        """
+        Returns the cache key for image_path compressed with the given settings tuple.
+        """
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        digest.update(repr(settings).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.img")
+
+    def get(self, key):
+        """
+        Returns (compressed_data, image_format) for key, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                image_format = f.readline().rstrip(b'\n').decode('ascii')
+                data = f.read()
+            os.utime(path)
+        except (OSError, UnicodeDecodeError):
+            return None
+        return data, image_format
+
+    def put(self, key, data, image_format):
+        """
+        Stores compressed bytes under key. The entry is written to a temporary file and renamed
+        into place, so concurrent writers and readers never see a partial entry.
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(image_format.encode('ascii') + b'\n')
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"Failed to write image cache entry {path}: {e}")
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_bytes.
+        Returns the number of entries removed.
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+                total += stat.st_size
+        removed = 0
+        for _, path, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            logging.info(f"Evicted {removed} entries from image cache {self.cache_dir}")
+        return removed
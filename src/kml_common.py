@@ -0,0 +1,164 @@
+import ast
+import functools
+import json
+
+import numpy as np
+from lxml import etree
+
+# Storage conventions shared by the ingest (test.py) and export (db_to_kmz.py) scripts
+
+# WGS-84 ellipsoid, matching geopy's default for geodesic()
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+WGS84_E2 = WGS84_F * (2 - WGS84_F)
+MEAN_EARTH_RADIUS = 6371008.8  # meters
+
+# Placemark geometry columns filled at ingest (see spatial_values in test.py) for spatial
+# filtering on export
+SPATIAL_COLUMNS = {
+    'geog': 'GEOGRAPHY',
+    'min_lat': 'FLOAT',
+    'max_lat': 'FLOAT',
+    'min_lon': 'FLOAT',
+    'max_lon': 'FLOAT'
+}
+
+# Storage format of the extended_data/attributes columns, recorded per row in data_format.
+# NULL: legacy str(dict) reprs read with ast.literal_eval; 1: JSON.
+JSON_DATA_FORMAT = 1
+
+
+def encode_json_column(value):
+    """
+    Serialises an extended_data/attributes dict for storage. Missing values are stored as NULL.
+    """
+    if value is None:
+        return None
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def decode_json_column(text, data_format=None):
+    """
+    Decodes a stored extended_data/attributes value. JSON rows are read with json.loads;
+    legacy rows (data_format NULL) hold str(dict) reprs and fall back to ast.literal_eval.
+    Raises ValueError or SyntaxError if the text is neither.
+    """
+    if not text:
+        return None
+    if data_format == JSON_DATA_FORMAT:
+        try:
+            return json.loads(text)
+        except ValueError:
+            pass
+    return ast.literal_eval(text)
+
+
+def parse_kml_coordinates(coord_text, on_invalid=None):
+    """
+    Parses a KML coordinates string into an (N, 3) float64 array of (lat, lon, alt); tuples
+    without an altitude, or with an empty one ("lon,lat,"), get 0. Tuples with fewer than two values are skipped. A tuple whose
+    values are not numbers raises ValueError, unless on_invalid is given, in which case it is
+    called with the tuple text and the error and the tuple is skipped.
+    """
+    tuples = coord_text.split() if coord_text else []
+    if not tuples:
+        return np.empty((0, 3), dtype=np.float64)
+
+    # Fast path: every tuple has the same number of components. The total comma count alone is
+    # not enough ("1,2,0 5" has as many commas as two lon,lat tuples), so each tuple is checked,
+    # and so is the value count, since an empty component ("1,2, 3,4,") leaves a value out.
+    comma_count = coord_text.count(',')
+    try:
+        for width in (3, 2):
+            if comma_count == (width - 1) * len(tuples):
+                values = coord_text.replace(',', ' ').split()
+                if (len(values) == width * len(tuples)
+                        and all(coord.count(',') == width - 1 for coord in tuples)):
+                    values = np.array(values, dtype=np.float64).reshape(-1, width)
+                    coords = np.zeros((len(values), 3), dtype=np.float64)
+                    coords[:, 0] = values[:, 1]
+                    coords[:, 1] = values[:, 0]
+                    if width == 3:
+                        coords[:, 2] = values[:, 2]
+                    return coords
+                break
+    except ValueError:
+        pass  # Fall back to per-tuple parsing so bad tuples are reported
+
+    # Mixed lon,lat and lon,lat,alt tuples, or tuples the fast path could not read
+    coords = []
+    for coord in tuples:
+        parts = coord.split(',')
+        if len(parts) < 2:
+            continue
+        try:
+            coords.append((float(parts[1]), float(parts[0]), float(parts[2]) if len(parts) > 2 and parts[2] else 0.0))
+        except ValueError as e:
+            if on_invalid is None:
+                raise
+            on_invalid(coord, e)
+    return np.array(coords, dtype=np.float64).reshape(-1, 3)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_folder_path(folder_path):
+    """
+    Splits a stored ' > ' folder path into a tuple of the display names of its folders.
+    Memoised, since thousands of rows share a few dozen distinct paths.
+    """
+    folder_names = []
+    for folder_name in folder_path.strip().split(' > '):
+        folder_name = folder_name.strip()
+        try:
+            folder_data = ast.literal_eval(folder_name)
+            if isinstance(folder_data, dict):
+                if 'featureType' in folder_data:
+                    folder_name = folder_data['featureType']
+                elif 'name' in folder_data:
+                    folder_name = folder_data['name']
+                else:
+                    folder_name = ', '.join(f'{k}: {v}' for k, v in folder_data.items())
+            else:
+                folder_name = str(folder_data)
+        except (ValueError, SyntaxError):
+            pass
+        folder_names.append(folder_name)
+    return tuple(folder_names)
+
+
+class FolderResolver:
+    """
+    Maps raw folder_hierarchy strings to Folder/Document elements under root_elem, creating
+    them on first use. Resolved raw paths are cached, so a repeat is a single dict hit; new
+    raw paths walk a trie of display names, sharing parent folders with earlier paths.
+    """
+
+    def __init__(self, root_elem, nsmap):
+        self.root_elem = root_elem
+        self.nsmap = nsmap
+        self.by_raw_path = {}
+        self.trie = {}  # display name -> (element, child trie)
+
+    def resolve(self, folder_path):
+        if not folder_path:
+            return self.root_elem
+        elem = self.by_raw_path.get(folder_path)
+        if elem is not None:
+            return elem
+
+        current_elem = self.root_elem
+        children = self.trie
+        for folder_name in parse_folder_path(folder_path):
+            if folder_name not in children:
+                if '.kmz' in folder_name.lower():
+                    folder_elem = etree.SubElement(current_elem, "{%s}Document" % self.nsmap['kml'])
+                else:
+                    folder_elem = etree.SubElement(current_elem, "{%s}Folder" % self.nsmap['kml'])
+                name_elem = etree.SubElement(folder_elem, "{%s}name" % self.nsmap['kml'])
+                name_elem.text = folder_name
+                children[folder_name] = (folder_elem, {})
+            current_elem, children = children[folder_name]
+
+        self.by_raw_path[folder_path] = current_elem
+        return current_elem
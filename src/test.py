@@ -1,17 +1,29 @@
 import zipfile
 import os
 from lxml import etree
-import ast
+import json
+import math
+import argparse
+from collections import Counter, namedtuple
+import hashlib
 import logging
 import shutil
 import glob
+import posixpath
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from urllib.parse import unquote
 from geopy.distance import geodesic  # Added for distance calculation
 import re  # For regular expressions
 import pyodbc  # For Microsoft SQL Server connection
+import numpy as np  # For vectorized line length computation
+from diagnostics import FEATURE_TRACE, LazyXml, add_logging_arguments, configure_logging
+from kml_common import (JSON_DATA_FORMAT, MEAN_EARTH_RADIUS, SPATIAL_COLUMNS, WGS84_A, WGS84_B, WGS84_F,
+                        decode_json_column, encode_json_column, parse_kml_coordinates)
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s:%(message)s')
-logging.disable(logging.CRITICAL)  # This will suppress all logging calls
+# Logging is configured in __main__ (--log-level, --trace-every); see diagnostics.py
 
 # Connection parameters for MS SQL Server
 server_name = 'sql_server,1433'  # Replace with your server name
@@ -19,18 +31,49 @@ database_name = 'your_database_name'  # Replace with your database name
 username = 'sa'  # Replace with your username
 password = 'YourStrong!Password'  # Replace with your password
 
-def init_db():
+# Ingest mode: stream features with iterparse instead of loading the whole tree
+streaming_ingest = True
+# Number of rows sent per executemany batch (and per commit) during ingest
+insert_batch_size = 1000
+# Batch ingest (--batch): bulk-insert connections shared by all parser processes, and how many
+# KMZs each parser process may run ahead of the inserters
+batch_insert_connections = 2
+batch_prefetch_per_worker = 1
+# Line length method: 'vincenty' (ellipsoidal, exact), 'haversine' (spherical, fast) or 'geopy' (reference)
+line_length_method = 'vincenty'
+
+# Columns added to every feature table for incremental ingest (see sync_source_rows) and
+# incremental export (row_version feeds the per-folder watermarks in db_to_kmz.py)
+INCREMENTAL_COLUMNS = {
+    'content_hash': 'CHAR(64)',
+    'source_file': 'NVARCHAR(260)',
+    'deleted_at': 'DATETIME2',
+    'row_version': 'ROWVERSION'
+}
+
+# geog is sent as WKT and converted server side; MakeValid repairs self-intersections and the like.
+# The conversion runs in its own UPDATE after the row is written (see fill_geography), so a
+# geometry SQL Server still rejects only leaves that row's geog NULL.
+GEOGRAPHY_FROM_WKT_SQL = "geography::STGeomFromText({}, 4326).MakeValid()"
+
+def connect_db(database=None, autocommit=False):
     """
-    Initializes the Microsoft SQL Server database with necessary tables and columns.
+    Opens a connection to the given database on the configured server (default: database_name).
     """
-    conn = pyodbc.connect('DRIVER={ODBC Driver 18 for SQL Server};'
+    return pyodbc.connect('DRIVER={ODBC Driver 18 for SQL Server};'
                           f'SERVER={server_name};'
-                          f'DATABASE=master;'
+                          f'DATABASE={database or database_name};'
                           f'UID={username};'
                           f'PWD={password};'
                           'Encrypt=no;',
-                          autocommit=True  # Enable autocommit mode
-                          )
+                          autocommit=autocommit)
+
+
+def init_db():
+    """
+    Initializes the Microsoft SQL Server database with necessary tables and columns.
+    """
+    conn = connect_db('master', autocommit=True)
     cursor = conn.cursor()
 
     # Check if the database exists
@@ -45,12 +88,7 @@ def init_db():
 
     # Now connect to the actual database
     conn.close()  # Close the connection to the master database
-    conn = pyodbc.connect('DRIVER={ODBC Driver 18 for SQL Server};'
-                          f'SERVER={server_name};'
-                          f'DATABASE={database_name};'
-                          f'UID={username};'
-                          f'PWD={password};'
-                          f'Encrypt=no;')
+    conn = connect_db()
     cursor = conn.cursor()
 
     # Create placemarks table if it does not exist
@@ -96,7 +134,17 @@ def init_db():
             address NVARCHAR(MAX),         -- New column for Address
             station_voltage NVARCHAR(MAX), -- New column for Station Voltage
             gln_x NVARCHAR(MAX),           -- New column for GLN X
-            gln_y NVARCHAR(MAX)            -- New column for GLN Y
+            gln_y NVARCHAR(MAX),           -- New column for GLN Y
+            geog GEOGRAPHY,                -- Geometry as SRID 4326 geography, spatially indexed
+            min_lat FLOAT,                 -- Bounding box of the geometry
+            max_lat FLOAT,
+            min_lon FLOAT,
+            max_lon FLOAT,
+            data_format INT,               -- Storage format of extended_data/attributes
+            content_hash CHAR(64),         -- SHA-256 of the stored feature values
+            source_file NVARCHAR(260),     -- KMZ file the row was ingested from
+            deleted_at DATETIME2,          -- Tombstone: set when the feature left its source file
+            row_version ROWVERSION         -- Bumped by SQL Server on every insert and update
         );
     END
     '''
@@ -121,13 +169,22 @@ def init_db():
         'address': 'NVARCHAR(MAX)',
         'station_voltage': 'NVARCHAR(MAX)',
         'gln_x': 'NVARCHAR(MAX)',
-        'gln_y': 'NVARCHAR(MAX)'
+        'gln_y': 'NVARCHAR(MAX)',
+        'data_format': 'INT',
+        **SPATIAL_COLUMNS
     }
     for column_name, column_type in new_columns.items():
         if column_name not in columns:
             cursor.execute(f"ALTER TABLE placemarks ADD {column_name} {column_type};")
             conn.commit()
 
+    # Spatial filters of regional exports (db_to_kmz.py --bbox / --within-km)
+    cursor.execute("IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'SIX_placemarks_geog') "
+                   "CREATE SPATIAL INDEX SIX_placemarks_geog ON placemarks (geog) USING GEOGRAPHY_AUTO_GRID;")
+    cursor.execute("IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_placemarks_bounds') "
+                   "CREATE INDEX IX_placemarks_bounds ON placemarks (min_lat, max_lat) INCLUDE (min_lon, max_lon);")
+    conn.commit()
+
     # Create groundoverlays table if it does not exist
     create_groundoverlays_table_sql = '''
     IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'groundoverlays')
@@ -147,7 +204,12 @@ def init_db():
             view_bound_scale FLOAT,  -- New column added here
             folder_hierarchy NVARCHAR(MAX),
             attributes NVARCHAR(MAX),
-            extended_data NVARCHAR(MAX)
+            extended_data NVARCHAR(MAX),
+            data_format INT,
+            content_hash CHAR(64),
+            source_file NVARCHAR(260),
+            deleted_at DATETIME2,
+            row_version ROWVERSION
         );
     END
     '''
@@ -163,6 +225,9 @@ def init_db():
     if 'extended_data' not in groundoverlay_columns:
         cursor.execute("ALTER TABLE groundoverlays ADD extended_data NVARCHAR(MAX);")
         conn.commit()
+    if 'data_format' not in groundoverlay_columns:
+        cursor.execute("ALTER TABLE groundoverlays ADD data_format INT;")
+        conn.commit()
 
     # Create networklinks table if it does not exist
     create_networklinks_table_sql = '''
@@ -184,7 +249,12 @@ def init_db():
             viewRefreshTime FLOAT,
             folder_hierarchy NVARCHAR(MAX),
             attributes NVARCHAR(MAX),
-            extended_data NVARCHAR(MAX)
+            extended_data NVARCHAR(MAX),
+            data_format INT,
+            content_hash CHAR(64),
+            source_file NVARCHAR(260),
+            deleted_at DATETIME2,
+            row_version ROWVERSION
         );
     END
     '''
@@ -197,287 +267,608 @@ def init_db():
     if 'extended_data' not in networklink_columns:
         cursor.execute("ALTER TABLE networklinks ADD extended_data NVARCHAR(MAX);")
         conn.commit()
+    if 'data_format' not in networklink_columns:
+        cursor.execute("ALTER TABLE networklinks ADD data_format INT;")
+        conn.commit()
+
+    # Incremental ingest/export bookkeeping, looked up by (source_file, content_hash)
+    for table in ('placemarks', 'groundoverlays', 'networklinks'):
+        cursor.execute("SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = ?", (table,))
+        table_columns = [row[0] for row in cursor.fetchall()]
+        for column_name, column_type in INCREMENTAL_COLUMNS.items():
+            if column_name not in table_columns:
+                cursor.execute(f"ALTER TABLE {table} ADD {column_name} {column_type};")
+                conn.commit()
+        cursor.execute(f"IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_{table}_source_hash') "
+                       f"CREATE INDEX IX_{table}_source_hash ON {table} (source_file, content_hash) INCLUDE (deleted_at);")
+        conn.commit()
 
     logging.info("Database initialized successfully.")
     return conn
 
-def extract_data_from_description(description):
+# Columns filled from placemark descriptions
+DESCRIPTION_FIELDS = (
+    'date_acq', 'voltage', 'cable', 'from_str', 'to_str', 'disp_condition', 'five_digit_code',
+    'county', 'address', 'station_voltage', 'gln_x', 'gln_y'
+)
+
+# Lower-cased description key -> column. Add entries here to recognise more spellings.
+DESCRIPTION_KEY_MAP = {
+    'date_acq': 'date_acq',
+    'date': 'date_acq',
+    'voltage': 'voltage',
+    'station voltage': 'voltage',
+    'cable': 'cable',
+    'conductor type': 'cable',  # Conductor Type is stored in cable
+    'from str.': 'from_str',
+    'to str.': 'to_str',
+    'disp. condition': 'disp_condition',
+    '5 digit code': 'five_digit_code',
+    'county': 'county',
+    'address': 'address',
+    'gln x': 'gln_x',
+    'gln y': 'gln_y'
+}
+
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
+HTML_TABLE_ROW_PATTERN = re.compile(r'<td>(.*?)</td>\s*<td>(.*?)</td>', re.DOTALL)
+# "Key: value", or a bare "Date 4/6/2023" line without a colon
+TEXT_LINE_PATTERN = re.compile(r'(.+?):\s*(.*)|(date|date_acq)\s+(\S+)', re.IGNORECASE)
+
+
+def extract_data_from_description(description, key_map=None):
     """
     Parses the description text and extracts specific data fields.
+    HTML descriptions are read from their <td>key</td><td>value</td> pairs, anything else
+    line by line as "key: value". key_map defaults to DESCRIPTION_KEY_MAP.
     """
-    data = {
-        'date_acq': None,
-        'voltage': None,
-        'cable': None,  # This will store Conductor Type
-        'from_str': None,
-        'to_str': None,
-        'disp_condition': None,
-        'five_digit_code': None,
-        'county': None,
-        'address': None,
-        'station_voltage': None,
-        'gln_x': None,
-        'gln_y': None
-    }
-
+    data = dict.fromkeys(DESCRIPTION_FIELDS)
     if description is None:
         return data
+    key_map = DESCRIPTION_KEY_MAP if key_map is None else key_map
 
-    # Remove HTML tags if present
-    description_text = re.sub(r'<[^>]+>', '', description)
-
-    # Split the description into lines
-    lines = description_text.splitlines()
-
-    # Check for HTML table format
     if '<td>' in description:
-        # Extract data from HTML table format
-        matches = re.findall(r'<td>(.*?)</td>\s*<td>(.*?)</td>', description, re.DOTALL)
-        for key, value in matches:
-            key = key.strip().lower()
-            value = value.strip()
-            if key in ['date_acq', 'date']:
-                data['date_acq'] = value
-            elif key in ['voltage', 'station voltage']:
-                data['voltage'] = value
-            elif key in ['cable', 'conductor type']:  # Added 'conductor type' mapping
-                data['cable'] = value
-            elif key == 'from str.':
-                data['from_str'] = value
-            elif key == 'to str.':
-                data['to_str'] = value
-            elif key == 'disp. condition':
-                data['disp_condition'] = value
-            elif key == '5 digit code':
-                data['five_digit_code'] = value
-            elif key == 'county':
-                data['county'] = value
-            elif key == 'address':
-                data['address'] = value
-            elif key == 'gln x':
-                data['gln_x'] = value
-            elif key == 'gln y':
-                data['gln_y'] = value
-            elif key == 'station voltage':
-                data['station_voltage'] = value
-    else:
-        # Extract data from plain text format
-        for line in lines:
-            line = line.strip()
-            if not line:
-                continue
-            # Use regex to extract key-value pairs
-            match = re.match(r'(.+?):\s*(.*)', line)
-            if match:
-                key, value = match.groups()
-                key = key.strip().lower()
-                value = value.strip()
-                if key in ['date_acq', 'date']:
-                    data['date_acq'] = value
-                elif key in ['voltage', 'station voltage']:
-                    data['voltage'] = value
-                elif key in ['cable', 'conductor type']:  # Added 'conductor type' mapping
-                    data['cable'] = value
-                elif key == 'from str.':
-                    data['from_str'] = value
-                elif key == 'to str.':
-                    data['to_str'] = value
-                elif key == 'disp. condition':
-                    data['disp_condition'] = value
-                elif key == '5 digit code':
-                    data['five_digit_code'] = value
-                elif key == 'county':
-                    data['county'] = value
-                elif key == 'address':
-                    data['address'] = value
-                elif key == 'gln x':
-                    data['gln_x'] = value
-                elif key == 'gln y':
-                    data['gln_y'] = value
-                elif key == 'station voltage':
-                    data['station_voltage'] = value
-            else:
-                # Handle cases where key and value are in the same line without colon
-                # For example: "Date 4/6/2023"
-                match = re.match(r'(date|date_acq)\s+(\S+)', line.lower())
-                if match:
-                    key, value = match.groups()
-                    data['date_acq'] = value.strip()
+        for key, value in HTML_TABLE_ROW_PATTERN.findall(description):
+            column = key_map.get(key.strip().lower())
+            if column:
+                data[column] = value.strip()
+        return data
+
+    for line in HTML_TAG_PATTERN.sub('', description).splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        match = TEXT_LINE_PATTERN.match(line)
+        if match is None:
+            continue
+        key, value, date_key, date_value = match.groups()
+        if key is not None:
+            column = key_map.get(key.strip().lower())
+            if column:
+                data[column] = value.strip()
+        else:
+            data['date_acq'] = date_value.lower()
 
     return data
 
 
-def insert_placemark(conn, placemark_data):
+PLACEMARK_ROW_COLUMNS = (
+    'name', 'description', 'coordinates', 'longitude', 'latitude', 'altitude', 'heading', 'tilt', 'range', 'altitude_mode',
+    'line_color', 'line_width', 'line_opacity', 'poly_color', 'poly_opacity', 'icon_href', 'icon_scale', 'icon_color',
+    'label_color', 'label_scale', 'extended_data', 'folder_hierarchy', 'attributes', 'geometry_type', 'geometry_xml', 'line_length',
+    'date_acq', 'voltage', 'cable', 'from_str', 'to_str', 'disp_condition', 'five_digit_code', 'county', 'address', 'station_voltage',
+    'gln_x', 'gln_y', 'geog', 'min_lat', 'max_lat', 'min_lon', 'max_lon', 'data_format', 'content_hash', 'source_file'
+)
+GROUNDOVERLAY_ROW_COLUMNS = (
+    'name', 'visibility', 'color', 'icon_href', 'coordinates', 'north', 'south', 'east', 'west', 'rotation', 'view_bound_scale',
+    'folder_hierarchy', 'attributes', 'extended_data', 'data_format', 'content_hash', 'source_file'
+)
+NETWORKLINK_ROW_COLUMNS = (
+    'name', 'visibility', 'longitude', 'latitude', 'altitude', 'heading', 'tilt', 'range', 'altitude_mode',
+    'href', 'viewRefreshMode', 'viewRefreshTime', 'folder_hierarchy', 'attributes', 'extended_data', 'data_format',
+    'content_hash', 'source_file'
+)
+
+
+# Placemark row tuples carry the geog WKT at this index; it is written by fill_geography, not
+# by the INSERT/MERGE, which take stored_values(table, row)
+PLACEMARK_GEOG_INDEX = PLACEMARK_ROW_COLUMNS.index('geog')
+
+
+def stored_values(table, row):
     """
-    Inserts a Placemark record into the database.
+    Returns the INSERT/MERGE parameters of a row tuple: all of it but a placemark's geog WKT.
     """
-    cursor = conn.cursor()
-    cleaned_coordinates = placemark_data['coordinates'].strip() if placemark_data['coordinates'] is not None else None
+    if table != 'placemarks':
+        return row
+    return row[:PLACEMARK_GEOG_INDEX] + row[PLACEMARK_GEOG_INDEX + 1:]
 
-    try:
-        cursor.execute('''
-            INSERT INTO placemarks (
-                name, description, coordinates, longitude, latitude, altitude, heading, tilt, range, altitude_mode,
-                line_color, line_width, line_opacity, poly_color, poly_opacity, icon_href, icon_scale, icon_color,
-                label_color, label_scale, extended_data, folder_hierarchy, attributes, geometry_type, geometry_xml, line_length,
-                date_acq, voltage, cable, from_str, to_str, disp_condition, five_digit_code, county, address, station_voltage, gln_x, gln_y
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            placemark_data.get('name'),
-            placemark_data.get('description'),
-            cleaned_coordinates,
-            placemark_data.get('longitude'),
-            placemark_data.get('latitude'),
-            placemark_data.get('altitude'),
-            placemark_data.get('heading'),
-            placemark_data.get('tilt'),
-            placemark_data.get('range'),
-            placemark_data.get('altitude_mode'),
-            placemark_data.get('line_color'),
-            placemark_data.get('line_width'),
-            placemark_data.get('line_opacity'),
-            placemark_data.get('poly_color'),
-            placemark_data.get('poly_opacity'),
-            placemark_data.get('icon_href'),
-            placemark_data.get('icon_scale'),
-            placemark_data.get('icon_color'),
-            placemark_data.get('label_color'),
-            placemark_data.get('label_scale'),
-            str(placemark_data.get('extended_data')),
-            ' > '.join(placemark_data['folder_hierarchy']) if placemark_data.get('folder_hierarchy') else None,
-            str(placemark_data.get('attributes')),
-            placemark_data.get('geometry_type'),
-            placemark_data.get('geometry_xml'),
-            placemark_data.get('line_length'),
-            placemark_data.get('date_acq'),
-            placemark_data.get('voltage'),
-            placemark_data.get('cable'),  # Conductor Type stored here
-            placemark_data.get('from_str'),
-            placemark_data.get('to_str'),
-            placemark_data.get('disp_condition'),
-            placemark_data.get('five_digit_code'),
-            placemark_data.get('county'),
-            placemark_data.get('address'),
-            placemark_data.get('station_voltage'),
-            placemark_data.get('gln_x'),
-            placemark_data.get('gln_y')
-        ))
 
-        conn.commit()
-        logging.debug(f"Inserted Placemark: {placemark_data.get('name')}")
-    except Exception as e:
-        logging.error(f"Failed to insert placemark '{placemark_data.get('name')}': {e}")
+def build_insert_sql(table, columns):
+    columns = [column for column in columns if column != 'geog']
+    return (f"INSERT INTO {table} ({', '.join(f'[{column}]' for column in columns)}) "
+            f"VALUES ({', '.join('?' for _ in columns)})")
+
 
-def insert_groundoverlay(conn, overlay_data):
+def build_merge_sql(table, columns):
+    """
+    Returns a MERGE that inserts one feature row unless the table already holds a row with the
+    same source_file and content_hash; such a row is only revived (its tombstone cleared).
     """
-    Inserts a GroundOverlay record into the database.
+    columns = [column for column in columns if column != 'geog']
+    return f'''
+MERGE {table} WITH (HOLDLOCK) AS target
+USING (SELECT {', '.join(f'? AS [{column}]' for column in columns)}) AS source
+ON target.source_file = source.source_file AND target.content_hash = source.content_hash
+WHEN MATCHED THEN
+    UPDATE SET deleted_at = NULL
+WHEN NOT MATCHED THEN
+    INSERT ({', '.join(f'[{column}]' for column in columns)})
+    VALUES ({', '.join(f'source.[{column}]' for column in columns)});
+'''
+
+
+INSERT_PLACEMARK_SQL = build_insert_sql('placemarks', PLACEMARK_ROW_COLUMNS)
+INSERT_GROUNDOVERLAY_SQL = build_insert_sql('groundoverlays', GROUNDOVERLAY_ROW_COLUMNS)
+INSERT_NETWORKLINK_SQL = build_insert_sql('networklinks', NETWORKLINK_ROW_COLUMNS)
+
+# Incremental ingest (see sync_source_rows)
+MERGE_FEATURE_SQL = {
+    'placemarks': build_merge_sql('placemarks', PLACEMARK_ROW_COLUMNS),
+    'groundoverlays': build_merge_sql('groundoverlays', GROUNDOVERLAY_ROW_COLUMNS),
+    'networklinks': build_merge_sql('networklinks', NETWORKLINK_ROW_COLUMNS)
+}
+SELECT_SOURCE_HASHES_SQL = "SELECT content_hash, deleted_at FROM {table} WHERE source_file = ?"
+TOMBSTONE_FEATURE_SQL = ("UPDATE {table} SET deleted_at = SYSUTCDATETIME() "
+                         "WHERE source_file = ? AND content_hash = ? AND deleted_at IS NULL")
+# Placemarks are addressed by (source_file, content_hash), unique within a source; rows without
+# a source_file by content_hash alone, which is safe because equal hashes mean equal geometry
+FILL_GEOGRAPHY_SQL = (f"UPDATE placemarks SET geog = {GEOGRAPHY_FROM_WKT_SQL.format('?')} "
+                      "WHERE source_file = ? AND content_hash = ? AND geog IS NULL")
+FILL_UNSOURCED_GEOGRAPHY_SQL = (f"UPDATE placemarks SET geog = {GEOGRAPHY_FROM_WKT_SQL.format('?')} "
+                                "WHERE source_file IS NULL AND content_hash = ? AND geog IS NULL")
+
+
+def execute_geography_updates(conn, sql, params):
     """
+    Runs a geog UPDATE (params rows start with the WKT) with one executemany. If SQL Server
+    rejects any geometry, e.g. one with an edge between antipodal points, the batch is rolled
+    back and retried row by row, so only the offending rows keep geog NULL. Returns the number
+    of rows that failed.
+    """
+    if not params:
+        return 0
     cursor = conn.cursor()
-
+    cursor.fast_executemany = True
     try:
-        cursor.execute('''
-            INSERT INTO groundoverlays (
-                name, visibility, color, icon_href, coordinates, north, south, east, west, rotation, view_bound_scale, folder_hierarchy, attributes, extended_data
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            overlay_data['name'],
-            overlay_data['visibility'],
-            overlay_data['color'],
-            overlay_data['icon_href'],
-            overlay_data['coordinates'],  # Store LatLonQuad coordinates here if available
-            overlay_data['north'],  # Store LatLonBox values
-            overlay_data['south'],
-            overlay_data['east'],
-            overlay_data['west'],
-            overlay_data['rotation'],  # New field inserted here
-            overlay_data['view_bound_scale'],  # New field inserted here
-            ' > '.join(overlay_data['folder_hierarchy']) if overlay_data['folder_hierarchy'] else None,
-            str(overlay_data['attributes']),
-            str(overlay_data['extended_data'])  # Store extended_data as string
-        ))
-        conn.commit()
-        logging.debug(f"Inserted GroundOverlay: {overlay_data['name']}")
-    except Exception as e:
-        logging.error(f"Failed to insert GroundOverlay '{overlay_data['name']}': {e}")
+        try:
+            cursor.executemany(sql, params)
+            conn.commit()
+            return 0
+        except Exception as e:
+            conn.rollback()
+            logging.warning(f"Geography update of {len(params)} placemarks failed, retrying row by row: {e}")
+        failed = 0
+        for row in params:
+            try:
+                cursor.execute(sql, row)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                failed += 1
+                logging.warning(f"Leaving geog NULL for placemark {row[1:]}: {e}")
+        return failed
+    finally:
+        cursor.close()
+
+
+def fill_geography(conn, rows):
+    """
+    Sets geog on placemark rows that were just written from their row tuples, leaving it NULL
+    where the WKT is missing or rejected. Returns the number of rows whose WKT was rejected.
+    """
+    sourced, unsourced = [], []
+    for row in rows:
+        wkt, content_hash, source_file = row[PLACEMARK_GEOG_INDEX], row[-2], row[-1]
+        if wkt is None:
+            continue
+        if source_file is None:
+            unsourced.append((wkt, content_hash))
+        else:
+            sourced.append((wkt, source_file, content_hash))
+    return (execute_geography_updates(conn, FILL_GEOGRAPHY_SQL, sourced)
+            + execute_geography_updates(conn, FILL_UNSOURCED_GEOGRAPHY_SQL, unsourced))
 
-def insert_networklink(conn, networklink_data):
+
+def with_row_metadata(values, source_file=None, derived=()):
     """
-    Inserts a NetworkLink record into the database.
+    Appends data_format, content_hash and source_file to a feature's stored values. The hash is
+    the SHA-256 of every stored value (name, geometry, style, folder path, description, ...), so
+    it is stable across runs and any edit to the feature changes it. derived values (the spatial
+    columns, computed from the hashed geometry) are stored before the metadata but not hashed,
+    so rows ingested before they existed keep their hashes.
     """
-    cursor = conn.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO networklinks (
-                name, visibility, longitude, latitude, altitude, heading, tilt, range, altitude_mode,
-                href, viewRefreshMode, viewRefreshTime, folder_hierarchy, attributes, extended_data
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            networklink_data['name'],
-            networklink_data['visibility'],
-            networklink_data['longitude'],
-            networklink_data['latitude'],
-            networklink_data['altitude'],
-            networklink_data['heading'],
-            networklink_data['tilt'],
-            networklink_data['range'],
-            networklink_data['altitude_mode'],
-            networklink_data['href'],  # Correctly extract href from either Link or Url
-            networklink_data['viewRefreshMode'],  # Correctly extract viewRefreshMode
-            networklink_data['viewRefreshTime'],  # Correctly extract viewRefreshTime
-            ' > '.join(networklink_data['folder_hierarchy']) if networklink_data['folder_hierarchy'] else None,
-            str(networklink_data.get('attributes')),
-            str(networklink_data.get('extended_data'))  # Optional
-        ))
-        conn.commit()
-        logging.debug(f"Inserted NetworkLink: {networklink_data['name']}")
-    except Exception as e:
-        logging.error(f"Failed to insert NetworkLink '{networklink_data['name']}': {e}")
+    content_hash = hashlib.sha256(json.dumps(values, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+    return values + tuple(derived) + (JSON_DATA_FORMAT, content_hash, source_file)
 
 
-def extract_kml_from_kmz(kmz_file, extract_path):
+def number_duplicate_hash(row, occurrences):
     """
-    Extracts the KML file from a KMZ archive.
+    Returns row with a content_hash that is unique within one source. Identical features in the
+    same file would share a hash, so the 2nd, 3rd ... copy is keyed by the hash of
+    "<hash>:<occurrence>" instead; re-ingesting the same file reproduces them. occurrences is
+    the Counter of hashes seen so far in the source and is updated.
     """
-    if not os.path.exists(extract_path):
-        os.makedirs(extract_path)
+    content_hash = row[-2]
+    occurrence = occurrences[content_hash]
+    occurrences[content_hash] += 1
+    if not occurrence:
+        return row
+    content_hash = hashlib.sha256(f"{content_hash}:{occurrence}".encode('ascii')).hexdigest()
+    occurrences[content_hash] += 1
+    return row[:-2] + (content_hash, row[-1])
+
+
+def placemark_row(placemark_data, source_file=None):
+    """
+    Builds the INSERT parameter tuple (PLACEMARK_ROW_COLUMNS) for a Placemark record.
+    """
+    cleaned_coordinates = placemark_data['coordinates'].strip() if placemark_data['coordinates'] is not None else None
+    return with_row_metadata((
+        placemark_data.get('name'),
+        placemark_data.get('description'),
+        cleaned_coordinates,
+        placemark_data.get('longitude'),
+        placemark_data.get('latitude'),
+        placemark_data.get('altitude'),
+        placemark_data.get('heading'),
+        placemark_data.get('tilt'),
+        placemark_data.get('range'),
+        placemark_data.get('altitude_mode'),
+        placemark_data.get('line_color'),
+        placemark_data.get('line_width'),
+        placemark_data.get('line_opacity'),
+        placemark_data.get('poly_color'),
+        placemark_data.get('poly_opacity'),
+        placemark_data.get('icon_href'),
+        placemark_data.get('icon_scale'),
+        placemark_data.get('icon_color'),
+        placemark_data.get('label_color'),
+        placemark_data.get('label_scale'),
+        encode_json_column(placemark_data.get('extended_data')),
+        ' > '.join(placemark_data['folder_hierarchy']) if placemark_data.get('folder_hierarchy') else None,
+        encode_json_column(placemark_data.get('attributes')),
+        placemark_data.get('geometry_type'),
+        placemark_data.get('geometry_xml'),
+        placemark_data.get('line_length'),
+        placemark_data.get('date_acq'),
+        placemark_data.get('voltage'),
+        placemark_data.get('cable'),  # Conductor Type stored here
+        placemark_data.get('from_str'),
+        placemark_data.get('to_str'),
+        placemark_data.get('disp_condition'),
+        placemark_data.get('five_digit_code'),
+        placemark_data.get('county'),
+        placemark_data.get('address'),
+        placemark_data.get('station_voltage'),
+        placemark_data.get('gln_x'),
+        placemark_data.get('gln_y')
+    ), source_file, (
+        placemark_data.get('geography_wkt'),
+        placemark_data.get('min_lat'),
+        placemark_data.get('max_lat'),
+        placemark_data.get('min_lon'),
+        placemark_data.get('max_lon')
+    ))
+
+
+def groundoverlay_row(overlay_data, source_file=None):
+    """
+    Builds the INSERT parameter tuple (GROUNDOVERLAY_ROW_COLUMNS) for a GroundOverlay record.
+    """
+    return with_row_metadata((
+        overlay_data['name'],
+        overlay_data['visibility'],
+        overlay_data['color'],
+        overlay_data['icon_href'],
+        overlay_data['coordinates'],  # Store LatLonQuad coordinates here if available
+        overlay_data['north'],  # Store LatLonBox values
+        overlay_data['south'],
+        overlay_data['east'],
+        overlay_data['west'],
+        overlay_data['rotation'],  # New field inserted here
+        overlay_data['view_bound_scale'],  # New field inserted here
+        ' > '.join(overlay_data['folder_hierarchy']) if overlay_data['folder_hierarchy'] else None,
+        encode_json_column(overlay_data['attributes']),
+        encode_json_column(overlay_data['extended_data'])
+    ), source_file)
+
+
+def networklink_row(networklink_data, source_file=None):
+    """
+    Builds the INSERT parameter tuple (NETWORKLINK_ROW_COLUMNS) for a NetworkLink record.
+    """
+    return with_row_metadata((
+        networklink_data['name'],
+        networklink_data['visibility'],
+        networklink_data['longitude'],
+        networklink_data['latitude'],
+        networklink_data['altitude'],
+        networklink_data['heading'],
+        networklink_data['tilt'],
+        networklink_data['range'],
+        networklink_data['altitude_mode'],
+        networklink_data['href'],  # Correctly extract href from either Link or Url
+        networklink_data['viewRefreshMode'],  # Correctly extract viewRefreshMode
+        networklink_data['viewRefreshTime'],  # Correctly extract viewRefreshTime
+        ' > '.join(networklink_data['folder_hierarchy']) if networklink_data['folder_hierarchy'] else None,
+        encode_json_column(networklink_data.get('attributes')),
+        encode_json_column(networklink_data.get('extended_data'))  # Optional
+    ), source_file)
+
+
+class BulkLoader:
+    """
+    Collects Placemark, GroundOverlay and NetworkLink rows and writes them in batches with
+    executemany (fast_executemany enabled), committing once per batch. If a batch fails it is
+    rolled back and retried row by row so the offending rows are logged and skipped. Placemark
+    geog values are filled after their rows are committed (fill_geography).
+    source_file (the KMZ file name) is stored with every row, and duplicate features get
+    occurrence-numbered content hashes (number_duplicate_hash) as in incremental ingest.
+    """
+
+    def __init__(self, conn, batch_size=1000, source_file=None):
+        self.conn = conn
+        self.batch_size = max(1, batch_size)
+        self.source_file = source_file
+        self.pending = {
+            'placemarks': [],
+            'groundoverlays': [],
+            'networklinks': []
+        }
+        self.sql = {
+            'placemarks': INSERT_PLACEMARK_SQL,
+            'groundoverlays': INSERT_GROUNDOVERLAY_SQL,
+            'networklinks': INSERT_NETWORKLINK_SQL
+        }
+        self.inserted = {table: 0 for table in self.pending}
+        self.failed = {table: 0 for table in self.pending}
+        self.hash_occurrences = {table: Counter() for table in self.pending}
+
+    def add_placemark(self, placemark_data):
+        self._add_feature('placemarks', placemark_data.get('name'), placemark_row(placemark_data, self.source_file))
+
+    def add_groundoverlay(self, overlay_data):
+        self._add_feature('groundoverlays', overlay_data['name'], groundoverlay_row(overlay_data, self.source_file))
+
+    def add_networklink(self, networklink_data):
+        self._add_feature('networklinks', networklink_data['name'],
+                          networklink_row(networklink_data, self.source_file))
+
+    def _add_feature(self, table, name, row):
+        self._add(table, name, number_duplicate_hash(row, self.hash_occurrences[table]))
+
+    def add_rows(self, table, rows):
+        """
+        Queues already built (name, row) pairs for table, e.g. rows collected by a RowCollector.
+        """
+        for name, row in rows:
+            self._add(table, name, row)
+
+    def _add(self, table, name, row):
+        rows = self.pending[table]
+        rows.append((name, row))
+        if len(rows) >= self.batch_size:
+            self._flush_table(table)
+
+    def flush(self):
+        """
+        Writes all pending rows for every table.
+        """
+        for table in self.pending:
+            self._flush_table(table)
+
+    def _flush_table(self, table):
+        rows = self.pending[table]
+        if not rows:
+            return
+        self.pending[table] = []
+
+        cursor = self.conn.cursor()
+        cursor.fast_executemany = True
+        try:
+            cursor.executemany(self.sql[table], [stored_values(table, row) for _, row in rows])
+            self.conn.commit()
+            self.inserted[table] += len(rows)
+            logging.debug("Inserted batch of %d rows into %s", len(rows), table)
+        except Exception as e:
+            logging.warning(f"Batch insert of {len(rows)} rows into {table} failed, retrying row by row: {e}")
+            self.conn.rollback()
+            rows = self._insert_rows_individually(table, rows)
+        finally:
+            cursor.close()
+        if table == 'placemarks':
+            fill_geography(self.conn, [row for _, row in rows])
+
+    def _insert_rows_individually(self, table, rows):
+        """
+        Inserts rows one at a time, logging and skipping the ones that fail. Returns the rows
+        that were inserted.
+        """
+        inserted = []
+        cursor = self.conn.cursor()
+        try:
+            for name, row in rows:
+                try:
+                    cursor.execute(self.sql[table], stored_values(table, row))
+                    self.conn.commit()
+                    self.inserted[table] += 1
+                    inserted.append((name, row))
+                except Exception as e:
+                    self.conn.rollback()
+                    self.failed[table] += 1
+                    logging.error(f"Failed to insert row '{name}' into {table}: {e}")
+        finally:
+            cursor.close()
+        return inserted
+
+
+class RowCollector(BulkLoader):
+    """
+    BulkLoader that keeps the built rows in memory (rows[table], as (name, row) pairs) instead of
+    writing them, so batch-ingest workers can parse without a connection and hand rows back.
+    """
+
+    def __init__(self, source_file=None):
+        super().__init__(None, source_file=source_file)
+        self.rows = {table: [] for table in self.pending}
+
+    def _flush_table(self, table):
+        self.rows[table].extend(self.pending[table])
+        self.pending[table] = []
 
-    with zipfile.ZipFile(kmz_file, 'r') as z:
-        z.extractall(extract_path)
 
-        for file in z.namelist():
-            if file.endswith('doc.kml') or file.endswith('.kml'):
-                return os.path.join(extract_path, file)
-    return None
+KML_NAMESPACE_DECLARATION = b' xmlns="http://www.opengis.net/kml/2.2"'
+XSI_NAMESPACE_DECLARATION = b' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+KML_ROOT_TAG_PATTERN = re.compile(rb'<kml(?=[\s>/])[^>]*>')
+DEFAULT_NAMESPACE_PATTERN = re.compile(rb'\sxmlns\s*=')
+XSI_NAMESPACE_PATTERN = re.compile(rb'\sxmlns:xsi\s*=')
+KML_HEAD_MAX_BYTES = 64 * 1024  # give up looking for the root <kml> tag after this much input
+# src/href attributes in description HTML, e.g. <img src="files/photo.jpg">
+DESCRIPTION_LINK_PATTERN = re.compile(r'''(?:src|href)\s*=\s*["']([^"']+)["']''', re.IGNORECASE)
 
 
-def fix_kml_namespace(kml_file):
+class NamespaceFixingReader:
     """
-    Ensures that the KML file has the correct namespaces.
+    Binary read-only stream over a KML document that adds the standard KML and xsi namespace
+    declarations to the root <kml> tag when they are missing, so lxml sees the features in the
+    KML namespace. Only the bytes up to the end of the root start tag are buffered; everything
+    after it is passed through from raw unchanged. Closing the reader closes raw.
     """
-    with open(kml_file, 'r', encoding='utf-8') as file:
-        kml_content = file.read()
 
-    # Check if the <kml> tag has the standard KML namespace
-    if 'xmlns="http://www.opengis.net/kml/2.2"' not in kml_content:
-        # Add the standard KML namespace
-        kml_content = kml_content.replace(
-            '<kml',
-            '<kml xmlns="http://www.opengis.net/kml/2.2"'
-        )
+    def __init__(self, raw):
+        self.raw = raw
+        self.name = getattr(raw, 'name', None)
+        self.head = None  # fixed-up prolog not yet returned by read()
+
+    def _read_head(self):
+        head = b''
+        while len(head) < KML_HEAD_MAX_BYTES:
+            chunk = self.raw.read(4096)
+            if not chunk:
+                break
+            head += chunk
+            match = KML_ROOT_TAG_PATTERN.search(head)
+            if match:
+                root_tag = match.group()
+                declarations = b''
+                if not DEFAULT_NAMESPACE_PATTERN.search(root_tag):
+                    declarations += KML_NAMESPACE_DECLARATION
+                if not XSI_NAMESPACE_PATTERN.search(root_tag):
+                    declarations += XSI_NAMESPACE_DECLARATION
+                if declarations:
+                    insert_at = match.start() + len(b'<kml')
+                    head = head[:insert_at] + declarations + head[insert_at:]
+                    logging.debug("Added missing KML namespace declarations to: %s", self.name)
+                break
+        return head
+
+    def read(self, size=-1):
+        if self.head is None:
+            self.head = self._read_head()
+        if not self.head:
+            return self.raw.read(size)
+        if size is None or size < 0:
+            data, self.head = self.head + self.raw.read(), b''
+        else:
+            data, self.head = self.head[:size], self.head[size:]
+        return data
+
+    def close(self):
+        self.raw.close()
+
+
+def open_kml_stream(kml_file):
+    """
+    Returns a NamespaceFixingReader over a KML path or an already opened binary file object.
+    """
+    if hasattr(kml_file, 'read'):
+        return NamespaceFixingReader(kml_file)
+    return NamespaceFixingReader(open(kml_file, 'rb'))
 
-    # Check if the 'xmlns:xsi' is present, add it if missing
-    if 'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"' not in kml_content:
-        kml_content = kml_content.replace(
-            '<kml ',
-            '<kml xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
-        )
 
-    corrected_kml_file_path = os.path.join(os.path.dirname(kml_file), 'corrected_doc.kml')
-    with open(corrected_kml_file_path, 'w', encoding='utf-8') as file:
-        file.write(kml_content)
+class KmzArchive:
+    """
+    Read access to a KMZ for ingest. The KML member is streamed straight out of the archive
+    (open_kml) and other members are extracted under extract_path only when a feature
+    references them (extract_references), so resources the document never uses are not written.
+    """
 
-    logging.info(f"Fixed KML namespace and saved to: {corrected_kml_file_path}")
-    return corrected_kml_file_path
+    def __init__(self, kmz_file, extract_path):
+        self.zip = zipfile.ZipFile(kmz_file, 'r')
+        self.extract_path = extract_path
+        self.members = set(self.zip.namelist())
+        # The first .kml in the archive is the document, as in Google Earth
+        self.kml_member = next((name for name in self.zip.namelist() if name.endswith('.kml')), None)
+        self.base_dir = posixpath.dirname(self.kml_member) if self.kml_member else ''
+        self.extracted = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def open_kml(self):
+        """
+        Returns a namespace-fixing stream of the KML member, decompressed as it is read.
+        """
+        return NamespaceFixingReader(self.zip.open(self.kml_member))
+
+    def member_for(self, href):
+        """
+        Returns the archive member a relative href points to, or None for URLs and missing files.
+        """
+        if not href or '://' in href or href.startswith(('#', 'data:', 'mailto:')):
+            return None
+        path = posixpath.normpath(posixpath.join(self.base_dir, unquote(href.strip())))
+        if path.startswith(('../', '/')) or path not in self.members:
+            return None
+        return path
+
+    def extract_reference(self, href):
+        """
+        Extracts the member href points to (once) and returns its path on disk, or None.
+        The file is written under a temporary name and renamed into place, so concurrent
+        ingests extracting the same resource path never leave a partial file.
+        """
+        member = self.member_for(href)
+        if member is None:
+            return None
+        path = os.path.join(self.extract_path, *member.split('/'))
+        if member not in self.extracted:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with self.zip.open(member) as source, open(tmp_path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.replace(tmp_path, path)
+            self.extracted.add(member)
+            logging.debug("Extracted referenced KMZ member: %s", member)
+        return path
+
+    def extract_references(self, feature_data):
+        """
+        Extracts every archive member a feature's icon, link and description HTML refer to.
+        """
+        for key in ('icon_href', 'href'):
+            self.extract_reference(feature_data.get(key))
+        description = feature_data.get('description')
+        if description:
+            for href in DESCRIPTION_LINK_PATTERN.findall(description):
+                self.extract_reference(href)
 
 
 def parse_styles_and_maps(root, ns):
@@ -501,285 +892,512 @@ def parse_styles_and_maps(root, ns):
 
 
 
-def extract_lookat(element, ns):
+KML = '{http://www.opengis.net/kml/2.2}'
+GX = '{http://www.google.com/kml/ext/2.2}'
+
+LOOKAT_TAGS = (KML + 'longitude', KML + 'latitude', KML + 'altitude', KML + 'heading', KML + 'tilt',
+               KML + 'range', GX + 'altitudeMode')
+# Descendants of a Placemark that extract_placemark_details looks for
+PLACEMARK_DESCENDANT_TAGS = (KML + 'MultiGeometry', KML + 'Point', KML + 'LineString', KML + 'Polygon',
+                             KML + 'coordinates', GX + 'drawOrder')
+
+
+def child_elements(element):
+    """
+    Walks the direct children of element once and maps each tag to its first child element,
+    so every field can be read with a dict lookup instead of a find().
+    """
+    children = {}
+    for child in element.iterchildren():
+        if child.tag not in children:
+            children[child.tag] = child
+    return children
+
+
+def first_descendants(element, tags):
+    """
+    Maps each of tags to the first descendant of element with that tag, in one filtered walk.
+    Keys are inserted in document order.
+    """
+    found = {}
+    for descendant in element.iterdescendants(*tags):
+        if descendant.tag not in found:
+            found[descendant.tag] = descendant
+            if len(found) == len(tags):
+                break
+    return found
+
+
+def text_of(element):
+    return element.text if element is not None else None
+
+
+def extract_extended_data(extended_data_element):
+    """
+    Reads <Data name="..."><value>...</value></Data> children of an <ExtendedData> into a dict.
+    """
+    extended_data = {}
+    if extended_data_element is not None:
+        for data_field in extended_data_element.iterchildren(KML + 'Data'):
+            extended_data[data_field.get('name')] = text_of(child_elements(data_field).get(KML + 'value'))
+    return extended_data
+
+
+def extract_lookat(element, ns, children=None):
     """
     Extracts LookAt information from a Placemark or NetworkLink.
+    children is the element's child_elements() map if the caller already has it.
     """
-    lookat = element.find('kml:LookAt', ns)
-    if lookat is not None:
-        longitude = lookat.find('kml:longitude', ns).text if lookat.find('kml:longitude', ns) is not None else None
-        latitude = lookat.find('kml:latitude', ns).text if lookat.find('kml:latitude', ns) is not None else None
-        altitude = lookat.find('kml:altitude', ns).text if lookat.find('kml:altitude', ns) is not None else None
-        heading = lookat.find('kml:heading', ns).text if lookat.find('kml:heading', ns) is not None else None
-        tilt = lookat.find('kml:tilt', ns).text if lookat.find('kml:tilt', ns) is not None else None
-        range_val = lookat.find('kml:range', ns).text if lookat.find('kml:range', ns) is not None else None
-        altitude_mode = lookat.find('gx:altitudeMode', ns).text if lookat.find('gx:altitudeMode', ns) is not None else None
-    else:
-        longitude = latitude = altitude = heading = tilt = range_val = altitude_mode = None
+    if children is None:
+        children = child_elements(element)
+    lookat = children.get(KML + 'LookAt')
+    if lookat is None:
+        return (None,) * len(LOOKAT_TAGS)
+    fields = child_elements(lookat)
+    return tuple(text_of(fields.get(tag)) for tag in LOOKAT_TAGS)
+
+
+# Stands in for an IconStyle child element that is absent (as opposed to present but empty)
+MISSING = object()
 
-    return longitude, latitude, altitude, heading, tilt, range_val, altitude_mode
+# Flattened <Style>: the values extract_style_info needs, read once per style.
+# has_* flags record which sub-styles exist; icon_* fields are MISSING when the element is absent.
+StyleRecord = namedtuple('StyleRecord', [
+    'has_line_style', 'color', 'width',
+    'has_poly_style', 'poly_color',
+    'has_icon_style', 'icon_scale', 'icon_href', 'icon_color',
+    'has_label_style', 'label_color'
+])
 
 
-def extract_style_info(placemark, ns, styles, style_maps, use_highlight):
+def flatten_style(style, ns):
+    """
+    Reads a <Style> element into a StyleRecord, finding each element once.
+    """
+    def child_text(parent, path, absent=None):
+        if parent is None:
+            return absent
+        child = parent.find(path, ns)
+        return child.text if child is not None else absent
+
+    line_style = style.find('.//kml:LineStyle', ns)
+    poly_style = style.find('.//kml:PolyStyle', ns)
+    icon_style = style.find('.//kml:IconStyle', ns)
+    label_style = style.find('.//kml:LabelStyle', ns)
+    return StyleRecord(
+        line_style is not None, child_text(line_style, 'kml:color'), child_text(line_style, 'kml:width'),
+        poly_style is not None, child_text(poly_style, 'kml:color'),
+        icon_style is not None, child_text(icon_style, 'kml:scale', MISSING),
+        child_text(icon_style, './/kml:Icon/kml:href', MISSING), child_text(icon_style, 'kml:color', MISSING),
+        label_style is not None, child_text(label_style, 'kml:color')
+    )
+
+
+class StyleResolver:
+    """
+    Resolves styleUrl references to flattened StyleRecords. Every <Style> is flattened once
+    when added, each <StyleMap> is reduced to a key -> style id table, and the StyleMap chain
+    for each (style id, highlight) is memoised, so resolving a shared style costs two dict hits
+    however many placemarks use it.
+    """
+
+    def __init__(self, styles, style_maps, ns):
+        self.ns = ns
+        self.records = {}
+        self.style_map_pairs = {}
+        self.chains = {}
+        for style_id, style in styles.items():
+            self.add_style(style_id, style)
+        for style_map_id, style_map in style_maps.items():
+            self.add_style_map(style_map_id, style_map)
+
+    def add_style(self, style_id, style):
+        self.records[style_id] = flatten_style(style, self.ns)
+
+    def add_style_map(self, style_map_id, style_map):
+        pairs = {}
+        for pair in style_map.iterfind('.//kml:Pair', self.ns):
+            key = pair.findtext('kml:key', namespaces=self.ns)
+            style_url = pair.findtext('kml:styleUrl', namespaces=self.ns)
+            if style_url is not None and key not in pairs:
+                pairs[key] = style_url.lstrip('#')
+        self.style_map_pairs[style_map_id] = pairs
+        self.chains.clear()
+
+    def resolve(self, style_ref, use_highlight):
+        """
+        Follows StyleMaps from style_ref and returns the StyleRecord it ends at, or None.
+        """
+        chain_key = (style_ref, use_highlight)
+        resolved_ref = self.chains.get(chain_key)
+        if resolved_ref is None:
+            key = 'highlight' if use_highlight else 'normal'
+            resolved_ref = style_ref
+            seen = set()
+            while resolved_ref in self.style_map_pairs and resolved_ref not in seen:
+                seen.add(resolved_ref)
+                next_ref = self.style_map_pairs[resolved_ref].get(key)
+                if next_ref is None:
+                    break
+                resolved_ref = next_ref
+            self.chains[chain_key] = resolved_ref
+        return self.records.get(resolved_ref)
+
+
+def alpha_percent(color):
+    """
+    Opacity in percent encoded by the alpha byte of an aabbggrr KML colour.
+    """
+    alpha_hex = color[:2]
+    alpha_decimal = int(alpha_hex, 16)
+    return (alpha_decimal / 255) * 100
+
+
+def extract_style_info(placemark, ns, style_resolver, use_highlight, children=None):
     """
     Extracts style information from a Placemark, handling both inline <Style> and <styleUrl>.
+    Shared styles are looked up through style_resolver.
     """
-    color, width, poly_color, poly_opacity, line_opacity = None, None, None, None, None
-    icon_color, label_color = None, None
-    icon_href, icon_scale = None, None
+    if children is None:
+        children = child_elements(placemark)
+    color, width, poly_color, label_color = None, None, None, None
+    icon_href, icon_scale, icon_color = None, None, None
 
     # First, handle inline <Style>
-    inline_style = placemark.find('kml:Style', ns)
+    inline_style = children.get(KML + 'Style')
     if inline_style is not None:
-        # Extract LineStyle
-        line_style = inline_style.find('.//kml:LineStyle', ns)
-        if line_style is not None:
-            color = line_style.find('kml:color', ns).text if line_style.find('kml:color', ns) is not None else None
-            width = line_style.find('kml:width', ns).text if line_style.find('kml:width', ns) is not None else None
-
-        # Extract PolyStyle
-        poly_style = inline_style.find('.//kml:PolyStyle', ns)
-        if poly_style is not None:
-            poly_color = poly_style.find('kml:color', ns).text if poly_style.find('kml:color', ns) is not None else None
-
-        # Extract IconStyle
-        icon_style = inline_style.find('.//kml:IconStyle', ns)
-        if icon_style is not None:
-            icon_scale = icon_style.find('kml:scale', ns).text if icon_style.find('kml:scale', ns) is not None else None
-            icon_href = icon_style.find('.//kml:Icon/kml:href', ns).text if icon_style.find('.//kml:Icon/kml:href', ns) is not None else None
-            icon_color = icon_style.find('kml:color', ns).text if icon_style.find('kml:color', ns) is not None else None
-
-        # Extract LabelStyle
-        label_style = inline_style.find('.//kml:LabelStyle', ns)
-        if label_style is not None:
-            label_color = label_style.find('kml:color', ns).text if label_style.find('kml:color', ns) is not None else None
-
-        # Calculate opacity from color
-        if color:
-            alpha_hex = color[:2]
-            alpha_decimal = int(alpha_hex, 16)
-            line_opacity = (alpha_decimal / 255) * 100
-
-        if poly_color:
-            alpha_hex = poly_color[:2]
-            alpha_decimal = int(alpha_hex, 16)
-            poly_opacity = (alpha_decimal / 255) * 100
+        inline = flatten_style(inline_style, ns)
+        color, width, poly_color, label_color = inline.color, inline.width, inline.poly_color, inline.label_color
+        icon_scale, icon_href, icon_color = (None if value is MISSING else value
+                                             for value in (inline.icon_scale, inline.icon_href, inline.icon_color))
 
     # Now, handle <styleUrl>
-    style_url = placemark.find('kml:styleUrl', ns)
-    if style_url is not None:
-        style_ref = style_url.text.lstrip('#')
-
-        def resolve_style(style_ref_inner, is_highlight_inner):
-            if style_ref_inner in style_maps:
-                key = 'highlight' if is_highlight_inner else 'normal'
-                style_pair = style_maps[style_ref_inner].find(f".//kml:Pair[kml:key='{key}']", ns)
-                if style_pair is not None:
-                    style_ref_resolved = style_pair.find('kml:styleUrl', ns).text.lstrip('#')
-                    return resolve_style(style_ref_resolved, is_highlight_inner)
-            return style_ref_inner
-
-        resolved_style_ref = resolve_style(style_ref, use_highlight)
-        if resolved_style_ref in styles:
-            resolved_style = styles[resolved_style_ref]
-
-            # Extract LineStyle
-            line_style = resolved_style.find('.//kml:LineStyle', ns)
-            if line_style is not None and color is None and width is None:
-                color = line_style.find('kml:color', ns).text if line_style.find('kml:color', ns) is not None else None
-                width = line_style.find('kml:width', ns).text if line_style.find('kml:width', ns) is not None else None
-
-            # Extract PolyStyle
-            poly_style = resolved_style.find('.//kml:PolyStyle', ns)
-            if poly_style is not None and poly_color is None:
-                poly_color = poly_style.find('kml:color', ns).text if poly_style.find('kml:color', ns) is not None else None
-
-            # Extract IconStyle
-            icon_style = resolved_style.find('.//kml:IconStyle', ns)
-            if icon_style is not None and (icon_href is None or icon_scale is None or icon_color is None):
-                icon_scale = icon_style.find('kml:scale', ns).text if icon_style.find('kml:scale', ns) is not None else icon_scale
-                icon_href = icon_style.find('.//kml:Icon/kml:href', ns).text if icon_style.find('.//kml:Icon/kml:href', ns) is not None else icon_href
-                icon_color = icon_style.find('kml:color', ns).text if icon_style.find('kml:color', ns) is not None else icon_color
-
-            # Extract LabelStyle
-            label_style = resolved_style.find('.//kml:LabelStyle', ns)
-            if label_style is not None and label_color is None:
-                label_color = label_style.find('kml:color', ns).text if label_style.find('kml:color', ns) is not None else None
-
-            # Calculate opacity from resolved style
-            if color and line_opacity is None:
-                alpha_hex = color[:2]
-                alpha_decimal = int(alpha_hex, 16)
-                line_opacity = (alpha_decimal / 255) * 100
-
-            if poly_color and poly_opacity is None:
-                alpha_hex = poly_color[:2]
-                alpha_decimal = int(alpha_hex, 16)
-                poly_opacity = (alpha_decimal / 255) * 100
-
-    # Log the extracted styles for debugging
-    logging.debug(f"Extracted Styles - Line Color: {color}, Line Width: {width}, Poly Color: {poly_color}, "
-                  f"Poly Opacity: {poly_opacity}, Icon Href: {icon_href}, Icon Scale: {icon_scale}, "
-                  f"Icon Color: {icon_color}, Label Color: {label_color}, Line Opacity: {line_opacity}")
+    style_url = children.get(KML + 'styleUrl')
+    if style_url is not None and style_url.text:
+        shared = style_resolver.resolve(style_url.text.lstrip('#'), use_highlight)
+        if shared is not None:
+            if shared.has_line_style and color is None and width is None:
+                color, width = shared.color, shared.width
+            if shared.has_poly_style and poly_color is None:
+                poly_color = shared.poly_color
+            if shared.has_icon_style and (icon_href is None or icon_scale is None or icon_color is None):
+                if shared.icon_scale is not MISSING:
+                    icon_scale = shared.icon_scale
+                if shared.icon_href is not MISSING:
+                    icon_href = shared.icon_href
+                if shared.icon_color is not MISSING:
+                    icon_color = shared.icon_color
+            if shared.has_label_style and label_color is None:
+                label_color = shared.label_color
+
+    # Calculate opacity from color
+    line_opacity = alpha_percent(color) if color else None
+    poly_opacity = alpha_percent(poly_color) if poly_color else None
 
     return color, width, poly_color, poly_opacity, icon_href, icon_scale, icon_color, label_color, line_opacity
 
 
-def get_folder_element(folder_path, parent_elem, folder_dict):
+def get_folder_hierarchy(element, ns):
     """
-    Recursively creates or retrieves folder elements based on the folder path.
+    Builds the list of Folder/Document names enclosing an element, outermost first.
     """
-    if not folder_path:
-        return parent_elem
+    folder_hierarchy = []
+    parent = element.getparent()
+    while parent is not None:
+        if parent.tag in ('{http://www.opengis.net/kml/2.2}Folder', '{http://www.opengis.net/kml/2.2}Document'):
+            folder_name_element = parent.find('kml:name', ns)
+            if folder_name_element is not None and folder_name_element.text is not None:
+                folder_hierarchy.insert(0, folder_name_element.text)
+        parent = parent.getparent()
+    return folder_hierarchy
 
-    folders = folder_path.strip().split(' > ')
-    current_path = ''
-    current_elem = parent_elem
 
-    for folder_name in folders:
-        folder_name = folder_name.strip()
-        try:
-            folder_data = ast.literal_eval(folder_name)
-            if isinstance(folder_data, dict):
-                if 'featureType' in folder_data:
-                    folder_name = folder_data['featureType']
-                elif 'name' in folder_data:
-                    folder_name = folder_data['name']
-                else:
-                    folder_name = ', '.join(f'{k}: {v}' for k, v in folder_data.items())
-            else:
-                folder_name = str(folder_data)
-        except (ValueError, SyntaxError):
-            pass
+def extract_geometry_type(placemark, ns, descendants=None):
+    """
+    Identifies the geometry type of the placemark.
+    descendants is the placemark's first_descendants() map if the caller already has it.
+    """
+    if descendants is None:
+        descendants = first_descendants(placemark, PLACEMARK_DESCENDANT_TAGS)
+    for geometry_type in ('MultiGeometry', 'Point', 'LineString', 'Polygon'):
+        if KML + geometry_type in descendants:
+            return geometry_type
+    return 'Unknown'
 
-        if current_path:
-            current_path += '/' + folder_name
-        else:
-            current_path = folder_name
 
-        if current_path in folder_dict:
-            current_elem = folder_dict[current_path]
-        else:
-            # Decide whether to create a Folder or Document based on naming
-            if '.kmz' in folder_name.lower():
-                folder_elem = etree.SubElement(current_elem, "Document")
-            else:
-                folder_elem = etree.SubElement(current_elem, "Folder")
-            name_elem = etree.SubElement(folder_elem, "name")
-            name_elem.text = folder_name
-            folder_dict[current_path] = folder_elem
-            current_elem = folder_elem
+def parse_coordinate_array(coord_text):
+    """
+    Parses a KML coordinates string into an (N, 2) float64 array of (lat, lon). Raises ValueError
+    on a tuple that is not numeric (see parse_kml_coordinates).
+    """
+    return parse_kml_coordinates(coord_text)[:, :2]
 
-    return current_elem
 
+def geography_points(coordinates_element):
+    """
+    Parses a <coordinates> element into an (N, 2) lat/lon array usable in a geography, or
+    returns None if it is missing, malformed or has a latitude outside [-90, 90].
+    """
+    if coordinates_element is None or not coordinates_element.text:
+        return None
+    try:
+        points = parse_coordinate_array(coordinates_element.text)
+    except ValueError:
+        return None
+    if not len(points) or not np.isfinite(points).all() or (np.abs(points[:, 0]) > 90).any():
+        return None
+    return points
 
-def extract_geometry_type(placemark, ns):
+
+def geography_point(coordinates_element):
     """
-    Identifies the geometry type of the placemark.
+    Returns the (lat, lon) of the first tuple of a Point's <coordinates>, or None under the
+    same rules as geography_points. Plain float parsing; Points are too small for numpy to pay.
     """
-    if placemark.find('.//kml:MultiGeometry', ns) is not None:
-        return 'MultiGeometry'
-    elif placemark.find('.//kml:Point', ns) is not None:
-        return 'Point'
-    elif placemark.find('.//kml:LineString', ns) is not None:
-        return 'LineString'
-    elif placemark.find('.//kml:Polygon', ns) is not None:
-        return 'Polygon'
-    else:
-        return 'Unknown'
+    tuples = coordinates_element.text.split(None, 1) if coordinates_element is not None and coordinates_element.text else []
+    try:
+        lon, lat = (float(value) for value in tuples[0].split(',')[:2])
+    except (IndexError, ValueError):
+        return None
+    if not (math.isfinite(lon) and math.isfinite(lat)) or abs(lat) > 90:
+        return None
+    return lat, lon
+
 
+def wkt_point_list(points):
+    return ', '.join(f"{lon!r} {lat!r}" for lat, lon in points.tolist())
 
-def compute_line_length(placemark, ns):
+
+def geometry_wkt(element):
     """
-    Computes the total length of all LineStrings in the placemark.
+    Returns (wkt, point_arrays) for a KML Point, LineString, LinearRing, Polygon or MultiGeometry
+    element, or (None, []) if it has no usable coordinates. The WKT is shaped for
+    geography::STGeomFromText: single-point lines become POINTs, rings are closed and oriented
+    with the interior on their left (exterior counter-clockwise, holes clockwise), and unusable
+    parts are dropped. SQL Server may still reject it, e.g. for an edge between antipodal
+    points, so it is converted apart from the row insert. Altitudes are ignored.
+    """
+    tag = element.tag
+    if tag == KML + 'Point':
+        point = geography_point(element.find(KML + 'coordinates'))
+        if point is None:
+            return None, []
+        return f"POINT ({point[1]!r} {point[0]!r})", [np.array([point])]
+    if tag in (KML + 'LineString', KML + 'LinearRing'):
+        points = geography_points(element.find(KML + 'coordinates'))
+        if points is None:
+            return None, []
+        kind = 'POINT' if len(points) == 1 else 'LINESTRING'
+        return f"{kind} ({wkt_point_list(points)})", [points]
+    if tag == KML + 'Polygon':
+        rings = []
+        for boundary in ('outerBoundaryIs', 'innerBoundaryIs'):
+            for ring in element.iterfind(f'{KML}{boundary}/{KML}LinearRing/{KML}coordinates'):
+                points = geography_points(ring)
+                if points is None:
+                    continue
+                if (points[0] != points[-1]).any():
+                    points = np.vstack([points, points[:1]])
+                if len(points) < 4:
+                    continue
+                # Twice the signed area with x = lon, y = lat; positive means counter-clockwise
+                area = np.sum(points[:-1, 1] * points[1:, 0] - points[1:, 1] * points[:-1, 0])
+                if (area < 0) == (boundary == 'outerBoundaryIs'):
+                    points = points[::-1]
+                rings.append(points)
+            if not rings:
+                return None, []  # no usable outer boundary
+        return f"POLYGON ({', '.join(f'({wkt_point_list(points)})' for points in rings)})", rings
+    if tag == KML + 'MultiGeometry':
+        parts = [geometry_wkt(child) for child in element.iterchildren(
+            KML + 'Point', KML + 'LineString', KML + 'LinearRing', KML + 'Polygon', KML + 'MultiGeometry')]
+        parts = [(wkt, point_arrays) for wkt, point_arrays in parts if wkt]
+        if not parts:
+            return None, []
+        return (f"GEOMETRYCOLLECTION ({', '.join(wkt for wkt, _ in parts)})",
+                [points for _, point_arrays in parts for points in point_arrays])
+    return None, []
+
+
+def spatial_values(geometry_element):
+    """
+    Returns the spatial columns of a placemark as a dict: geography_wkt (WKT for geog, see
+    geometry_wkt) and the min_lat, max_lat, min_lon, max_lon of its bounding box, all None if
+    the geometry has no usable coordinates. Bounding boxes do not wrap the antimeridian.
     """
-    total_length = 0.0
+    if geometry_element is not None and geometry_element.tag == KML + 'Point':
+        point = geography_point(geometry_element.find(KML + 'coordinates'))
+        if point is not None:
+            lat, lon = point
+            return {'geography_wkt': f"POINT ({lon!r} {lat!r})",
+                    'min_lat': lat, 'max_lat': lat, 'min_lon': lon, 'max_lon': lon}
+    wkt, point_arrays = geometry_wkt(geometry_element) if geometry_element is not None else (None, [])
+    if not wkt:
+        return dict.fromkeys(('geography_wkt', 'min_lat', 'max_lat', 'min_lon', 'max_lon'))
+    points = np.concatenate(point_arrays)
+    (min_lat, min_lon), (max_lat, max_lon) = points.min(axis=0).tolist(), points.max(axis=0).tolist()
+    return {'geography_wkt': wkt, 'min_lat': min_lat, 'max_lat': max_lat, 'min_lon': min_lon, 'max_lon': max_lon}
+
+
+def haversine_segment_lengths(points):
+    """
+    Great-circle lengths in meters of consecutive segments of an (N, 2) lat/lon array on a
+    sphere of mean Earth radius. Differs from the ellipsoidal length by up to about 0.5%.
+    """
+    lat = np.radians(points[:, 0])
+    lon = np.radians(points[:, 1])
+    d_lat = np.diff(lat)
+    d_lon = np.diff(lon)
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(d_lon / 2) ** 2
+    return 2 * MEAN_EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def vincenty_segment_lengths(points, tolerance=1e-12, max_iterations=200):
+    """
+    Ellipsoidal (WGS-84) lengths in meters of consecutive segments of an (N, 2) lat/lon array,
+    using Vincenty's inverse formula evaluated for all segments at once. Agrees with
+    geopy.distance.geodesic to within 1 mm per segment; the rare nearly antipodal segments
+    where the iteration does not converge fall back to geopy.
+    """
+    lat1 = np.radians(points[:-1, 0])
+    lat2 = np.radians(points[1:, 0])
+    big_l = np.radians(points[1:, 1] - points[:-1, 1])
+
+    u1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin_u1, cos_u1 = np.sin(u1), np.cos(u1)
+    sin_u2, cos_u2 = np.sin(u2), np.cos(u2)
+
+    lam = big_l.copy()
+    converged = np.zeros(lam.shape, dtype=bool)
+    sin_sigma = cos_sigma = sigma = cos_sq_alpha = cos_2sigma_m = np.zeros_like(lam)
+    for _ in range(max_iterations):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cos_u2 * sin_lam, cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)
+        cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # Equatorial lines have cos_sq_alpha == 0
+            cos_2sigma_m = np.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+        c = WGS84_F / 16 * cos_sq_alpha * (4 + WGS84_F * (4 - 3 * cos_sq_alpha))
+        lam_prev = lam
+        lam = big_l + (1 - c) * WGS84_F * sin_alpha * (
+            sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+        converged = np.abs(lam - lam_prev) <= tolerance
+        if converged.all():
+            break
+
+    u_sq = cos_sq_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+        big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+    lengths = WGS84_B * big_a * (sigma - delta_sigma)
+
+    for i in np.flatnonzero(~converged | ~np.isfinite(lengths)):
+        lengths[i] = geodesic(tuple(points[i]), tuple(points[i + 1])).meters
+    return lengths
+
+
+def geopy_segment_lengths(points):
+    """
+    Reference segment lengths computed with geopy.distance.geodesic, one call per segment.
+    """
+    return np.array([geodesic(tuple(points[i]), tuple(points[i + 1])).meters
+                     for i in range(len(points) - 1)])
+
+
+SEGMENT_LENGTH_METHODS = {
+    'vincenty': vincenty_segment_lengths,
+    'haversine': haversine_segment_lengths,
+    'geopy': geopy_segment_lengths
+}
 
-    # Find all LineString elements in the placemark
-    line_strings = placemark.findall('.//kml:LineString', ns)
 
-    for line_string in line_strings:
+def compute_line_length(placemark, ns, method=None):
+    """
+    Computes the total length of all LineStrings in the placemark.
+    All segments of a LineString are measured in one vectorized batch using the
+    method named by line_length_method (see SEGMENT_LENGTH_METHODS).
+    """
+    segment_lengths = SEGMENT_LENGTH_METHODS[method or line_length_method]
+
+    # Stack the points of every LineString so the whole placemark is measured in one batch
+    point_arrays = []
+    for line_string in placemark.findall('.//kml:LineString', ns):
         coordinates_element = line_string.find('kml:coordinates', ns)
         if coordinates_element is not None and coordinates_element.text:
-            coordinates_list = coordinates_element.text.strip().split()
-            # Parse coordinates into list of (lat, lon) tuples
-            points = []
-            for coord in coordinates_list:
-                lon_lat_alt = coord.strip().split(',')
-                if len(lon_lat_alt) >= 2:
-                    lon = float(lon_lat_alt[0])
-                    lat = float(lon_lat_alt[1])
-                    # We can ignore altitude for distance calculation
-                    points.append((lat, lon))
-            # Compute length between consecutive points
+            points = parse_coordinate_array(coordinates_element.text)
             if len(points) >= 2:
-                for i in range(len(points) - 1):
-                    # Use geodesic distance
-                    length = geodesic(points[i], points[i + 1]).meters
-                    total_length += length
+                point_arrays.append(points)
+
+    if not point_arrays:
+        return 0.0
 
-    return total_length
+    # Drop the joining segments between the end of one LineString and the start of the next
+    lengths = segment_lengths(np.concatenate(point_arrays))
+    keep = np.ones(len(lengths), dtype=bool)
+    keep[np.cumsum([len(points) for points in point_arrays])[:-1] - 1] = False
 
+    return float(lengths[keep].sum())
 
-def extract_placemark_details(placemark, ns, styles, style_maps, use_highlight):
+
+def extract_placemark_details(placemark, ns, style_resolver, use_highlight, folder_hierarchy=None):
     """
     Extracts detailed information from a Placemark element.
+    If folder_hierarchy is None it is rebuilt by walking the element's ancestors.
     """
-    name = placemark.find('kml:name', ns).text if placemark.find('kml:name', ns) is not None else None
-    description_element = placemark.find('kml:description', ns)
-    description = description_element.text if description_element is not None else None
+    children = child_elements(placemark)
+    descendants = first_descendants(placemark, PLACEMARK_DESCENDANT_TAGS)
+
+    name = text_of(children.get(KML + 'name'))
+    description = text_of(children.get(KML + 'description'))
 
     # Extract additional data from description
     additional_data = extract_data_from_description(description)
 
     # Extract ExtendedData from <ExtendedData> tag
-    extended_data = {}
-    extended_data_element = placemark.find('kml:ExtendedData', ns)
-    if extended_data_element is not None:
-        for data_field in extended_data_element.findall('kml:Data', ns):
-            data_name = data_field.get('name')
-            data_value = data_field.find('kml:value', ns).text if data_field.find('kml:value', ns) is not None else None
-            extended_data[data_name] = data_value
+    extended_data = extract_extended_data(children.get(KML + 'ExtendedData'))
 
     # Extract LookAt or other positional information
-    longitude, latitude, altitude, heading, tilt, range_val, altitude_mode = extract_lookat(placemark, ns)
+    longitude, latitude, altitude, heading, tilt, range_val, altitude_mode = extract_lookat(placemark, ns, children)
 
     # Extract coordinates and geometry type
-    geometry_type = extract_geometry_type(placemark, ns)
+    geometry_type = extract_geometry_type(placemark, ns, descendants)
+    coordinates_element = descendants.get(KML + 'coordinates')
 
     # Initialize line_length to None
     line_length = None
 
-    # Log the entire Placemark XML for debugging
-    placemark_xml = etree.tostring(placemark, pretty_print=True, encoding='unicode')
-    logging.debug(f"Placemark XML:\n{placemark_xml}")
+    # Sampled per-feature tracing; no serialisation unless this feature is traced at DEBUG
+    trace = FEATURE_TRACE.sample()
+    if trace:
+        logging.debug("Placemark XML:\n%s", LazyXml(placemark, pretty_print=True))
 
     if geometry_type == 'MultiGeometry':
         # Extract the entire MultiGeometry element as a string
-        multi_geometry_element = placemark.find('.//kml:MultiGeometry', ns)
+        multi_geometry_element = descendants.get(KML + 'MultiGeometry')
         if multi_geometry_element is not None:
             geometry_xml = etree.tostring(multi_geometry_element, encoding='unicode')
-            logging.debug(f"Serialized MultiGeometry: {geometry_xml}")
             # Compute the total length of LineStrings in MultiGeometry
             line_length = compute_line_length(placemark, ns)
-            logging.debug(f"Computed total line length for MultiGeometry: {line_length} meters")
         else:
             geometry_xml = None
             logging.warning(f"Placemark '{name}' has MultiGeometry type but no MultiGeometry element found.")
         coordinates = None  # Coordinates are not applicable for MultiGeometry
     elif geometry_type == 'LineString':
         # Extract the LineString element and its XML
-        geometry_element = placemark.find('.//kml:LineString', ns)
+        geometry_element = descendants.get(KML + 'LineString')
         if geometry_element is not None:
             geometry_xml = etree.tostring(geometry_element, encoding='unicode')
-            logging.debug(f"Serialized Geometry (LineString): {geometry_xml}")
             # Compute the length of the LineString
             line_length = compute_line_length(placemark, ns)
-            logging.debug(f"Computed line length for LineString: {line_length} meters")
         else:
             geometry_xml = None
             logging.warning(f"Placemark '{name}' has geometry type 'LineString' but no LineString element found.")
-        coordinates_element = placemark.find('.//kml:coordinates', ns)
         if coordinates_element is not None and coordinates_element.text is not None:
             coordinates = coordinates_element.text.strip()
         else:
@@ -787,44 +1405,34 @@ def extract_placemark_details(placemark, ns, styles, style_maps, use_highlight):
     else:
         # Handle other geometry types as before
         # Extract the geometry element and its XML
-        geometry_element = placemark.find('.//kml:Point|.//kml:Polygon', ns)
+        # First Point or Polygon in document order
+        geometry_element = next((element for tag, element in descendants.items()
+                                 if tag in (KML + 'Point', KML + 'Polygon')), None)
         if geometry_element is not None:
             geometry_xml = etree.tostring(geometry_element, encoding='unicode')
-            logging.debug(f"Serialized Geometry ({geometry_type}): {geometry_xml}")
         else:
             geometry_xml = None
             logging.warning(f"Placemark '{name}' has geometry type '{geometry_type}' but no corresponding geometry element found.")
-        coordinates_element = placemark.find('.//kml:coordinates', ns)
         if coordinates_element is not None and coordinates_element.text is not None:
             coordinates = coordinates_element.text.strip()
         else:
             coordinates = None
 
-    label_scale = placemark.find('.//gx:drawOrder', ns)
-    label_scale = label_scale.text if label_scale is not None else None
+    spatial = spatial_values(multi_geometry_element if geometry_type == 'MultiGeometry' else geometry_element)
+
+    label_scale = text_of(descendants.get(GX + 'drawOrder'))
 
     # Extract style information (including the icon style)
     color, width, poly_color, poly_opacity, icon_href, icon_scale, icon_color, label_color, line_opacity = extract_style_info(
-        placemark, ns, styles, style_maps, use_highlight)
+        placemark, ns, style_resolver, use_highlight, children)
 
     # Get folder hierarchy
-    folder_hierarchy = []
-    parent = placemark.getparent()
-    while parent is not None:
-        if parent.tag in ('{http://www.opengis.net/kml/2.2}Folder', '{http://www.opengis.net/kml/2.2}Document'):
-            folder_name_element = parent.find('kml:name', ns)
-            if folder_name_element is not None and folder_name_element.text is not None:
-                folder_hierarchy.insert(0, folder_name_element.text)
-        parent = parent.getparent()
+    if folder_hierarchy is None:
+        folder_hierarchy = get_folder_hierarchy(placemark, ns)
 
     # Get attributes
     attributes = dict(placemark.attrib)
 
-    # Logging for debugging
-    logging.debug(f"Placemark: {name}")
-    logging.debug(f"Geometry Type: {geometry_type}")
-    logging.debug(f"Geometry XML: {geometry_xml}")
-
     placemark_data = {
         'name': name,
         'description': description,
@@ -863,46 +1471,55 @@ def extract_placemark_details(placemark, ns, styles, style_maps, use_highlight):
         'address': additional_data.get('address'),
         'station_voltage': additional_data.get('station_voltage'),
         'gln_x': additional_data.get('gln_x'),
-        'gln_y': additional_data.get('gln_y')
+        'gln_y': additional_data.get('gln_y'),
+        **spatial
     }
 
+    if trace:
+        logging.debug("Extracted Placemark Data: %s", placemark_data)
+
     return placemark_data
 
 
-def extract_groundoverlay_details(groundoverlay, ns):
+def extract_groundoverlay_details(groundoverlay, ns, folder_hierarchy=None):
     """
     Extracts detailed information from a GroundOverlay element.
+    If folder_hierarchy is None it is rebuilt by walking the element's ancestors.
     """
-    name = groundoverlay.find('kml:name', ns).text if groundoverlay.find('kml:name', ns) is not None else None
-    visibility = groundoverlay.find('kml:visibility', ns).text if groundoverlay.find('kml:visibility', ns) is not None else None
-    color = groundoverlay.find('kml:color', ns).text if groundoverlay.find('kml:color', ns) is not None else None
-    icon_href = groundoverlay.find('.//kml:Icon/kml:href', ns).text if groundoverlay.find('.//kml:Icon/kml:href', ns) is not None else None
+    children = child_elements(groundoverlay)
+    name = text_of(children.get(KML + 'name'))
+    visibility = text_of(children.get(KML + 'visibility'))
+    color = text_of(children.get(KML + 'color'))
+    # First <href> of any <Icon> descendant
+    icon_href = next((text_of(href) for icon in groundoverlay.iterdescendants(KML + 'Icon')
+                      for href in icon.iterchildren(KML + 'href')), None)
     rotation = None  # Initialize rotation to ensure it's always defined
 
     # Initialize view_bound_scale
     view_bound_scale = None
 
     # Check for gx:LatLonQuad
-    latlonquad = groundoverlay.find('.//gx:LatLonQuad', ns)
+    latlonquad = next(groundoverlay.iterdescendants(GX + 'LatLonQuad'), None)
     if latlonquad is not None:
-        coordinates = latlonquad.find('kml:coordinates', ns).text.strip() if latlonquad.find('kml:coordinates', ns) is not None else None
+        coordinates_element = child_elements(latlonquad).get(KML + 'coordinates')
+        coordinates = coordinates_element.text.strip() if coordinates_element is not None else None
         north = south = east = west = None  # Not applicable when using LatLonQuad
     else:
         # Fallback to LatLonBox
-        latlonbox = groundoverlay.find('kml:LatLonBox', ns)
+        latlonbox = children.get(KML + 'LatLonBox')
         if latlonbox is not None:
-            north = latlonbox.find('kml:north', ns).text if latlonbox.find('kml:north', ns) is not None else None
-            south = latlonbox.find('kml:south', ns).text if latlonbox.find('kml:south', ns) is not None else None
-            east = latlonbox.find('kml:east', ns).text if latlonbox.find('kml:east', ns) is not None else None
-            west = latlonbox.find('kml:west', ns).text if latlonbox.find('kml:west', ns) is not None else None
+            box = child_elements(latlonbox)
+            north = text_of(box.get(KML + 'north'))
+            south = text_of(box.get(KML + 'south'))
+            east = text_of(box.get(KML + 'east'))
+            west = text_of(box.get(KML + 'west'))
             coordinates = None  # No LatLonQuad; use individual values instead
 
             # Correctly Extract rotation from LatLonBox
-            rotation_elem = latlonbox.find('kml:rotation', ns)
+            rotation_elem = box.get(KML + 'rotation')
             if rotation_elem is not None and rotation_elem.text:
                 try:
                     rotation = float(rotation_elem.text)
-                    logging.debug(f"Extracted rotation: {rotation}")
                 except ValueError:
                     logging.warning(f"Invalid rotation value: {rotation_elem.text}")
             else:
@@ -911,42 +1528,26 @@ def extract_groundoverlay_details(groundoverlay, ns):
             north = south = east = west = coordinates = rotation = None
 
     # Extract viewBoundScale from <Icon>
-    icon = groundoverlay.find('kml:Icon', ns)
+    icon = children.get(KML + 'Icon')
     if icon is not None:
-        view_bound_scale_elem = icon.find('kml:viewBoundScale', ns)
+        view_bound_scale_elem = child_elements(icon).get(KML + 'viewBoundScale')
         if view_bound_scale_elem is not None and view_bound_scale_elem.text:
             try:
                 view_bound_scale = float(view_bound_scale_elem.text)
-                logging.debug(f"Extracted viewBoundScale: {view_bound_scale}")
             except ValueError:
                 logging.warning(f"Invalid viewBoundScale value: {view_bound_scale_elem.text}")
 
     # Extract ExtendedData for GroundOverlay
-    extended_data = {}
-    extended_data_element = groundoverlay.find('kml:ExtendedData', ns)
-    if extended_data_element is not None:
-        for data_field in extended_data_element.findall('kml:Data', ns):
-            data_name = data_field.get('name')
-            data_value = data_field.find('kml:value', ns).text if data_field.find('kml:value', ns) is not None else None
-            extended_data[data_name] = data_value
+    extended_data = extract_extended_data(children.get(KML + 'ExtendedData'))
 
     # Get folder hierarchy
-    folder_hierarchy = []
-    parent = groundoverlay.getparent()
-    while parent is not None:
-        if parent.tag in ('{http://www.opengis.net/kml/2.2}Folder', '{http://www.opengis.net/kml/2.2}Document'):
-            folder_name_element = parent.find('kml:name', ns)
-            if folder_name_element is not None and folder_name_element.text is not None:
-                folder_hierarchy.insert(0, folder_name_element.text)
-        parent = parent.getparent()
+    if folder_hierarchy is None:
+        folder_hierarchy = get_folder_hierarchy(groundoverlay, ns)
 
     # Get attributes
     attributes = dict(groundoverlay.attrib)
 
-    # Logging for debugging
-    logging.debug(f"GroundOverlay: {name}")
-
-    return {
+    overlay_data = {
         'name': name,
         'visibility': visibility,
         'color': color,
@@ -963,55 +1564,48 @@ def extract_groundoverlay_details(groundoverlay, ns):
         'extended_data': extended_data  # Include extended_data
     }
 
+    if FEATURE_TRACE.sample():
+        logging.debug("Extracted GroundOverlay Data: %s", overlay_data)
+
+    return overlay_data
+
 
-def extract_networklink_details(networklink, ns):
+def extract_networklink_details(networklink, ns, folder_hierarchy=None):
     """
     Extracts detailed information from a NetworkLink element.
+    If folder_hierarchy is None it is rebuilt by walking the element's ancestors.
     """
-    name = networklink.find('kml:name', ns).text if networklink.find('kml:name', ns) is not None else None
-    visibility = networklink.find('kml:visibility', ns).text if networklink.find('kml:visibility', ns) is not None else None
+    children = child_elements(networklink)
+    name = text_of(children.get(KML + 'name'))
+    visibility = text_of(children.get(KML + 'visibility'))
 
     # Extract LookAt or other positional information
-    longitude, latitude, altitude, heading, tilt, range_val, altitude_mode = extract_lookat(networklink, ns)
+    longitude, latitude, altitude, heading, tilt, range_val, altitude_mode = extract_lookat(networklink, ns, children)
 
     # Handle both <Link> and <Url>
-    link = networklink.find('kml:Link', ns)
+    link = children.get(KML + 'Link')
     if link is None:  # If <Link> is not found, try <Url>
-        link = networklink.find('kml:Url', ns)
+        link = children.get(KML + 'Url')
 
     if link is not None:
-        href = link.find('kml:href', ns).text if link.find('kml:href', ns) is not None else None
-        viewRefreshMode = link.find('kml:viewRefreshMode', ns).text if link.find('kml:viewRefreshMode', ns) is not None else None
-        viewRefreshTime = link.find('kml:viewRefreshTime', ns).text if link.find('kml:viewRefreshTime', ns) is not None else None
+        link_fields = child_elements(link)
+        href = text_of(link_fields.get(KML + 'href'))
+        viewRefreshMode = text_of(link_fields.get(KML + 'viewRefreshMode'))
+        viewRefreshTime = text_of(link_fields.get(KML + 'viewRefreshTime'))
     else:
         href = viewRefreshMode = viewRefreshTime = None
 
     # Extract ExtendedData for NetworkLink
-    extended_data = {}
-    extended_data_element = networklink.find('kml:ExtendedData', ns)
-    if extended_data_element is not None:
-        for data_field in extended_data_element.findall('kml:Data', ns):
-            data_name = data_field.get('name')
-            data_value = data_field.find('kml:value', ns).text if data_field.find('kml:value', ns) is not None else None
-            extended_data[data_name] = data_value
+    extended_data = extract_extended_data(children.get(KML + 'ExtendedData'))
 
     # Get folder hierarchy
-    folder_hierarchy = []
-    parent = networklink.getparent()
-    while parent is not None:
-        if parent.tag in ('{http://www.opengis.net/kml/2.2}Folder', '{http://www.opengis.net/kml/2.2}Document'):
-            folder_name_element = parent.find('kml:name', ns)
-            if folder_name_element is not None and folder_name_element.text is not None:
-                folder_hierarchy.insert(0, folder_name_element.text)
-        parent = parent.getparent()
+    if folder_hierarchy is None:
+        folder_hierarchy = get_folder_hierarchy(networklink, ns)
 
     # Get attributes
     attributes = dict(networklink.attrib)
 
-    # Logging for debugging
-    logging.debug(f"NetworkLink: {name}")
-
-    return {
+    networklink_data = {
         'name': name,
         'visibility': visibility,
         'longitude': longitude,
@@ -1029,6 +1623,11 @@ def extract_networklink_details(networklink, ns):
         'attributes': attributes
     }
 
+    if FEATURE_TRACE.sample():
+        logging.debug("Extracted NetworkLink Data: %s", networklink_data)
+
+    return networklink_data
+
 
 def write_to_output(data, groundoverlays, networklinks, output_file):
     """
@@ -1125,26 +1724,30 @@ def write_to_output(data, groundoverlays, networklinks, output_file):
         # ...
 
 
-def parse_kml(kml_file, conn, use_highlight=False):
+def parse_kml(kml_file, conn, use_highlight=False, batch_size=None, kmz=None, loader=None):
     """
     Parses the KML file and inserts data into the database.
+    kml_file is a path or a binary stream (e.g. KmzArchive.open_kml()); it is read once and closed.
+    When kmz is given, archive members referenced by the features are extracted from it.
+    Rows go to loader when given (e.g. a RowCollector), otherwise to a BulkLoader on conn.
     """
-    logging.info(f"Parsing .kml file: {kml_file}")
-
-    # Fix the namespace if necessary
-    corrected_kml_file_path = fix_kml_namespace(kml_file)
+    stream = open_kml_stream(kml_file)
+    logging.info(f"Parsing .kml file: {stream.name}")
 
     try:
-        tree = etree.parse(corrected_kml_file_path)
+        tree = etree.parse(stream)
     except etree.XMLSyntaxError as e:
         logging.error(f"Failed to parse KML file: {e}")
         return [], [], []
+    finally:
+        stream.close()
 
     root = tree.getroot()
     ns = {'kml': 'http://www.opengis.net/kml/2.2', 'gx': 'http://www.google.com/kml/ext/2.2'}
 
-    # Build dictionaries of styles and style maps for quick lookup
+    # Flatten styles and style maps once for quick lookup
     styles, style_maps = parse_styles_and_maps(root, ns)
+    style_resolver = StyleResolver(styles, style_maps, ns)
 
     placemarks = root.findall('.//kml:Placemark', ns)
     groundoverlays = root.findall('.//kml:GroundOverlay', ns)
@@ -1152,25 +1755,34 @@ def parse_kml(kml_file, conn, use_highlight=False):
     # Find NetworkLink elements
     networklinks = root.findall('.//kml:NetworkLink', ns)
 
+    if loader is None:
+        loader = BulkLoader(conn, batch_size or insert_batch_size)
+
     data = []
     for placemark in placemarks:
-        placemark_data = extract_placemark_details(placemark, ns, styles, style_maps, use_highlight)
-        logging.debug(f"Extracted Placemark Data: {placemark_data}")
-        insert_placemark(conn, placemark_data)
+        placemark_data = extract_placemark_details(placemark, ns, style_resolver, use_highlight)
+        loader.add_placemark(placemark_data)
+        if kmz is not None:
+            kmz.extract_references(placemark_data)
         data.append(placemark_data)
 
     groundoverlay_data = []
     for overlay in groundoverlays:
         overlay_data = extract_groundoverlay_details(overlay, ns)
-        insert_groundoverlay(conn, overlay_data)
+        loader.add_groundoverlay(overlay_data)
+        if kmz is not None:
+            kmz.extract_references(overlay_data)
         groundoverlay_data.append(overlay_data)
 
     networklink_data_list = []
     for networklink in networklinks:
         networklink_data = extract_networklink_details(networklink, ns)
-        insert_networklink(conn, networklink_data)
+        loader.add_networklink(networklink_data)
+        if kmz is not None:
+            kmz.extract_references(networklink_data)
         networklink_data_list.append(networklink_data)
-        logging.debug(f"Inserted NetworkLink: {networklink_data['name']}")
+
+    loader.flush()
 
     # Optional: Write to a text file for verification
     # output_file_path = os.path.join(os.path.dirname(kml_file), 'parsed_output.txt')
@@ -1181,6 +1793,89 @@ def parse_kml(kml_file, conn, use_highlight=False):
     return data, groundoverlay_data, networklink_data_list
 
 
+def parse_kml_streaming(kml_file, conn, use_highlight=False, batch_size=None, kmz=None, loader=None):
+    """
+    Streams the KML file with iterparse and inserts each feature as soon as its end tag is read.
+    Styles and StyleMaps must appear before the features that reference them, which is how
+    Google Earth writes them. Handled elements are cleared so memory stays flat.
+    kml_file, kmz and loader are as for parse_kml.
+    """
+    stream = open_kml_stream(kml_file)
+    logging.info(f"Streaming .kml file: {stream.name}")
+
+    ns = {'kml': 'http://www.opengis.net/kml/2.2', 'gx': 'http://www.google.com/kml/ext/2.2'}
+    kml_ns = '{%s}' % ns['kml']
+    container_tags = (kml_ns + 'Folder', kml_ns + 'Document')
+
+    style_resolver = StyleResolver({}, {}, ns)
+    folder_stack = []  # [element, name] for every open Folder/Document
+    placemark_count = groundoverlay_count = networklink_count = 0
+    if loader is None:
+        loader = BulkLoader(conn, batch_size or insert_batch_size)
+
+    try:
+        for event, elem in etree.iterparse(stream, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag in container_tags:
+                    folder_stack.append([elem, None])
+                continue
+
+            if tag == kml_ns + 'name':
+                if folder_stack and elem.getparent() is folder_stack[-1][0]:
+                    folder_stack[-1][1] = elem.text
+                continue
+
+            if tag == kml_ns + 'Style':
+                if elem.get('id'):
+                    style_resolver.add_style(elem.get('id'), elem)
+                continue
+            if tag == kml_ns + 'StyleMap':
+                if elem.get('id'):
+                    style_resolver.add_style_map(elem.get('id'), elem)
+                continue
+
+            folder_hierarchy = [name for _, name in folder_stack if name is not None]
+
+            if tag == kml_ns + 'Placemark':
+                placemark_data = extract_placemark_details(elem, ns, style_resolver, use_highlight, folder_hierarchy)
+                loader.add_placemark(placemark_data)
+                if kmz is not None:
+                    kmz.extract_references(placemark_data)
+                placemark_count += 1
+            elif tag == kml_ns + 'GroundOverlay':
+                overlay_data = extract_groundoverlay_details(elem, ns, folder_hierarchy)
+                loader.add_groundoverlay(overlay_data)
+                if kmz is not None:
+                    kmz.extract_references(overlay_data)
+                groundoverlay_count += 1
+            elif tag == kml_ns + 'NetworkLink':
+                networklink_data = extract_networklink_details(elem, ns, folder_hierarchy)
+                loader.add_networklink(networklink_data)
+                if kmz is not None:
+                    kmz.extract_references(networklink_data)
+                networklink_count += 1
+            elif tag in container_tags:
+                folder_stack.pop()
+            else:
+                continue
+
+            # Release the handled feature (or the emptied folder) and detach it from the tree
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                parent.remove(elem)
+    except etree.XMLSyntaxError as e:
+        logging.error(f"Failed to parse KML file: {e}")
+    finally:
+        stream.close()
+        loader.flush()
+
+    logging.info(f"Streamed {placemark_count} placemarks, {groundoverlay_count} ground overlays, and {networklink_count} network links.")
+
+    return placemark_count, groundoverlay_count, networklink_count
+
+
 def create_kmz_with_images(kml_file, kmz_file, source_folder):
     """
     Creates a KMZ file from a KML file and its associated resources (images).
@@ -1214,12 +1909,13 @@ def is_valid_number(value):
         return False
 
 
-def add_extended_data(element, extended_data_str):
+def add_extended_data(element, extended_data_str, data_format=None):
     """
-    Adds ExtendedData to a KML element based on a string representation of a dictionary.
+    Adds ExtendedData to a KML element based on a stored extended_data value (JSON, or a
+    legacy string representation of a dictionary).
     """
     try:
-        extended_data = ast.literal_eval(extended_data_str)
+        extended_data = decode_json_column(extended_data_str, data_format)
         if isinstance(extended_data, dict):
             extended_data_elem = etree.SubElement(element, "ExtendedData")
             for key, value in extended_data.items():
@@ -1250,31 +1946,338 @@ def copy_images_to_output(source_folder, destination_folder):
         logging.warning(f"Source folder {source_folder} does not exist. No images to copy.")
 
 
-def extract_kml(kmz_file, extract_path):
+def unique_content_hashes(rows, source_file):
+    """
+    Returns {content_hash: row} for one source's (name, row) pairs, with source_file set on each
+    row. Rows built by a BulkLoader already carry unique hashes; any duplicates left are numbered
+    the same way by number_duplicate_hash.
+    """
+    unique = {}
+    occurrences = Counter()
+    for _, row in rows:
+        row = number_duplicate_hash(row[:-1] + (source_file,), occurrences)
+        unique[row[-2]] = row
+    return unique
+
+
+def sync_source_rows(conn, source_file, rows, batch_size=None):
+    """
+    Incrementally applies one KMZ's rows (table -> (name, row) pairs, e.g. RowCollector.rows).
+    Rows whose content hash is already live for source_file are not touched. New or changed
+    features (an edit produces a new hash) are upserted with MERGE, which also revives a
+    tombstoned row that reappears. Live rows whose hash is no longer in the file are tombstoned
+    by setting deleted_at. Returns {table: (upserted, tombstoned, unchanged)}.
+    """
+    batch_size = batch_size or insert_batch_size
+    summary = {}
+    cursor = conn.cursor()
+    cursor.fast_executemany = True
+    try:
+        for table, table_rows in rows.items():
+            cursor.execute(SELECT_SOURCE_HASHES_SQL.format(table=table), (source_file,))
+            stored = {content_hash: deleted_at for content_hash, deleted_at in cursor.fetchall()}
+            incoming = unique_content_hashes(table_rows, source_file)
+            upserts = [row for content_hash, row in incoming.items()
+                       if content_hash not in stored or stored[content_hash] is not None]
+            stale = [(source_file, content_hash) for content_hash, deleted_at in stored.items()
+                     if deleted_at is None and content_hash not in incoming]
+            try:
+                for sql, params in ((MERGE_FEATURE_SQL[table], [stored_values(table, row) for row in upserts]),
+                                    (TOMBSTONE_FEATURE_SQL.format(table=table), stale)):
+                    for offset in range(0, len(params), batch_size):
+                        cursor.executemany(sql, params[offset:offset + batch_size])
+                        conn.commit()
+                if table == 'placemarks':
+                    for offset in range(0, len(upserts), batch_size):
+                        fill_geography(conn, upserts[offset:offset + batch_size])
+            except Exception as e:
+                conn.rollback()
+                logging.error(f"Incremental ingest of {table} from {source_file} failed: {e}")
+                continue
+            summary[table] = (len(upserts), len(stale), len(incoming) - len(upserts))
+            logging.info(f"{source_file} {table}: {len(upserts)} upserted, {len(stale)} tombstoned, "
+                         f"{len(incoming) - len(upserts)} unchanged")
+    finally:
+        cursor.close()
+    return summary
+
+
+KmzIngestResult = namedtuple('KmzIngestResult', ['kmz_file', 'rows', 'resources', 'seconds', 'error'])
+
+
+def find_kmz_files(source):
+    """
+    Returns the sorted .kmz paths in a directory, or matching a glob pattern.
+    """
+    if os.path.isdir(source):
+        source = os.path.join(source, '*.kmz')
+    return sorted(glob.glob(source))
+
+
+def ingest_kmz_file(kmz_file, extract_path, use_highlight=True):
+    """
+    Batch-ingest worker: parses one KMZ, extracting the resources it references under
+    extract_path, and returns its rows in a KmzIngestResult without touching the database.
+    """
+    start = time.perf_counter()
+    collector = RowCollector(os.path.basename(kmz_file))
+    try:
+        with KmzArchive(kmz_file, extract_path) as kmz:
+            if not kmz.kml_member:
+                raise ValueError("No .kml file found in the .kmz archive")
+            if streaming_ingest:
+                parse_kml_streaming(kmz.open_kml(), None, use_highlight, kmz=kmz, loader=collector)
+            else:
+                parse_kml(kmz.open_kml(), None, use_highlight, kmz=kmz, loader=collector)
+            resources = len(kmz.extracted)
+    except Exception as e:
+        return KmzIngestResult(kmz_file, {}, 0, time.perf_counter() - start, str(e))
+    return KmzIngestResult(kmz_file, collector.rows, resources, time.perf_counter() - start, None)
+
+
+def iter_ingested_kmz(kmz_files, extract_path, workers=1):
     """
-    Extracts and fixes the KML file from a KMZ archive.
+    Yields a KmzIngestResult per file as soon as it is parsed. With workers > 1 files are parsed
+    in a process pool that runs a bounded number of files ahead of the consumer.
     """
-    kml_file = extract_kml_from_kmz(kmz_file, extract_path)
-    if kml_file:
-        corrected_kml_file = fix_kml_namespace(kml_file)
-        return corrected_kml_file
+    if workers <= 1:
+        for kmz_file in kmz_files:
+            yield ingest_kmz_file(kmz_file, extract_path)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        remaining = iter(kmz_files)
+        window = workers * batch_prefetch_per_worker
+        while True:
+            while len(pending) < window:
+                kmz_file = next(remaining, None)
+                if kmz_file is None:
+                    break
+                pending.add(executor.submit(ingest_kmz_file, kmz_file, extract_path))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def sync_rows_worker(row_queue, loader, batch_size):
+    """
+    Incremental batch-ingest thread: applies (source_file, rows) items from row_queue with
+    sync_source_rows on its loader's connection until it receives None. A file that fails is
+    logged and counted in loader.failed, and the thread keeps draining the queue so the
+    producer never blocks on a dead consumer.
+    """
+    while True:
+        item = row_queue.get()
+        if item is None:
+            break
+        source_file, rows = item
+        try:
+            sync_source_rows(loader.conn, source_file, rows, batch_size)
+        except Exception as e:
+            logging.error(f"Incremental ingest of {source_file} failed: {e}")
+            for table, table_rows in rows.items():
+                loader.failed[table] += len(table_rows)
+
+
+def insert_rows_worker(row_queue, loader):
+    """
+    Batch-ingest insert thread: feeds (table, rows) chunks from row_queue into its own
+    BulkLoader until it receives None. A chunk that fails (e.g. the connection dropped) is
+    logged and counted in loader.failed, and the thread keeps draining the queue so the
+    producer never blocks on a dead consumer.
+    """
+    while True:
+        item = row_queue.get()
+        if item is None:
+            break
+        table, rows = item
+        try:
+            loader.add_rows(table, rows)
+        except Exception as e:
+            logging.error(f"Insert of {len(rows)} rows into {table} failed: {e}")
+            loader.pending[table] = []
+            loader.failed[table] += len(rows)
+    for table in loader.pending:
+        pending = len(loader.pending[table])
+        try:
+            loader._flush_table(table)
+        except Exception as e:
+            logging.error(f"Insert of {pending} rows into {table} failed: {e}")
+            loader.failed[table] += pending
+
+
+def batch_ingest(kmz_files, extract_path, workers=1, connections=None, batch_size=None, incremental=False):
+    """
+    Ingests many KMZs in parallel. Parsing and resource extraction run in up to workers
+    processes; their rows are funnelled through a bounded queue to a fixed number of insert
+    threads, each with its own connection and BulkLoader. With incremental=True each file's
+    rows are applied as a whole by sync_source_rows instead. Logs per-file parse throughput
+    and returns (files ingested, features parsed, rows inserted by plain ingest).
+    """
+    batch_size = batch_size or insert_batch_size
+    connections = max(1, connections or batch_insert_connections)
+    row_queue = queue.Queue(maxsize=connections * 2)
+    loaders = [BulkLoader(connect_db(), batch_size) for _ in range(connections)]
+    if incremental:
+        threads = [threading.Thread(target=sync_rows_worker, args=(row_queue, loader, batch_size), daemon=True)
+                   for loader in loaders]
     else:
-        logging.error("No .kml file found in the .kmz archive")
-        return None
+        threads = [threading.Thread(target=insert_rows_worker, args=(row_queue, loader), daemon=True)
+                   for loader in loaders]
+    for thread in threads:
+        thread.start()
 
+    start = time.perf_counter()
+    ingested_files = total_features = 0
+    try:
+        for result in iter_ingested_kmz(kmz_files, extract_path, workers):
+            name = os.path.basename(result.kmz_file)
+            if result.error:
+                logging.error(f"Failed to ingest {name}: {result.error}")
+                continue
+            features = sum(len(rows) for rows in result.rows.values())
+            if incremental:
+                row_queue.put((os.path.basename(result.kmz_file), result.rows))
+            else:
+                for table, rows in result.rows.items():
+                    for offset in range(0, len(rows), batch_size):
+                        row_queue.put((table, rows[offset:offset + batch_size]))
+            ingested_files += 1
+            total_features += features
+            seconds = max(result.seconds, 1e-6)
+            size = os.path.getsize(result.kmz_file)
+            logging.info(f"Parsed {name}: {features} features, {result.resources} resources in {seconds:.2f} s "
+                         f"({features / seconds:,.0f} features/s, {size / seconds / 1e6:.1f} MB/s)")
+    finally:
+        for _ in threads:
+            row_queue.put(None)
+        for thread in threads:
+            thread.join()
+        for loader in loaders:
+            loader.conn.close()
+
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    inserted = sum(sum(loader.inserted.values()) for loader in loaders)
+    failed = sum(sum(loader.failed.values()) for loader in loaders)
+    logging.info(f"Batch ingest: {ingested_files}/{len(kmz_files)} files, {total_features} features, "
+                 f"{inserted} rows inserted ({failed} failed) in {elapsed:.2f} s "
+                 f"({total_features / elapsed:,.0f} features/s) with {workers} workers "
+                 f"and {connections} connections")
+    return ingested_files, total_features, inserted
+
+
+def migrate_json_columns(conn, batch_size=None):
+    """
+    One-off migration of legacy rows (data_format NULL) from str(dict) reprs to JSON.
+    Rows are walked in id order in batches of batch_size, each rewritten with one
+    executemany and committed. Rows whose values cannot be parsed are left as they are.
+    Returns the number of rows migrated.
+    """
+    batch_size = batch_size or insert_batch_size
+    migrated = 0
+    for table in ('placemarks', 'groundoverlays', 'networklinks'):
+        cursor = conn.cursor()
+        cursor.fast_executemany = True
+        last_id = 0
+        while True:
+            cursor.execute(f"SELECT TOP ({batch_size}) id, attributes, extended_data FROM {table} "
+                           f"WHERE data_format IS NULL AND id > ? ORDER BY id", (last_id,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            updates = []
+            for row_id, attributes, extended_data in rows:
+                try:
+                    updates.append((
+                        encode_json_column(decode_json_column(attributes)),
+                        encode_json_column(decode_json_column(extended_data)),
+                        JSON_DATA_FORMAT,
+                        row_id
+                    ))
+                except (ValueError, SyntaxError) as e:
+                    logging.warning(f"Leaving {table} row {row_id} in legacy format: {e}")
+            if updates:
+                cursor.executemany(f"UPDATE {table} SET attributes = ?, extended_data = ?, data_format = ? WHERE id = ?",
+                                   updates)
+                conn.commit()
+                migrated += len(updates)
+        logging.info(f"Migrated {table} to JSON storage")
+    logging.info(f"Migrated {migrated} rows to JSON storage.")
+    return migrated
+
+
+def backfill_spatial_columns(conn, batch_size=None):
+    """
+    One-off fill of the spatial columns (see spatial_values) for placemarks ingested before they
+    existed, re-parsed from geometry_xml. Rows are walked in id order in batches of batch_size;
+    each batch's bounding boxes are updated with one executemany and committed, then its geog
+    values through execute_geography_updates, so a rejected geometry only leaves its geog NULL.
+    Returns the number of rows filled; rows without usable coordinates keep NULLs.
+    """
+    batch_size = batch_size or insert_batch_size
+    cursor = conn.cursor()
+    cursor.fast_executemany = True
+    filled = 0
+    last_id = 0
+    while True:
+        cursor.execute(f"SELECT TOP ({batch_size}) id, geometry_xml FROM placemarks "
+                       f"WHERE min_lat IS NULL AND geometry_xml IS NOT NULL AND id > ? ORDER BY id", (last_id,))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        for row_id, geometry_xml in rows:
+            try:
+                spatial = spatial_values(etree.fromstring(geometry_xml))
+            except etree.XMLSyntaxError as e:
+                logging.warning(f"Skipping placemark {row_id} with unparsable geometry_xml: {e}")
+                continue
+            if spatial['geography_wkt']:
+                updates.append((spatial['geography_wkt'], spatial['min_lat'], spatial['max_lat'],
+                                spatial['min_lon'], spatial['max_lon'], row_id))
+        if updates:
+            cursor.executemany("UPDATE placemarks SET min_lat = ?, max_lat = ?, min_lon = ?, max_lon = ? WHERE id = ?",
+                               [update[1:] for update in updates])
+            conn.commit()
+            execute_geography_updates(conn, f"UPDATE placemarks SET geog = {GEOGRAPHY_FROM_WKT_SQL.format('?')} "
+                                            f"WHERE id = ?", [(update[0], update[-1]) for update in updates])
+            filled += len(updates)
+    logging.info(f"Filled spatial columns of {filled} placemarks.")
+    return filled
 
 
 # The main function is adjusted to remove the db_path parameter
 if __name__ == "__main__":
-    current_dir = os.getcwd()  # Get the current directory
+    parser = argparse.ArgumentParser(description='Ingest a KMZ into the database.')
+    parser.add_argument('--migrate-json', action='store_true',
+                        help='Convert legacy extended_data/attributes reprs to JSON and exit')
+    parser.add_argument('--backfill-spatial', action='store_true',
+                        help='Fill the geography and bounding-box columns of placemarks ingested without them and exit')
+    parser.add_argument('--batch', metavar='DIR_OR_GLOB',
+                        help='Ingest every .kmz in a directory (or matching a glob) in parallel')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Parser processes used by --batch')
+    parser.add_argument('--db-connections', type=int, default=batch_insert_connections,
+                        help='Bulk-insert connections used by --batch')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Upsert only new or changed features and tombstone removed ones, per KMZ file name')
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging(args.log_level, trace_every=args.trace_every)
+
+    if args.migrate_json:
+        migrate_json_columns(init_db())
+        raise SystemExit(0)
+    if args.backfill_spatial:
+        backfill_spatial_columns(init_db())
+        raise SystemExit(0)
 
-    # Search for the only .kmz file in the current folder
-    kmz_files = glob.glob(os.path.join(current_dir, '*.kmz'))  # Find all .kmz files in the current directory
-
-    if len(kmz_files) == 1:
-        kmz_file = kmz_files[0]  # Use the only found .kmz file
-    else:
-        raise FileNotFoundError("Either no .kmz files or multiple .kmz files found in the current directory. Ensure there is exactly one .kmz file.")
+    current_dir = os.getcwd()  # Get the current directory
 
     # Paths for extraction
     extract_path = os.path.join(current_dir, 'outputs')  # Path for extraction
@@ -1284,18 +2287,49 @@ if __name__ == "__main__":
     images_folder = os.path.join(extract_path, 'images')
     os.makedirs(images_folder, exist_ok=True)  # Create the images folder if it doesn't exist
 
-    # Initialize the database connection
-    conn = init_db()
+    if args.batch:
+        kmz_files = find_kmz_files(args.batch)
+        if not kmz_files:
+            raise FileNotFoundError(f"No .kmz files found in {args.batch}")
+        init_db().close()  # Create the database and tables before the workers connect
+        batch_ingest(kmz_files, extract_path, workers=args.workers, connections=args.db_connections,
+                     incremental=args.incremental)
+        copy_images_to_output(os.path.join(extract_path, 'files'), images_folder)
+        raise SystemExit(0)
+
+    # Search for the only .kmz file in the current folder
+    kmz_files = glob.glob(os.path.join(current_dir, '*.kmz'))  # Find all .kmz files in the current directory
 
-    # Extract KML from KMZ
-    kml_file = extract_kml(kmz_file, extract_path)
+    if len(kmz_files) == 1:
+        kmz_file = kmz_files[0]  # Use the only found .kmz file
+    else:
+        raise FileNotFoundError("Either no .kmz files or multiple .kmz files found in the current directory. Ensure there is exactly one .kmz file, or use --batch.")
 
-    if kml_file:
-        # Parse the KML and populate the database
-        placemarks, groundoverlays, networklinks = parse_kml(kml_file, conn, use_highlight=True)
+    # Initialize the database connection
+    conn = init_db()
 
-        # Copy images to the output folder
-        source_folder = os.path.join(current_dir, 'outputs/files')  # Source folder for original images/resources
-        copy_images_to_output(source_folder, images_folder)
+    # Incremental ingest collects the whole file first, so it can tell which features disappeared
+    source_file = os.path.basename(kmz_file)
+    if args.incremental:
+        loader = RowCollector(source_file)
     else:
-        logging.error("No .kml file found in the .kmz archive")
+        loader = BulkLoader(conn, insert_batch_size, source_file)
+
+    # Stream the KML out of the KMZ; referenced resources are extracted as features are read
+    with KmzArchive(kmz_file, extract_path) as kmz:
+        if kmz.kml_member:
+            # Parse the KML and populate the database
+            if streaming_ingest:
+                parse_kml_streaming(kmz.open_kml(), conn, use_highlight=True, kmz=kmz, loader=loader)
+            else:
+                placemarks, groundoverlays, networklinks = parse_kml(kmz.open_kml(), conn, use_highlight=True,
+                                                                     kmz=kmz, loader=loader)
+            if args.incremental:
+                sync_source_rows(conn, source_file, loader.rows)
+            logging.info(f"Extracted {len(kmz.extracted)} referenced resources from {kmz_file}")
+
+            # Copy images to the output folder
+            source_folder = os.path.join(current_dir, 'outputs/files')  # Source folder for original images/resources
+            copy_images_to_output(source_folder, images_folder)
+        else:
+            logging.error("No .kml file found in the .kmz archive")